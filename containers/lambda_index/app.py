@@ -2,39 +2,45 @@
 # SPDX-License-Identifier: MIT-0
 
 import json
+import os
 import boto3
 import urllib.parse
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from opensearchpy import OpenSearch, RequestsHttpConnection, AWSV4SignerAuth, helpers
 from index_documents_helper import (
+    read_document,
     summarize_documents, 
     index_opensearch_summary_payload, 
     split_and_index_full_text,
     index_date,
-    delete_index_recs_by_key_list
+    delete_index_recs_by_key_list_from_indices,
+    get_boto3_client,
+    get_opensearch_client,
+    get_stack_outputs,
+    fan_out_run_prefix,
+    plan_document_fan_out,
+    index_document_work_unit,
+    merge_document_work_units,
+    bump_index_generation,
+    changed_or_removed_object_error_codes
 )
+from summary_cache_helper import S3SummaryCache, s3_summary_cache_prefix, s3_summary_cache_max_bytes
+from fan_out_helper import SqsWorkQueue, S3StateStore, start_fan_out, process_fan_out_message, unit_text_name, summary_text_name
+from metrics_helper import IndexingMetrics, metrics_stage
+from embedding_helper import OpenSearchMLEmbeddingBackend, get_pipeline_embedding_model_id
 
-def handler(event, context):
-
-    s3_notification = json.loads(event["Records"][0]["body"])
-    if not "Records" in s3_notification:
-        print("No records in notification.  Event dump:")
-        print(event)
-        #print("s3_notification: ", s3_notification)
-        return {"statusCode": 200}
+# Maximum number of S3 objects processed at the same time within one invocation
+max_concurrent_objects = 4
 
-    if (
-            not s3_notification["Records"][0]["eventName"] == "ObjectCreated:Put" 
-            and not s3_notification["Records"][0]["eventName"] == "ObjectCreated:CompleteMultipartUpload"
-            and not s3_notification["Records"][0]["eventName"] == "ObjectRemoved:Delete"
-            and not s3_notification["Records"][0]["eventName"] == "ObjectRemoved:DeleteMarkerCreated"
-        ):
-        print("Event is not s3 object created or object removed.  Event dump:")
-        print(event)
-        return {"statusCode": 200}
+# Records are not started with less than this many milliseconds of the invocation left, as a summary or fan-out unit
+# can take minutes and a timeout would fail every message in the batch, including those already processed
+# Records that are not started are returned to the queue at once, instead of after the visibility timeout
+min_remaining_time_to_start_ms = 300000
 
-    print("S3 notification:", s3_notification)
-    s3_object_data = s3_notification["Records"][0]["s3"]
-    print("S3 object data:", s3_object_data)
+# The handler processes every S3 record in every SQS message of the batch
+# Failed messages are returned in batchItemFailures so only they are retried by SQS
+def handler(event, context):
 
     stack_name = "chatbot-demo"
     max_file_size = 25000000
@@ -42,7 +48,21 @@ def handler(event, context):
     full_text_index_name = "chatbot-full_text"
     summary_index_name = "chatbot-summary"
     date_index_name = "chatbot-date-index"
+    # The chat drops cached answers when the counter in the generation index changes
+    generation_index_name = "chatbot-index-generation"
     pipeline_id = "chatbot-nlp-pipeline"
+    summary_cache_prefix = s3_summary_cache_prefix
+    summary_cache_max_bytes = s3_summary_cache_max_bytes
+    # Set to True to embed sections in batches with the ML predict API instead of one at a time in the ingest pipeline
+    client_side_embedding = False
+    # Objects larger than fan_out_min_file_size are split into work units that are queued and indexed by separate invocations
+    # The queue URL is set by the stack; without it, objects up to max_file_size are indexed in a single invocation
+    fan_out_queue_url = os.environ.get("FAN_OUT_QUEUE_URL")
+    fan_out_min_file_size = 10000000
+    fan_out_max_file_size = 250000000
+    fan_out_pages_per_unit = 50
+    fan_out_chars_per_unit = 250000
+    fan_out_state_prefix = "chatbot-fan-out/"
 
     # Get the current region
     session = boto3.session.Session()
@@ -50,103 +70,477 @@ def handler(event, context):
     print("Region is", region_name)
     
     # Get the name of the data bucket and the OpenSearch endpoint created by the stack
-    cf_client = boto3.client('cloudformation')
-    response = cf_client.describe_stacks(StackName=stack_name)
-    outputs = response["Stacks"][0]["Outputs"]
-    bucket_name = list(filter(lambda outputs: outputs['OutputKey'] == 'DataBucket', outputs))[0]["OutputValue"]
+    # The stack outputs are cached, so describe_stacks is only called on a cold start
+    outputs = get_stack_outputs(stack_name)
+    bucket_name = outputs['DataBucket']
     print("The name of the data bucket is:", bucket_name)
-    host = list(filter(lambda outputs: outputs['OutputKey'] == 'OpenSearchServiceDomainEndpoint', outputs))[0]["OutputValue"]
+    host = outputs['OpenSearchServiceDomainEndpoint']
     print("The endpoint for the OpenSearch domain is:", host)
 
-    # Get OpenSearch client
-    credentials = boto3.Session().get_credentials()
-    auth = AWSV4SignerAuth(credentials, region_name)
-    opensearch_client = OpenSearch(
-        hosts = [{'host': host, 'port': 443}],
-        http_auth = auth,
-        use_ssl = True,
-        verify_certs = True,
-        connection_class = RequestsHttpConnection
+    # Use the embedding model of the ingest pipeline so vectors match those the pipeline would write
+    embedding_backend = None
+    if client_side_embedding:
+        opensearch_client = get_opensearch_client(region_name, host)
+        embedding_backend = OpenSearchMLEmbeddingBackend(
+            opensearch_client = opensearch_client,
+            model_id = get_pipeline_embedding_model_id(opensearch_client, pipeline_id)
+        )
+
+    # Summary stages, and work units and merges of large documents, are queued on the same queue as the S3 notifications
+    work_queue = None
+    state_store = None
+    if fan_out_queue_url is not None:
+        work_queue = SqsWorkQueue(fan_out_queue_url, sqs_client = get_boto3_client("sqs"))
+        state_store = S3StateStore(bucket_name, fan_out_state_prefix, s3_client = get_boto3_client("s3"))
+
+    # Build a list of the S3 records in each SQS message, grouped by object key
+    # Records for the same key are processed in order so a later delete cannot race an earlier put
+    # Summary and fan-out messages are independent of each other, so each one is in a group of its own
+    object_records_by_key = {}
+    record_count = 0
+    for sqs_record in event["Records"]:
+        s3_notification = json.loads(sqs_record["body"])
+        if "summarize_document" in s3_notification:
+            object_records_by_key[("summarize", sqs_record["messageId"])] = [
+                {
+                    "message_id": sqs_record["messageId"],
+                    "summary_message": s3_notification["summarize_document"]
+                }
+            ]
+            record_count += 1
+            continue
+        if "fan_out_unit" in s3_notification or "fan_out_merge" in s3_notification:
+            object_records_by_key[("fan_out", sqs_record["messageId"])] = [
+                {
+                    "message_id": sqs_record["messageId"],
+                    "fan_out_message": s3_notification
+                }
+            ]
+            record_count += 1
+            continue
+        if not "Records" in s3_notification:
+            print("No records in notification.  Message dump:")
+            print(sqs_record)
+            continue
+        for s3_record in s3_notification["Records"]:
+            key = s3_record.get("s3", {}).get("object", {}).get("key")
+            object_records_by_key.setdefault(key, []).append(
+                {
+                    "message_id": sqs_record["messageId"],
+                    "s3_record": s3_record
+                }
+            )
+            record_count += 1
+    print("Processing", record_count, "S3 records for", len(object_records_by_key), "objects from", len(event["Records"]), "SQS messages")
+
+    config_dict = {
+        "region_name": region_name,
+        "bucket_name": bucket_name,
+        "host": host,
+        "max_file_size": max_file_size,
+        "max_summary_length": max_summary_length,
+        "full_text_index_name": full_text_index_name,
+        "summary_index_name": summary_index_name,
+        "date_index_name": date_index_name,
+        "summary_cache_prefix": summary_cache_prefix,
+        "summary_cache_max_bytes": summary_cache_max_bytes,
+        "embedding_backend": embedding_backend,
+        "work_queue": work_queue,
+        "state_store": state_store,
+        "fan_out_min_file_size": fan_out_min_file_size,
+        "fan_out_max_file_size": fan_out_max_file_size,
+        "fan_out_pages_per_unit": fan_out_pages_per_unit,
+        "fan_out_chars_per_unit": fan_out_chars_per_unit,
+        "get_remaining_time_in_millis": context.get_remaining_time_in_millis
+    }
+
+    # Process the objects concurrently and collect the SQS messages of any records that failed or were not started
+    failed_message_ids = set()
+    unstarted_message_ids = set()
+    indices_changed = False
+    with ThreadPoolExecutor(max_workers = max(1, min(max_concurrent_objects, len(object_records_by_key)))) as executor:
+        futures = [
+            executor.submit(process_object_records, object_records, config_dict)
+            for object_records in object_records_by_key.values()
+        ]
+        for future in as_completed(futures):
+            object_failed_message_ids, object_unstarted_message_ids, object_indices_changed = future.result()
+            failed_message_ids.update(object_failed_message_ids)
+            unstarted_message_ids.update(object_unstarted_message_ids)
+            indices_changed = indices_changed or object_indices_changed
+
+    # Make messages with records that were not started visible again, unless another of their records failed
+    unstarted_message_ids -= failed_message_ids
+    if len(unstarted_message_ids) > 0:
+        print("Not enough time left to start", len(unstarted_message_ids), "messages, returning them to the queue")
+        if fan_out_queue_url is not None:
+            return_messages_to_queue(fan_out_queue_url, [
+                sqs_record["receiptHandle"] for sqs_record in event["Records"] if sqs_record["messageId"] in unstarted_message_ids
+            ])
+        failed_message_ids.update(unstarted_message_ids)
+
+    # Increment the index generation after any change to the indices, so the chat stops returning answers cached before it
+    # Batches that wrote and deleted nothing, e.g. only failed records or fan-out units waiting for their merge, keep the cache
+    # A failure here does not fail the batch, as the documents are indexed and cached answers still expire with their TTL
+    if indices_changed:
+        try:
+            print("Index generation is now", bump_index_generation(region_name, host, generation_index_name))
+        except Exception as error:
+            print("Error incrementing the index generation:", repr(error))
+
+    batch_item_failures = [{"itemIdentifier": message_id} for message_id in failed_message_ids]
+    print("Batch item failures:", batch_item_failures)
+    return {"batchItemFailures": batch_item_failures}
+
+# Function to make messages of the event source queue visible again at once, so they are retried without waiting
+# for the visibility timeout; the messages are still reported in batchItemFailures if this fails
+def return_messages_to_queue(queue_url, receipt_handles):
+    sqs_client = get_boto3_client("sqs")
+    # change_message_visibility_batch accepts up to 10 messages per request
+    for start in range(0, len(receipt_handles), 10):
+        try:
+            response = sqs_client.change_message_visibility_batch(
+                QueueUrl = queue_url,
+                Entries = [
+                    {"Id": str(index), "ReceiptHandle": receipt_handle, "VisibilityTimeout": 0}
+                    for index, receipt_handle in enumerate(receipt_handles[start:start + 10])
+                ]
+            )
+        except ClientError as error:
+            print("Error returning messages to the queue:", repr(error))
+            continue
+        if len(response.get("Failed", [])) > 0:
+            print("Failed to return messages to the queue:", json.dumps(response["Failed"]))
+
+# Function to process the S3 records for one object in order
+# Returns the SQS message ids that failed, those of records not started because the invocation was running out of time,
+# and whether any record wrote or deleted records in the indices, including records that failed part way
+# After a failure, or a record that was not started, the remaining records for the object are not started either,
+# and are reported with it so they are retried in order
+# Each record's stage timings and counts are printed as CloudWatch EMF log lines, ending with a summary line for the document
+def process_object_records(object_records, config_dict):
+    failed_message_ids = []
+    unstarted_message_ids = []
+    indices_changed = False
+    for item in object_records:
+        if len(failed_message_ids) > 0:
+            failed_message_ids.append(item["message_id"])
+            continue
+        if len(unstarted_message_ids) > 0 or config_dict["get_remaining_time_in_millis"]() < min_remaining_time_to_start_ms:
+            unstarted_message_ids.append(item["message_id"])
+            continue
+        if "summary_message" in item:
+            metrics = IndexingMetrics(item["summary_message"]["key"], operation = "Summarize")
+        elif "fan_out_message" in item:
+            fan_out_message = item["fan_out_message"]
+            if "fan_out_unit" in fan_out_message:
+                metrics = IndexingMetrics(fan_out_message["fan_out_unit"]["key"], operation = "FanOutUnit")
+            else:
+                metrics = IndexingMetrics(fan_out_message["fan_out_merge"]["run_prefix"], operation = "FanOutMerge")
+        else:
+            metrics = IndexingMetrics(urllib.parse.unquote_plus(item["s3_record"].get("s3", {}).get("object", {}).get("key", "")))
+        status = "Succeeded"
+        try:
+            if "summary_message" in item:
+                process_summary_queue_message(item["summary_message"], config_dict, metrics)
+            elif "fan_out_message" in item:
+                process_fan_out_queue_message(item["fan_out_message"], config_dict, metrics)
+            else:
+                process_s3_record(item["s3_record"], config_dict, metrics)
+        except Exception as error:
+            print("Error processing message", item["message_id"], ":", repr(error))
+            failed_message_ids.append(item["message_id"])
+            status = "Failed"
+        metrics.emit_summary(status)
+        if metrics.get_count("RecordsWritten") + metrics.get_count("RecordsDeleted") > 0:
+            indices_changed = True
+    return failed_message_ids, unstarted_message_ids, indices_changed
+
+# Function to return the cache of section summaries kept under a prefix in the data bucket
+def get_summary_cache(config_dict):
+    return S3SummaryCache(
+        bucket_name = config_dict["bucket_name"],
+        prefix = config_dict["summary_cache_prefix"],
+        max_bytes = config_dict["summary_cache_max_bytes"],
+        s3_client = get_boto3_client("s3")
+    )
+
+# Function to split a large document into work units and queue them for separate invocations
+# Returns False, without queuing anything, if the document only needs one work unit
+def start_document_fan_out(key, config_dict, metrics = None):
+
+    # Planning only needs the page count of a pdf, so no pdf text is extracted here
+    parsed_document = read_document(
+        bucket_name = config_dict["bucket_name"],
+        key = key,
+        page_range = (0, 0),
+        metrics = metrics
+    )
+    plan = plan_document_fan_out(
+        parsed_document = parsed_document,
+        bucket_name = config_dict["bucket_name"],
+        pages_per_unit = config_dict["fan_out_pages_per_unit"],
+        chars_per_unit = config_dict["fan_out_chars_per_unit"]
+    )
+    if len(plan["units"]) <= 1:
+        return False
+
+    # Index the date first, so the sections written by the units are searchable before the merge
+    index_date(
+        region_name = config_dict["region_name"],
+        opensearch_host = config_dict["host"],
+        bucket_name = config_dict["bucket_name"],
+        key_list = [key],
+        date_index_name = config_dict["date_index_name"],
+        parsed_documents = {key: parsed_document},
+        metrics = metrics
+    )
+
+    # Store the text of each markdown or docx unit with the run, so units do not read and parse the whole document again
+    unit_texts = None
+    if parsed_document["file_extension"] != ".pdf":
+        unit_texts = [
+            {"text": parsed_document["text"][unit["start"]:unit["end"]], "document_date": plan["document_date"]}
+            for unit in plan["units"]
+        ]
+
+    run_prefix = fan_out_run_prefix(key, parsed_document["etag"])
+    with metrics_stage(metrics, "FanOutQueue"):
+        queued = start_fan_out(config_dict["state_store"], config_dict["work_queue"], run_prefix, plan, unit_texts)
+    print("Split", key, "into", len(plan["units"]), "work units.  Queued", queued, "units for run", run_prefix)
+    return True
+
+# Function to process a work unit or merge message of a large document
+def process_fan_out_queue_message(message, config_dict, metrics = None):
+    summary_cache = get_summary_cache(config_dict)
+
+    def process_unit(unit):
+        print("Processing", unit["kind"], unit["start"], "to", unit["end"], "of", unit["key"], "as unit", unit["unit_index"] + 1, "of", unit["unit_count"])
+        unit_text = None
+        if unit["kind"] == "characters":
+            unit_text = config_dict["state_store"].get(unit_text_name(unit["run_prefix"], unit["unit_index"]))
+        result = index_document_work_unit(
+            region_name = config_dict["region_name"],
+            opensearch_host = config_dict["host"],
+            unit = unit,
+            full_text_index_name = config_dict["full_text_index_name"],
+            max_summary_length = config_dict["max_summary_length"],
+            summary_cache = summary_cache,
+            embedding_backend = config_dict["embedding_backend"],
+            unit_text = unit_text,
+            metrics = metrics
+        )
+        if result is not None:
+            print("Unit result:", {name: value for name, value in result.items() if name not in ("summary", "record_ids")})
+        return result
+
+    def merge_units(plan, unit_results):
+        print("Merging", len(unit_results), "units of", plan["key"])
+        merge_result = merge_document_work_units(
+            region_name = config_dict["region_name"],
+            opensearch_host = config_dict["host"],
+            plan = plan,
+            unit_results = unit_results,
+            summary_index_name = config_dict["summary_index_name"],
+            full_text_index_name = config_dict["full_text_index_name"],
+            date_index_name = config_dict["date_index_name"],
+            max_summary_length = config_dict["max_summary_length"],
+            summary_cache = summary_cache,
+            embedding_backend = config_dict["embedding_backend"],
+            metrics = metrics
+        )
+        print("Merge result:", merge_result)
+
+    process_fan_out_message(
+        message = message,
+        state_store = config_dict["state_store"],
+        work_queue = config_dict["work_queue"],
+        process_unit = process_unit,
+        merge_units = merge_units
     )
 
+# Function to index or remove the document for a single S3 event record
+def process_s3_record(s3_record, config_dict, metrics = None):
+
+    if (
+            not s3_record["eventName"] == "ObjectCreated:Put" 
+            and not s3_record["eventName"] == "ObjectCreated:CompleteMultipartUpload"
+            and not s3_record["eventName"] == "ObjectRemoved:Delete"
+            and not s3_record["eventName"] == "ObjectRemoved:DeleteMarkerCreated"
+        ):
+        print("Event is not s3 object created or object removed.  Record dump:")
+        print(s3_record)
+        return
+
+    s3_object_data = s3_record["s3"]
+    print("S3 object data:", s3_object_data)
+
+    region_name = config_dict["region_name"]
+    bucket_name = config_dict["bucket_name"]
+    host = config_dict["host"]
+    max_file_size = config_dict["max_file_size"]
+    max_summary_length = config_dict["max_summary_length"]
+    full_text_index_name = config_dict["full_text_index_name"]
+    summary_index_name = config_dict["summary_index_name"]
+    date_index_name = config_dict["date_index_name"]
+    embedding_backend = config_dict["embedding_backend"]
+    work_queue = config_dict["work_queue"]
+
+    # Objects created by a single put or by a multipart upload are indexed, removed objects are deleted from the indices
+    object_created = s3_record["eventName"].startswith("ObjectCreated:")
+
+    # Large objects can be indexed up to a higher limit when they can be split into work units
+    if work_queue is not None:
+        max_file_size = config_dict["fan_out_max_file_size"]
+
     # Get the file info and check to make sure it is within the maximum size
     key = urllib.parse.unquote_plus(s3_object_data["object"]["key"])
-    print("Processing file", key, "for", s3_notification["Records"][0]["eventName"])
-    if "size" in s3_object_data["object"] and s3_notification["Records"][0]["eventName"] == "ObjectCreated:Put":
+    print("Processing file", key, "for", s3_record["eventName"])
+    file_size = 0
+    if "size" in s3_object_data["object"] and object_created:
         file_size = s3_object_data["object"]["size"]
         if  file_size > max_file_size:
             print("File size", file_size, "exceeds maximum file size", max_file_size, " Skipping.")
-            return {"statusCode": 200}
+            return
 
     key_list = [key]
-    
-    # Delete any existing records in the OpenSearch summary index for this document
-    summary_delete_result = delete_index_recs_by_key_list(
-        region_name = region_name, 
-        opensearch_host = host, 
-        key_list = key_list, 
-        index_name = summary_index_name
-    )
-    print("Summary text delete result:", summary_delete_result)
 
-    # Summarize the document using the LLM and return an OpenSearch payload
-    if s3_notification["Records"][0]["eventName"] == "ObjectCreated:Put":
-        opensearch_payload = summarize_documents(
-            region_name = region_name,
-            bucket_name = bucket_name,
-            key_list = key_list,
-            max_summary_length = max_summary_length
-        )
-        print("OpenSearch payload has", len(opensearch_payload), "records")
+    # If the document has been removed, delete its records from all three OpenSearch indices with one request per index
+    if not object_created:
+        if metrics is not None:
+            metrics.set_operation("Delete")
+        with metrics_stage(metrics, "OpenSearchDelete"):
+            delete_result = delete_index_recs_by_key_list_from_indices(
+                region_name = region_name,
+                opensearch_host = host,
+                key_list = key_list,
+                index_name_list = [summary_index_name, full_text_index_name, date_index_name],
+                metrics = metrics
+            )
+        print("Delete result:", delete_result)
+        return
 
-    # Index the OpenSearch summary payload
-    if s3_notification["Records"][0]["eventName"] == "ObjectCreated:Put":
-        summary_indexing_result = index_opensearch_summary_payload(
-            region_name = region_name,
-            opensearch_host = host,
-            opensearch_payload = opensearch_payload,
-            summary_index_name = summary_index_name
-        )
-        print("Summary indexing result:", summary_indexing_result)
+    # Split large documents into work units indexed in parallel by separate invocations
+    if work_queue is not None and file_size > config_dict["fan_out_min_file_size"]:
+        if start_document_fan_out(key, config_dict, metrics):
+            if metrics is not None:
+                metrics.set_operation("FanOutStart")
+            return
+
+    # Download and parse the document once for use by the full text, date and summary stages
+    parsed_documents = {}
+    parsed_documents[key] = read_document(
+        bucket_name = bucket_name,
+        key = key,
+        metrics = metrics
+    )
 
-    # Delete any existing records in the OpenSearch full text index for this document
-    full_text_delete_result = delete_index_recs_by_key_list(
+    # The full text and date are indexed first so the document is searchable within seconds of the upload
+    # Iterate through list of files, split into sections and write added or changed sections to OpenSearch index
+    # New versions of a document are indexed incrementally, so existing full text records are not deleted first
+    full_text_indexing_result = split_and_index_full_text(
         region_name = region_name, 
-        opensearch_host = host, 
-        key_list = key_list, 
-        index_name = full_text_index_name
+        opensearch_host = host,
+        bucket_name = bucket_name,
+        key_list = key_list,
+        full_text_index_name = full_text_index_name,
+        parsed_documents = parsed_documents,
+        incremental = True,
+        embedding_backend = embedding_backend,
+        metrics = metrics
     )
-    print("Full text delete result:", full_text_delete_result)
-
-    # Iterate through list of files, split into sections and add to OpenSearch index
-    if s3_notification["Records"][0]["eventName"] == "ObjectCreated:Put":
-        full_text_indexing_result = split_and_index_full_text(
-            region_name = region_name, 
-            opensearch_host = host,
-            bucket_name = bucket_name,
-            key_list = key_list,
-            full_text_index_name = full_text_index_name
-        )
-        print("Full text indexing result:", full_text_indexing_result)
+    print("Full text indexing result:", full_text_indexing_result)
 
-    # Delete any existing records in the OpenSearch date index for this document
-    date_delete_result = delete_index_recs_by_key_list(
+    # Iterate through list of files, get date and add to OpenSearch index, overwriting the previous date record by id
+    date_indexing_result = index_date(
         region_name = region_name, 
-        opensearch_host = host, 
-        key_list = key_list, 
-        index_name = date_index_name
+        opensearch_host = host,
+        bucket_name = bucket_name,
+        key_list = key_list,
+        date_index_name = date_index_name,
+        parsed_documents = parsed_documents,
+        metrics = metrics
     )
-    print("Date delete result:", date_delete_result)
-
-    # Iterate through list of files, get date and add to OpenSearch index
-    if s3_notification["Records"][0]["eventName"] == "ObjectCreated:Put":
-        date_indexing_result = index_date(
-            region_name = region_name, 
-            opensearch_host = host,
-            bucket_name = bucket_name,
-            key_list = key_list,
-            date_index_name = date_index_name
-        )
-        print("Date indexing result:", date_indexing_result)
+    print("Date indexing result:", date_indexing_result)
+
+    # Summarizing with the LLM can take minutes, so it is queued as a separate stage when there is a queue
+    # The extracted text is stored for the stage, so it does not download and parse the document again
+    if work_queue is not None:
+        etag = parsed_documents[key]["etag"]
+        with metrics_stage(metrics, "SummaryQueue"):
+            config_dict["state_store"].put(summary_text_name(fan_out_run_prefix(key, etag)), {"text": parsed_documents[key]["text"]})
+            work_queue.send_messages([{"summarize_document": {"key": key, "etag": etag}}])
+        print("Queued summary of", key)
+        return
+
+    summarize_and_index_documents(key_list, parsed_documents, config_dict, metrics)
+
+# Function to summarize documents using the LLM and index the summaries
+def summarize_and_index_documents(key_list, parsed_documents, config_dict, metrics = None):
+
+    # Summarize the document using the LLM and return an OpenSearch payload
+    # Section summaries are cached under a prefix in the data bucket so unchanged sections are not summarized again
+    summary_cache = get_summary_cache(config_dict)
+    opensearch_payload = summarize_documents(
+        region_name = config_dict["region_name"],
+        bucket_name = config_dict["bucket_name"],
+        key_list = key_list,
+        max_summary_length = config_dict["max_summary_length"],
+        parsed_documents = parsed_documents,
+        summary_cache = summary_cache,
+        metrics = metrics
+    )
+    print("OpenSearch payload has", len(opensearch_payload), "records")
+
+    # Skip writing the summary if the document changed or was removed while it was being summarized
+    # The event for the change queues a summary of the new version, or deletes the records of the removed document
+    for key in key_list:
+        try:
+            get_boto3_client("s3").head_object(Bucket=config_dict["bucket_name"], Key=key, IfMatch=parsed_documents[key]["etag"])
+        except ClientError as error:
+            if error.response['Error']['Code'] in changed_or_removed_object_error_codes:
+                print(key, "has changed or been removed while it was summarized.  Skipping its summary.")
+                return None
+            raise
+
+    # Index the OpenSearch summary payload
+    # Records have deterministic ids, so a new version overwrites the previous one and leftover sections are deleted by id
+    summary_indexing_result = index_opensearch_summary_payload(
+        region_name = config_dict["region_name"],
+        opensearch_host = config_dict["host"],
+        opensearch_payload = opensearch_payload,
+        summary_index_name = config_dict["summary_index_name"],
+        key_list = key_list,
+        embedding_backend = config_dict["embedding_backend"],
+        metrics = metrics
+    )
+    print("Summary indexing result:", summary_indexing_result)
+    return summary_indexing_result
 
-    return {"statusCode": 200}
\ No newline at end of file
+# Function to process a queued summary stage of a document whose full text and date have been indexed
+# The text stored when the stage was queued is summarized, and the document is only read again if there is no stored text
+# The message is skipped if the object has changed or been removed since it was queued, as the newer event handles it
+def process_summary_queue_message(message, config_dict, metrics = None):
+    key = message["key"]
+    print("Summarizing", key)
+    text_name = summary_text_name(fan_out_run_prefix(key, message["etag"]))
+    stored_text = config_dict["state_store"].get(text_name)
+    try:
+        if stored_text is not None:
+            get_boto3_client("s3").head_object(Bucket=config_dict["bucket_name"], Key=key, IfMatch=message["etag"])
+            parsed_document = {"key": key, "etag": message["etag"], "text": stored_text["text"]}
+        else:
+            parsed_document = read_document(
+                bucket_name = config_dict["bucket_name"],
+                key = key,
+                if_match = message["etag"],
+                metrics = metrics
+            )
+    except ClientError as error:
+        if error.response['Error']['Code'] in changed_or_removed_object_error_codes:
+            print(key, "has changed or been removed since its summary was queued.  Skipping.")
+            config_dict["state_store"].delete_prefix(text_name)
+            return
+        raise
+    summarize_and_index_documents([key], {key: parsed_document}, config_dict, metrics)
+    config_dict["state_store"].delete_prefix(text_name)
@@ -0,0 +1,226 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# This script populates the summary, full text and date OpenSearch indices for every document in the data bucket
+# Documents are processed by a pool of workers and each completed document is recorded in a local manifest file
+# If the script is stopped, running it again with the same manifest skips documents that are already indexed and unchanged
+# Use --dry-run to list and size the work without indexing anything
+# Use --embedding-backend to compute embeddings in batches on the client instead of one record at a time in the ingest pipeline
+#
+# Example:
+#   python backfill_indices.py --workers 8 --manifest backfill_manifest.jsonl
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import boto3
+from index_documents_helper import (
+    get_s3_object_list,
+    get_stack_outputs,
+    get_boto3_client,
+    get_opensearch_client,
+    read_document,
+    summarize_documents,
+    index_opensearch_summary_payload,
+    split_and_index_full_text,
+    index_date,
+    bump_index_generation
+)
+from summary_cache_helper import S3SummaryCache, s3_summary_cache_prefix, s3_summary_cache_max_bytes
+from embedding_helper import (
+    OpenSearchMLEmbeddingBackend,
+    SentenceTransformerEmbeddingBackend,
+    StubEmbeddingBackend,
+    get_pipeline_embedding_model_id
+)
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description = "Populate the chatbot OpenSearch indices from the documents in the data bucket.")
+    parser.add_argument("--stack-name", default = "chatbot-demo", help = "CloudFormation stack that created the data bucket and OpenSearch domain")
+    parser.add_argument("--bucket-name", help = "Data bucket name, read from the stack outputs if not given")
+    parser.add_argument("--opensearch-host", help = "OpenSearch endpoint, read from the stack outputs if not given")
+    parser.add_argument("--s3-prefix", default = "", help = "Only index keys under this prefix")
+    parser.add_argument("--max-file-size", type = int, default = 25000000, help = "Skip files larger than this many bytes")
+    parser.add_argument("--max-summary-length", type = int, default = 5000)
+    parser.add_argument("--summary-index-name", default = "chatbot-summary")
+    parser.add_argument("--full-text-index-name", default = "chatbot-full_text")
+    parser.add_argument("--date-index-name", default = "chatbot-date-index")
+    parser.add_argument("--generation-index-name", default = "chatbot-index-generation", help = "Index whose generation counter is incremented so the chat drops cached answers")
+    parser.add_argument("--summary-cache-prefix", default = s3_summary_cache_prefix, help = "S3 prefix for cached section summaries, empty to disable")
+    parser.add_argument("--pipeline-id", default = "chatbot-nlp-pipeline", help = "Ingest pipeline whose embedding model is used by the opensearch-ml backend")
+    parser.add_argument(
+        "--embedding-backend",
+        choices = ["pipeline", "opensearch-ml", "local", "stub"],
+        default = "pipeline",
+        help = "pipeline: embed in the ingest pipeline; opensearch-ml: batched ML predict calls; local: sentence-transformers on this host; stub: deterministic test vectors"
+    )
+    parser.add_argument("--embedding-batch-size", type = int, default = 32, help = "Number of texts embedded in one backend call")
+    parser.add_argument("--workers", type = int, default = 4, help = "Number of documents indexed at the same time")
+    parser.add_argument("--manifest", default = "backfill_manifest.jsonl", help = "Local file recording completed documents")
+    parser.add_argument("--dry-run", action = "store_true", help = "List and size the work without indexing")
+    return parser.parse_args()
+
+# Function to read the manifest of completed documents into a dictionary of key to ETag
+def read_manifest(manifest_path):
+    completed = {}
+    if not os.path.exists(manifest_path):
+        return completed
+    with open(manifest_path) as manifest_file:
+        for line in manifest_file:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # A partially written last line from an interrupted run is ignored
+                continue
+            completed[entry["key"]] = entry["etag"]
+    return completed
+
+# Function to index one document in the summary, full text and date indices, returning the number of sections written
+def index_document(object_info, args, region_name, bucket_name, host, summary_cache, embedding_backend):
+    key = object_info["key"]
+    key_list = [key]
+    parsed_documents = {key: read_document(bucket_name = bucket_name, key = key)}
+
+    opensearch_payload = summarize_documents(
+        region_name = region_name,
+        bucket_name = bucket_name,
+        key_list = key_list,
+        max_summary_length = args.max_summary_length,
+        parsed_documents = parsed_documents,
+        summary_cache = summary_cache
+    )
+    index_opensearch_summary_payload(
+        region_name = region_name,
+        opensearch_host = host,
+        opensearch_payload = opensearch_payload,
+        summary_index_name = args.summary_index_name,
+        key_list = key_list,
+        embedding_backend = embedding_backend
+    )
+
+    full_text_indexing_result = split_and_index_full_text(
+        region_name = region_name,
+        opensearch_host = host,
+        bucket_name = bucket_name,
+        key_list = key_list,
+        full_text_index_name = args.full_text_index_name,
+        parsed_documents = parsed_documents,
+        incremental = True,
+        embedding_backend = embedding_backend
+    )
+
+    index_date(
+        region_name = region_name,
+        opensearch_host = host,
+        bucket_name = bucket_name,
+        key_list = key_list,
+        date_index_name = args.date_index_name,
+        parsed_documents = parsed_documents
+    )
+
+    sections = len(opensearch_payload) + sum(result['sections'] for result in full_text_indexing_result)
+    return sections
+
+def main():
+    args = parse_arguments()
+
+    session = boto3.session.Session()
+    region_name = session.region_name
+    print("Region is", region_name)
+
+    if args.bucket_name is None or args.opensearch_host is None:
+        outputs = get_stack_outputs(args.stack_name)
+    bucket_name = args.bucket_name if args.bucket_name is not None else outputs['DataBucket']
+    host = args.opensearch_host if args.opensearch_host is not None else outputs['OpenSearchServiceDomainEndpoint']
+    print("The name of the data bucket is:", bucket_name)
+    print("The endpoint for the OpenSearch domain is:", host)
+
+    # List the documents and skip those already completed with the same ETag
+    object_list = get_s3_object_list(
+        bucket_name = bucket_name,
+        s3_prefix = args.s3_prefix,
+        file_extensions = (".md", ".pdf", ".docx"),
+        max_file_size = args.max_file_size
+    )
+    completed = read_manifest(args.manifest)
+    pending_list = [item for item in object_list if completed.get(item["key"]) != item["etag"]]
+    pending_bytes = sum(item["size"] for item in pending_list)
+    print("Found", len(object_list), "documents,", len(object_list) - len(pending_list), "already in manifest,", len(pending_list), "to index", "(" + str(round(pending_bytes / 1000000, 1)), "MB)")
+
+    if args.dry_run:
+        for file_extension in (".md", ".pdf", ".docx"):
+            extension_list = [item for item in pending_list if item["key"].endswith(file_extension)]
+            print(" ", file_extension, len(extension_list), "documents,", round(sum(item["size"] for item in extension_list) / 1000000, 1), "MB")
+        return 0
+
+    summary_cache = None
+    if len(args.summary_cache_prefix) > 0:
+        summary_cache = S3SummaryCache(
+            bucket_name = bucket_name,
+            prefix = args.summary_cache_prefix,
+            max_bytes = s3_summary_cache_max_bytes,
+            s3_client = get_boto3_client("s3")
+        )
+
+    embedding_backend = None
+    if args.embedding_backend == "opensearch-ml":
+        opensearch_client = get_opensearch_client(region_name, host)
+        embedding_backend = OpenSearchMLEmbeddingBackend(
+            opensearch_client = opensearch_client,
+            model_id = get_pipeline_embedding_model_id(opensearch_client, args.pipeline_id),
+            batch_size = args.embedding_batch_size
+        )
+    elif args.embedding_backend == "local":
+        embedding_backend = SentenceTransformerEmbeddingBackend(batch_size = args.embedding_batch_size)
+    elif args.embedding_backend == "stub":
+        embedding_backend = StubEmbeddingBackend(batch_size = args.embedding_batch_size)
+
+    # Index the pending documents with a pool of workers, appending each completed document to the manifest
+    start_time = time.time()
+    documents_done = 0
+    sections_done = 0
+    failed_keys = []
+    with open(args.manifest, "a") as manifest_file, ThreadPoolExecutor(max_workers = max(1, args.workers)) as executor:
+        futures = {
+            executor.submit(index_document, item, args, region_name, bucket_name, host, summary_cache, embedding_backend): item
+            for item in pending_list
+        }
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                sections = future.result()
+            except Exception as error:
+                print("Error indexing", item["key"], ":", repr(error))
+                failed_keys.append(item["key"])
+                continue
+            manifest_file.write(json.dumps({"key": item["key"], "etag": item["etag"], "sections": sections}) + "\n")
+            manifest_file.flush()
+            documents_done += 1
+            sections_done += sections
+            elapsed = max(time.time() - start_time, 0.001)
+            print(
+                "[" + str(documents_done + len(failed_keys)) + "/" + str(len(pending_list)) + "]",
+                item["key"],
+                "-", round(documents_done / elapsed, 2), "documents/sec,",
+                round(sections_done / elapsed, 1), "sections/sec"
+            )
+
+    print("Indexed", documents_done, "documents and", sections_done, "sections in", round(time.time() - start_time, 1), "seconds")
+
+    # Invalidate the answers cached by the chat before these documents were indexed
+    if documents_done > 0:
+        print("Index generation is now", bump_index_generation(region_name, host, args.generation_index_name))
+    if len(failed_keys) > 0:
+        print(len(failed_keys), "documents failed and will be retried on the next run:")
+        for key in failed_keys:
+            print(" ", key)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
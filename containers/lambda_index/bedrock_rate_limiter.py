@@ -0,0 +1,183 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# This file contains an adaptive client side rate limiter for Bedrock model calls
+# The same file is used by the indexing Lambda (batch traffic) and the Streamlit chat (interactive traffic);
+# the Streamlit build copies it from this folder (see containers/streamlit/buildspec.yml)
+#
+# Each priority class has a token bucket whose rate is adjusted with AIMD (additive increase, multiplicative decrease):
+#   - every successful call adds increase_step calls/sec to the rate, up to max_rate
+#   - every ThrottlingException multiplies the rate by decrease_factor, down to min_rate, and empties the bucket
+# Batch traffic backs off harder and recovers slower than interactive traffic, so when both share the account quota
+# from separate processes, summarization gives up quota to chat instead of competing with it
+# Within one process, batch calls also wait while any interactive call is waiting, and an interactive throttle slows batch traffic too
+#
+# The current rate, queue depth and throttles of a class can be read with get_metrics or printed in CloudWatch Embedded Metric Format
+
+import json
+import threading
+import time
+from botocore.exceptions import ClientError
+
+# Priority classes in order, highest priority first
+rate_limiter_priorities = ["interactive", "batch"]
+
+# Token bucket and AIMD settings of each priority class, in calls per second
+rate_limiter_settings = {
+    "interactive": {
+        "initial_rate": 5,
+        "min_rate": 0.5,
+        "max_rate": 20,
+        "increase_step": 0.5,
+        "decrease_factor": 0.7,
+        "burst": 5
+    },
+    "batch": {
+        "initial_rate": 2,
+        "min_rate": 0.05,
+        "max_rate": 10,
+        "increase_step": 0.1,
+        "decrease_factor": 0.5,
+        "burst": 2
+    }
+}
+
+rate_limiter_metrics_namespace = "ChatbotBedrock"
+
+# Adaptive token bucket rate limiter with a bucket per priority class, shared by all threads of a process
+class AdaptiveRateLimiter:
+    def __init__(self, settings = rate_limiter_settings):
+        self.settings = settings
+        self.condition = threading.Condition()
+        now = time.monotonic()
+        self.classes = {
+            priority: {
+                "rate": float(class_settings["initial_rate"]),
+                "tokens": float(class_settings["burst"]),
+                "last_refill": now,
+                "waiting": 0,
+                "throttles": 0
+            }
+            for priority, class_settings in settings.items()
+        }
+
+    def refill(self, priority, now):
+        state = self.classes[priority]
+        state["tokens"] = min(self.settings[priority]["burst"], state["tokens"] + (now - state["last_refill"]) * state["rate"])
+        state["last_refill"] = now
+
+    def higher_priority_waiting(self, priority):
+        for other_priority in rate_limiter_priorities:
+            if other_priority == priority:
+                return False
+            if other_priority in self.classes and self.classes[other_priority]["waiting"] > 0:
+                return True
+        return False
+
+    # Wait until a call of the priority class may be made
+    def acquire(self, priority):
+        with self.condition:
+            state = self.classes[priority]
+            state["waiting"] += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self.refill(priority, now)
+                    if state["tokens"] >= 1 and not self.higher_priority_waiting(priority):
+                        state["tokens"] -= 1
+                        return
+                    if self.higher_priority_waiting(priority):
+                        # Sleep until woken when a higher priority call is granted or gives up
+                        self.condition.wait()
+                    else:
+                        # Sleep until the next token is due, or until woken when the rate changes
+                        self.condition.wait(timeout = (1 - state["tokens"]) / state["rate"])
+            finally:
+                state["waiting"] -= 1
+                self.condition.notify_all()
+
+    def record_success(self, priority):
+        with self.condition:
+            state = self.classes[priority]
+            state["rate"] = min(self.settings[priority]["max_rate"], state["rate"] + self.settings[priority]["increase_step"])
+            self.condition.notify_all()
+
+    # Reduce the rate of the class, and of every lower priority class, after a ThrottlingException
+    def record_throttle(self, priority):
+        with self.condition:
+            now = time.monotonic()
+            for throttled_priority in rate_limiter_priorities[rate_limiter_priorities.index(priority):]:
+                if throttled_priority not in self.classes:
+                    continue
+                self.refill(throttled_priority, now)
+                state = self.classes[throttled_priority]
+                state["rate"] = max(self.settings[throttled_priority]["min_rate"], state["rate"] * self.settings[throttled_priority]["decrease_factor"])
+                state["tokens"] = 0
+            self.classes[priority]["throttles"] += 1
+
+    # Return the current rate in calls/sec, the number of waiting calls and the throttles since the last reset of a class
+    def get_metrics(self, priority, reset_throttles = False):
+        with self.condition:
+            state = self.classes[priority]
+            metrics = {
+                "BedrockCallRate": round(state["rate"], 3),
+                "BedrockQueueDepth": state["waiting"],
+                "BedrockThrottles": state["throttles"]
+            }
+            if reset_throttles:
+                state["throttles"] = 0
+        return metrics
+
+    # Print the metrics of a class as a CloudWatch Embedded Metric Format log line, resetting its throttle count
+    def emit_metrics(self, priority, namespace = rate_limiter_metrics_namespace):
+        metrics = self.get_metrics(priority, reset_throttles = True)
+        print(json.dumps({
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": namespace,
+                        "Dimensions": [["Priority"]],
+                        "Metrics": [
+                            {"Name": "BedrockCallRate", "Unit": "Count/Second"},
+                            {"Name": "BedrockQueueDepth", "Unit": "Count"},
+                            {"Name": "BedrockThrottles", "Unit": "Count"}
+                        ]
+                    }
+                ]
+            },
+            "Priority": priority,
+            **metrics
+        }))
+        return metrics
+
+# Rate limiter shared by every Bedrock call made in this process
+bedrock_rate_limiter = AdaptiveRateLimiter()
+
+# Function to return True if an error is a Bedrock throttling error
+def is_throttling_error(error):
+    return isinstance(error, ClientError) and error.response['Error']['Code'] == 'ThrottlingException'
+
+# Function to invoke a Bedrock model through the rate limiter, retrying throttled calls up to max_retries times
+# The wait before a retry comes from the reduced rate of the limiter
+# If metrics_callback is given, it is called with "ModelCalls" for every attempt and "ModelRetries" for every throttled attempt that is retried
+def invoke_model_with_rate_limit(bedrock_runtime_object, priority, max_retries = 6, rate_limiter = None, metrics_callback = None, **invoke_model_args):
+    if rate_limiter is None:
+        rate_limiter = bedrock_rate_limiter
+    for attempt in range(max_retries + 1):
+        rate_limiter.acquire(priority)
+        try:
+            if metrics_callback is not None:
+                metrics_callback("ModelCalls")
+            response = bedrock_runtime_object.invoke_model(**invoke_model_args)
+        except ClientError as error:
+            if not is_throttling_error(error):
+                raise
+            rate_limiter.record_throttle(priority)
+            if attempt == max_retries:
+                raise
+            print("Bedrock call throttled, retrying at", rate_limiter.get_metrics(priority)["BedrockCallRate"], "calls/sec")
+            if metrics_callback is not None:
+                metrics_callback("ModelRetries")
+            continue
+        rate_limiter.record_success(priority)
+        return response
@@ -0,0 +1,934 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# This script benchmarks document indexing on a laptop, without a deployed stack
+# It generates synthetic markdown, pdf and docx documents and indexes them with the same calls as the indexing Lambda
+# (read_document, summarize_documents, index_opensearch_summary_payload, split_and_index_full_text and index_date)
+# S3, Bedrock and OpenSearch are replaced by local stand-ins with configurable latency, placed in the shared client caches
+# It reports documents/sec, sections/sec, peak memory, time per stage and request counts per service
+# Use --passes 2 to also measure reindexing unchanged documents, and --json to save a report for comparing runs
+#
+# Other modes benchmark one part of indexing on its own:
+#   --mode bulk   writes --bulk-records sections to a local HTTP stand-in for OpenSearch, once with an index request per record
+#                 and once with bulk_index_records, and reports the requests and wall time of each
+#   --mode summarize  summarizes a --summarize-kb text with split_and_summarize_text_until_sized at each of --concurrency-levels
+#                 against a stand-in model with --bedrock-latency per call, reports the wall time of each level,
+#                 and exits with an error if any summary is not in section order
+#   --mode memory   reads a --pdf-pages pdf with --pdf-image-kb of image data per page, like a scanned report, once by reading
+#                 the whole object into memory and once with read_document, each in a fresh process, and reports peak memory
+#   --mode pdf-extraction   extracts the text of a --pdf-pages pdf with extract_pdf_page_texts at each of --worker-counts
+#                 and reports pages/sec, exiting with an error if any worker count returns different page texts
+#   --mode fan-out  indexes a --pdf-pages pdf and a --document-kb markdown document as work units with the indexing Lambda's
+#                 fan-out functions, on the in-memory queue and state store of fan_out_helper, delivering every unit message
+#                 and the merge message twice and one unit message again after the merge, as SQS may
+#                 It exits with an error unless the sections match indexing each document in a single invocation,
+#                 the run state is removed, and no unit downloads more than 1 + ranged_read_max_fraction times the object
+#
+# Examples:
+#   python benchmark_indexing.py --md-count 10 --pdf-count 10 --docx-count 10 --workers 4 --passes 2
+#   python benchmark_indexing.py --mode bulk --bulk-records 5000 --opensearch-latency 0.005
+#   python benchmark_indexing.py --mode summarize --summarize-kb 1000 --bedrock-latency 0.5 --concurrency-levels 1,2,4,8
+#   python benchmark_indexing.py --mode memory --pdf-pages 200 --pdf-image-kb 250
+#   python benchmark_indexing.py --mode pdf-extraction --pdf-pages 400 --worker-counts 1,2,4,8
+#   python benchmark_indexing.py --mode fan-out --pdf-pages 200 --pdf-image-kb 100 --document-kb 500
+
+import argparse
+import collections
+import contextlib
+import datetime
+import hashlib
+import http.server
+import io
+import json
+import multiprocessing
+import os
+import random
+import re
+import sys
+import threading
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from botocore.exceptions import ClientError
+import docx
+from pypdf import PdfReader
+from opensearchpy import OpenSearch
+from opensearchpy.serializer import JSONSerializer
+import index_documents_helper
+from index_documents_helper import (
+    read_document,
+    summarize_documents,
+    index_opensearch_summary_payload,
+    split_and_index_full_text,
+    index_date,
+    bulk_index_records,
+    split_and_summarize_text_until_sized,
+    iter_pdf_page_texts,
+    extract_pdf_page_texts,
+    fan_out_run_prefix
+)
+from summary_cache_helper import SqliteSummaryCache
+from fan_out_helper import InMemoryWorkQueue, InMemoryStateStore
+import app
+from embedding_helper import StubEmbeddingBackend
+from metrics_helper import IndexingMetrics
+from bedrock_rate_limiter import AdaptiveRateLimiter, rate_limiter_settings
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+benchmark_region_name = "us-east-1"
+benchmark_bucket_name = "benchmark-bucket"
+benchmark_opensearch_host = "benchmark-opensearch"
+
+word_list = (
+    "system data index search document section summary model request response cluster node query vector "
+    "embedding latency throughput storage bucket object page text report policy network security access "
+    "configuration deployment service function event message queue record field value result process"
+).split()
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description = "Benchmark document indexing against local stand-ins for S3, Bedrock and OpenSearch.")
+    parser.add_argument("--mode", choices = ["indexing", "bulk", "summarize", "memory", "pdf-extraction", "fan-out"], default = "indexing", help = "indexing: index a synthetic corpus end to end; bulk: compare per-record and _bulk writes; summarize: summarization wall time against concurrency; memory: peak memory of reading a large pdf; pdf-extraction: pdf pages/sec against worker processes; fan-out: index a pdf and a markdown document as work units and check them against a single invocation")
+    parser.add_argument("--md-count", type = int, default = 5, help = "Number of markdown documents")
+    parser.add_argument("--pdf-count", type = int, default = 5, help = "Number of pdf documents")
+    parser.add_argument("--docx-count", type = int, default = 5, help = "Number of docx documents")
+    parser.add_argument("--document-kb", type = int, default = 100, help = "Approximate text size of each markdown and docx document in KB")
+    parser.add_argument("--pdf-pages", type = int, default = 30, help = "Pages in each pdf document, with about 3 KB of text per page")
+    parser.add_argument("--pdf-image-kb", type = int, default = 0, help = "KB of image data added to each pdf page, as in scanned documents")
+    parser.add_argument("--bedrock-latency", type = float, default = 0.05, help = "Seconds per Bedrock invoke_model call")
+    parser.add_argument("--bedrock-quota", type = float, default = 0, help = "Bedrock calls/sec allowed before ThrottlingException is raised, 0 for no limit")
+    parser.add_argument("--opensearch-latency", type = float, default = 0.005, help = "Seconds per OpenSearch request")
+    parser.add_argument("--pipeline-latency", type = float, default = 0.002, help = "Seconds per record embedded by the ingest pipeline within a _bulk request")
+    parser.add_argument("--s3-latency", type = float, default = 0.01, help = "Seconds per S3 GetObject request")
+    parser.add_argument("--embedding-backend", choices = ["pipeline", "stub"], default = "pipeline", help = "pipeline: records are embedded by the simulated ingest pipeline; stub: client side StubEmbeddingBackend")
+    parser.add_argument("--summary-cache", action = "store_true", help = "Use an in-memory SQLite summary cache")
+    parser.add_argument("--pdf-workers", type = int, default = None, help = "Processes used to extract pdf text, default from index_documents_helper")
+    parser.add_argument("--workers", type = int, default = 4, help = "Number of documents indexed at the same time")
+    parser.add_argument("--passes", type = int, default = 1, help = "Number of times the documents are indexed; later passes reindex unchanged documents")
+    parser.add_argument("--max-summary-length", type = int, default = 5000)
+    parser.add_argument("--trace-memory", action = "store_true", help = "Also report peak Python heap with tracemalloc, which slows the run")
+    parser.add_argument("--bulk-records", type = int, default = 2000, help = "Number of sections written in bulk mode")
+    parser.add_argument("--summarize-kb", type = int, default = 500, help = "Size of the text summarized in summarize mode in KB")
+    parser.add_argument("--concurrency-levels", default = "1,2,4,8", help = "Comma separated summarization concurrency settings compared in summarize mode")
+    parser.add_argument("--worker-counts", default = "1,2,4", help = "Comma separated pdf extraction worker counts compared in pdf-extraction mode")
+    parser.add_argument("--fan-out-pages-per-unit", type = int, default = 50, help = "Pages of the pdf in each work unit in fan-out mode")
+    parser.add_argument("--fan-out-chars-per-unit", type = int, default = 50000, help = "Characters of the markdown document in each work unit in fan-out mode")
+    parser.add_argument("--seed", type = int, default = 1)
+    parser.add_argument("--json", help = "Write the report to this JSON file")
+    return parser.parse_args()
+
+# Function to return a paragraph of random words
+def random_paragraph(rng, sentence_count):
+    sentences = []
+    for _ in range(sentence_count):
+        words = [rng.choice(word_list) for _ in range(rng.randint(8, 20))]
+        sentences.append(" ".join(words).capitalize() + ".")
+    return " ".join(sentences)
+
+# Function to return a markdown document of about target_chars characters
+def make_markdown(rng, target_chars):
+    parts = []
+    length = 0
+    heading_number = 0
+    while length < target_chars:
+        heading_number += 1
+        part = "# Heading " + str(heading_number) + "\n\n" + random_paragraph(rng, rng.randint(3, 8)) + "\n\n" + random_paragraph(rng, rng.randint(3, 8)) + "\n\n"
+        parts.append(part)
+        length += len(part)
+    return "".join(parts).encode('utf-8')
+
+# Function to return a docx document of about target_chars characters
+def make_docx(rng, target_chars):
+    document = docx.Document()
+    document.core_properties.created = datetime.datetime(2024, 1, 1)
+    length = 0
+    heading_number = 0
+    while length < target_chars:
+        heading_number += 1
+        document.add_heading("Heading " + str(heading_number), level = 1)
+        for _ in range(2):
+            paragraph = random_paragraph(rng, rng.randint(3, 8))
+            document.add_paragraph(paragraph)
+            length += len(paragraph)
+    file_object = io.BytesIO()
+    document.save(file_object)
+    return file_object.getvalue()
+
+# Function to return a pdf document with page_count pages of text, using the standard Helvetica font
+# If image_kb is given, each page also has an uncompressed image of that many KB of random data, which has no text
+def make_pdf(rng, page_count, image_kb = 0):
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        ("<< /Type /Pages /Kids [" + " ".join(str(5 + 2 * page) + " 0 R" for page in range(page_count)) + "] /Count " + str(page_count) + " >>").encode(),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+        b"<< /Producer (benchmark_indexing) /CreationDate (D:20240101000000Z) >>"
+    ]
+    for page in range(page_count):
+        lines = []
+        while sum(len(line) for line in lines) < 3000:
+            words = [rng.choice(word_list) for _ in range(12)]
+            lines.append(" ".join(words))
+        content = ("BT /F1 9 Tf 11 TL 40 800 Td " + " ".join("(" + line + ") '" for line in lines) + " ET").encode()
+        image_resource = " /XObject << /Im1 " + str(5 + 2 * page_count + page) + " 0 R >>" if image_kb > 0 else ""
+        objects.append(("<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] /Resources << /Font << /F1 3 0 R >>" + image_resource + " >> /Contents " + str(6 + 2 * page) + " 0 R >>").encode())
+        objects.append(b"<< /Length " + str(len(content)).encode() + b" >>\nstream\n" + content + b"\nendstream")
+    if image_kb > 0:
+        for page in range(page_count):
+            image = rng.randbytes(image_kb * 1000)
+            objects.append(("<< /Type /XObject /Subtype /Image /Width 1000 /Height " + str(image_kb) + " /ColorSpace /DeviceGray /BitsPerComponent 8 /Length " + str(len(image)) + " >>").encode() + b"\nstream\n" + image + b"\nendstream")
+
+    pdf = b"%PDF-1.4\n"
+    offsets = []
+    for object_number, body in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += str(object_number).encode() + b" 0 obj\n" + body + b"\nendobj\n"
+    xref_offset = len(pdf)
+    pdf += b"xref\n0 " + str(len(objects) + 1).encode() + b"\n0000000000 65535 f \n"
+    pdf += b"".join(str(offset).zfill(10).encode() + b" 00000 n \n" for offset in offsets)
+    pdf += b"trailer\n<< /Size " + str(len(objects) + 1).encode() + b" /Root 1 0 R /Info 4 0 R >>\nstartxref\n" + str(xref_offset).encode() + b"\n%%EOF\n"
+    return pdf
+
+# Function to generate the synthetic corpus as a dictionary of key to file contents
+def make_corpus(args):
+    rng = random.Random(args.seed)
+    corpus = {}
+    for number in range(args.md_count):
+        corpus["benchmark/document-" + str(number) + ".md"] = make_markdown(rng, args.document_kb * 1000)
+    for number in range(args.pdf_count):
+        corpus["benchmark/document-" + str(number) + ".pdf"] = make_pdf(rng, args.pdf_pages)
+    for number in range(args.docx_count):
+        corpus["benchmark/document-" + str(number) + ".docx"] = make_docx(rng, args.document_kb * 1000)
+    return corpus
+
+# Request counter shared by the stand-ins
+class RequestCounter:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+
+    def add(self, name, value = 1):
+        with self.lock:
+            self.counts[name] += value
+
+# Exceptions raised by the S3 stand-in, as boto3 clients expose them
+class LocalS3Exceptions:
+    class NoSuchKey(ClientError):
+        pass
+
+# Stand-in for the S3 client, serving the corpus from memory
+# Supports ranged and conditional reads, and the writes, listings and deletes of the summary cache
+class LocalS3Client:
+    exceptions = LocalS3Exceptions
+
+    def __init__(self, corpus, latency, counter):
+        self.corpus = corpus
+        self.latency = latency
+        self.counter = counter
+        self.last_modified = datetime.datetime.now(datetime.timezone.utc)
+        self.etags = {}
+
+    def get_etag(self, key):
+        body = self.corpus[key]
+        if key not in self.etags or self.etags[key][0] is not body:
+            self.etags[key] = (body, '"' + hashlib.md5(body).hexdigest() + '"')
+        return self.etags[key][1]
+
+    def check_object(self, key, if_match, operation_name):
+        if key not in self.corpus:
+            raise self.exceptions.NoSuchKey({"Error": {"Code": "NoSuchKey", "Message": "Not found"}}, operation_name)
+        if if_match is not None and if_match != self.get_etag(key):
+            raise ClientError({"Error": {"Code": "PreconditionFailed", "Message": "ETag does not match"}}, operation_name)
+
+    def head_object(self, Bucket, Key, IfMatch = None):
+        self.counter.add("S3 HeadObject")
+        time.sleep(self.latency)
+        self.check_object(Key, IfMatch, "HeadObject")
+        return {"ContentLength": len(self.corpus[Key]), "ETag": self.get_etag(Key), "LastModified": self.last_modified}
+
+    def get_object(self, Bucket, Key, IfMatch = None, Range = None):
+        self.counter.add("S3 GetObject")
+        time.sleep(self.latency)
+        self.check_object(Key, IfMatch, "GetObject")
+        body = self.corpus[Key]
+        if Range is not None:
+            first_byte, last_byte = Range[len("bytes="):].split("-")
+            body = body[int(first_byte):int(last_byte) + 1]
+        self.counter.add("S3 bytes read", len(body))
+        return {
+            "Body": io.BytesIO(body),
+            "ContentLength": len(body),
+            "ETag": self.get_etag(Key),
+            "LastModified": self.last_modified
+        }
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.counter.add("S3 PutObject")
+        self.corpus[Key] = Body
+
+    def get_paginator(self, operation_name):
+        client = self
+
+        class ListObjectsPaginator:
+            def paginate(self, Bucket, Prefix):
+                return [{"Contents": [
+                    {"Key": key, "Size": len(body), "LastModified": client.last_modified}
+                    for key, body in sorted(client.corpus.items())
+                    if key.startswith(Prefix)
+                ]}]
+
+        return ListObjectsPaginator()
+
+    def delete_objects(self, Bucket, Delete):
+        for item in Delete["Objects"]:
+            self.corpus.pop(item["Key"], None)
+        return {}
+
+# Stand-in for the Bedrock runtime client, returning a canned summary after a fixed latency
+# If quota is set, calls beyond quota calls in the last second raise ThrottlingException, as Bedrock does
+class LocalBedrockRuntimeClient:
+    canned_summary = (
+        "The document describes how the system indexes and searches documents. "
+        "It explains the configuration of the cluster and the services it uses. "
+        "It lists the steps to deploy and operate the solution. "
+        "It notes the limits on request latency and throughput."
+    )
+
+    def __init__(self, latency, quota, counter):
+        self.latency = latency
+        self.quota = quota
+        self.counter = counter
+        self.lock = threading.Lock()
+        self.call_times = collections.deque()
+
+    def invoke_model(self, body, modelId, accept, contentType):
+        self.counter.add("Bedrock InvokeModel")
+        if self.quota > 0:
+            with self.lock:
+                now = time.monotonic()
+                while len(self.call_times) > 0 and self.call_times[0] < now - 1:
+                    self.call_times.popleft()
+                throttled = len(self.call_times) >= self.quota
+                if not throttled:
+                    self.call_times.append(now)
+            if throttled:
+                self.counter.add("Bedrock throttled")
+                raise ClientError({"Error": {"Code": "ThrottlingException", "Message": "Too many requests"}}, "InvokeModel")
+        input_text = json.loads(body)["inputText"]
+        self.counter.add("Bedrock input characters", len(input_text))
+        time.sleep(self.latency)
+        return {"body": io.BytesIO(json.dumps({"results": [{"outputText": self.summarize(input_text)}]}).encode())}
+
+    def summarize(self, input_text):
+        return self.canned_summary
+
+# Stand-in for the Bedrock runtime client whose summary of a section is the first position marker in it
+# Summaries joined in section order therefore list the markers in increasing order
+class MarkerBedrockRuntimeClient(LocalBedrockRuntimeClient):
+    def summarize(self, input_text):
+        return re.search(r"m[0-9]{7}", input_text).group(0)
+
+class LocalTransport:
+    def __init__(self):
+        self.serializer = JSONSerializer()
+
+# Stand-in for the OpenSearch client, keeping records in memory
+# Supports the _bulk, scroll search and delete_by_query requests made by index_documents_helper
+# Records indexed without pipeline _none are charged pipeline_latency each, as the ingest pipeline would embed them
+class LocalOpenSearchClient:
+    def __init__(self, request_latency, pipeline_latency, counter):
+        self.transport = LocalTransport()
+        self.request_latency = request_latency
+        self.pipeline_latency = pipeline_latency
+        self.counter = counter
+        self.lock = threading.Lock()
+        self.indices = collections.defaultdict(dict)
+        self.next_id = 0
+
+    def bulk(self, body, index = None, **kwargs):
+        self.counter.add("OpenSearch _bulk")
+        lines = [json.loads(line) for line in body.splitlines() if len(line) > 0]
+        items = []
+        pipeline_records = 0
+        position = 0
+        with self.lock:
+            while position < len(lines):
+                op_type, meta = next(iter(lines[position].items()))
+                position += 1
+                records = self.indices[meta.get("_index", index)]
+                record_id = meta.get("_id")
+                status = 200
+                if op_type in ("index", "create"):
+                    source = dict(lines[position])
+                    position += 1
+                    if record_id is None:
+                        self.next_id += 1
+                        record_id = "auto-" + str(self.next_id)
+                    if meta.get("pipeline") != "_none":
+                        pipeline_records += 1
+                    # Vectors are not kept, to keep the memory of the stand-in small
+                    source.pop("text_embedding", None)
+                    status = 200 if record_id in records else 201
+                    records[record_id] = source
+                elif op_type == "update":
+                    doc = lines[position]["doc"]
+                    position += 1
+                    if record_id in records:
+                        records[record_id].update(doc)
+                    else:
+                        status = 404
+                elif op_type == "delete":
+                    status = 200 if records.pop(record_id, None) is not None else 404
+                items.append({op_type: {"_index": meta.get("_index", index), "_id": record_id, "status": status}})
+        self.counter.add("OpenSearch records written", len(items))
+        self.counter.add("OpenSearch records embedded by pipeline", pipeline_records)
+        time.sleep(self.request_latency + pipeline_records * self.pipeline_latency)
+        return {"took": 1, "errors": any(item[next(iter(item))]["status"] >= 300 for item in items), "items": items}
+
+    # Scroll searches return every match in the first page
+    def search(self, body = None, index = None, **kwargs):
+        self.counter.add("OpenSearch search")
+        time.sleep(self.request_latency)
+        key = body["query"]["term"]["document.keyword"]
+        source_fields = body.get("_source")
+        with self.lock:
+            hits = [
+                {
+                    "_index": index,
+                    "_id": record_id,
+                    "_source": {name: value for name, value in source.items() if source_fields is None or name in source_fields}
+                }
+                for record_id, source in self.indices[index].items()
+                if source.get("document") == key
+            ]
+        return {"_scroll_id": "scroll", "_shards": {"total": 1, "successful": 1, "skipped": 0}, "hits": {"hits": hits}}
+
+    def scroll(self, body = None, **kwargs):
+        return {"_scroll_id": "scroll", "_shards": {"total": 1, "successful": 1, "skipped": 0}, "hits": {"hits": []}}
+
+    def clear_scroll(self, body = None, **kwargs):
+        return {}
+
+    def delete_by_query(self, index, body, **kwargs):
+        self.counter.add("OpenSearch delete_by_query")
+        time.sleep(self.request_latency)
+        keys = set(body["query"]["terms"]["document.keyword"])
+        with self.lock:
+            records = self.indices[index]
+            deleted = [record_id for record_id, source in records.items() if source.get("document") in keys]
+            for record_id in deleted:
+                del records[record_id]
+        return {"deleted": len(deleted)}
+
+# Stand-in for the OpenSearch HTTP API, accepting index (POST /<index>/_doc) and _bulk requests
+# Each request is delayed by the server's request_latency and counted, and the records are discarded
+class LocalOpenSearchHttpHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Send responses immediately on the kept-alive connection, as OpenSearch does, instead of waiting on delayed ACKs
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.server.request_latency)
+        path = self.path.split("?")[0]
+        if path.endswith("/_bulk"):
+            self.server.counter.add("OpenSearch _bulk")
+            lines = [json.loads(line) for line in body.splitlines() if len(line) > 0]
+            # Every action in this benchmark is an index action followed by its source
+            items = [{"index": {"_id": str(position), "status": 201}} for position in range(0, len(lines), 2)]
+            response = {"took": 1, "errors": False, "items": items}
+        else:
+            self.server.counter.add("OpenSearch index")
+            response = {"_id": "1", "result": "created"}
+        self.server.counter.add("OpenSearch records written", len(items) if path.endswith("/_bulk") else 1)
+        response_body = json.dumps(response).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response_body)))
+        self.end_headers()
+        self.wfile.write(response_body)
+
+    def log_message(self, format, *args):
+        pass
+
+# Function to write the sections of a synthetic document with one request per record and with _bulk requests
+# Returns the report of each write path
+def run_bulk_benchmark(args):
+    rng = random.Random(args.seed)
+    records = [
+        {
+            "document": "benchmark/document.pdf",
+            "section": section_number,
+            "page": section_number // 6 + 1,
+            "text": random_paragraph(rng, 6)[:512]
+        }
+        for section_number in range(args.bulk_records)
+    ]
+
+    counter = RequestCounter()
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), LocalOpenSearchHttpHandler)
+    server.request_latency = args.opensearch_latency
+    server.counter = counter
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    opensearch_client = OpenSearch(hosts = [{"host": "127.0.0.1", "port": server.server_address[1]}], use_ssl = False)
+
+    reports = []
+    for write_path in ("index per record", "bulk_index_records"):
+        counter.counts.clear()
+        start_time = time.perf_counter()
+        if write_path == "index per record":
+            for record in records:
+                opensearch_client.index(index = "chatbot-full_text", body = record)
+        else:
+            bulk_index_records(opensearch_client, "chatbot-full_text", records)
+        elapsed = time.perf_counter() - start_time
+        reports.append({
+            "write_path": write_path,
+            "records": len(records),
+            "requests": counter.counts["OpenSearch index"] + counter.counts["OpenSearch _bulk"],
+            "records_written": counter.counts["OpenSearch records written"],
+            "seconds": round(elapsed, 2),
+            "records_per_second": round(len(records) / elapsed, 1)
+        })
+    server.shutdown()
+
+    for report in reports:
+        print(report["write_path"].ljust(20), report["records_written"], "records in", report["requests"], "requests,", report["seconds"], "seconds,", report["records_per_second"], "records/sec")
+    print("Requests reduced", str(round(reports[0]["requests"] / max(1, reports[1]["requests"]), 1)) + "x, wall time reduced", str(round(reports[0]["seconds"] / max(0.001, reports[1]["seconds"]), 1)) + "x")
+    return reports
+
+# Function to summarize a text of position markers at each concurrency level and check the summaries stay in section order
+# Returns the report of each level
+def run_summarize_benchmark(args):
+    text = " ".join("m" + str(position).zfill(7) for position in range(args.summarize_kb * 125))
+    # The limiter allows every call at once, so wall time reflects the concurrency setting rather than the limiter's ramp up
+    unlimited_settings = dict(rate_limiter_settings, batch = {"initial_rate": 1000, "min_rate": 1, "max_rate": 1000, "increase_step": 1, "decrease_factor": 0.5, "burst": 1000})
+    index_documents_helper.bedrock_rate_limiter = AdaptiveRateLimiter(unlimited_settings)
+
+    reports = []
+    for concurrency in [int(level) for level in args.concurrency_levels.split(",")]:
+        counter = RequestCounter()
+        bedrock_runtime_object = MarkerBedrockRuntimeClient(args.bedrock_latency, 0, counter)
+        start_time = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            summary = split_and_summarize_text_until_sized(
+                region_name = benchmark_region_name,
+                text = text,
+                max_summary_length = args.max_summary_length,
+                max_concurrency = concurrency,
+                bedrock_runtime_object = bedrock_runtime_object
+            )
+        elapsed = time.perf_counter() - start_time
+        positions = [int(marker[1:]) for marker in summary.split()]
+        reports.append({
+            "concurrency": concurrency,
+            "model_calls": counter.counts["Bedrock InvokeModel"],
+            "seconds": round(elapsed, 2),
+            "in_order": len(positions) > 0 and all(first < second for first, second in zip(positions, positions[1:]))
+        })
+
+    for report in reports:
+        print(
+            "Concurrency", str(report["concurrency"]).rjust(3), "-", report["model_calls"], "calls in", report["seconds"], "seconds,",
+            str(round(reports[0]["seconds"] / max(0.001, report["seconds"]), 1)) + "x,",
+            "summaries in section order" if report["in_order"] else "SUMMARIES OUT OF ORDER"
+        )
+    return reports
+
+# Stand-in for the S3 client, streaming the object from a local file as S3 streams the response body
+class LocalFileS3Client:
+    def __init__(self, path):
+        self.path = path
+
+    def get_object(self, Bucket, Key, IfMatch = None):
+        return {
+            "Body": open(self.path, "rb"),
+            "ContentLength": os.path.getsize(self.path),
+            "ETag": '"memory-benchmark"',
+            "LastModified": datetime.datetime.now(datetime.timezone.utc)
+        }
+
+# Function run in a fresh process to read a pdf from a file-backed S3 stand-in and return the peak memory of the read
+# "whole object" reads the body into memory and extracts every page from it; "read_document" uses the indexing Lambda's read path
+def measure_pdf_read_memory(read_path, pdf_path):
+    index_documents_helper.boto3_client_cache[("s3", None)] = LocalFileS3Client(pdf_path)
+    index_documents_helper.pdf_extraction_workers = 1
+    baseline_rss_mb = peak_rss_mb()
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        if read_path == "whole object":
+            body = index_documents_helper.get_boto3_client("s3").get_object(Bucket = benchmark_bucket_name, Key = "benchmark/scanned.pdf")["Body"].read()
+            page_texts = list(iter_pdf_page_texts(PdfReader(io.BytesIO(body))))
+        else:
+            page_texts = read_document(benchmark_bucket_name, "benchmark/scanned.pdf")["page_texts"]
+    elapsed = time.perf_counter() - start_time
+    peak_heap_mb = tracemalloc.get_traced_memory()[1] / 1000000
+    tracemalloc.stop()
+    return {
+        "read_path": read_path,
+        "pages": len(page_texts),
+        "text_mb": round(sum(len(text) for text in page_texts) / 1000000, 1),
+        "seconds": round(elapsed, 2),
+        "peak_python_heap_mb": round(peak_heap_mb, 1),
+        "peak_rss_growth_mb": round(peak_rss_mb() - baseline_rss_mb, 1) if baseline_rss_mb is not None else None
+    }
+
+# Function to compare the peak memory of reading a large pdf whole and with read_document
+# Returns the report of each read path
+def run_memory_benchmark(args):
+    rng = random.Random(args.seed)
+    reports = []
+    with tempfile.TemporaryDirectory() as directory:
+        pdf_path = os.path.join(directory, "scanned.pdf")
+        with open(pdf_path, "wb") as pdf_file:
+            pdf_file.write(make_pdf(rng, args.pdf_pages, args.pdf_image_kb))
+        file_mb = round(os.path.getsize(pdf_path) / 1000000, 1)
+        print("pdf of", args.pdf_pages, "pages,", file_mb, "MB")
+        # Each read path runs in its own process, so its peak RSS is not hidden by the other's
+        for read_path in ("whole object", "read_document"):
+            with ProcessPoolExecutor(max_workers = 1, mp_context = multiprocessing.get_context("spawn")) as executor:
+                report = executor.submit(measure_pdf_read_memory, read_path, pdf_path).result()
+            report["file_mb"] = file_mb
+            reports.append(report)
+
+    for report in reports:
+        print(
+            report["read_path"].ljust(15), report["pages"], "pages,", report["text_mb"], "MB of text in", report["seconds"], "seconds -",
+            "peak Python heap", report["peak_python_heap_mb"], "MB, peak RSS growth", report["peak_rss_growth_mb"], "MB"
+        )
+    return reports
+
+# Function to extract the text of a pdf with each number of worker processes and check every count returns the same pages
+# Returns the report of each worker count
+def run_pdf_extraction_benchmark(args):
+    rng = random.Random(args.seed)
+    file_object = io.BytesIO(make_pdf(rng, args.pdf_pages, args.pdf_image_kb))
+    print("pdf of", args.pdf_pages, "pages,", round(len(file_object.getvalue()) / 1000000, 1), "MB,", os.cpu_count(), "CPUs")
+
+    reports = []
+    serial_page_texts = None
+    for worker_count in [int(count) for count in args.worker_counts.split(",")]:
+        reader = PdfReader(file_object)
+        start_time = time.perf_counter()
+        page_texts = extract_pdf_page_texts(reader, file_object, max_workers = worker_count)
+        elapsed = time.perf_counter() - start_time
+        if serial_page_texts is None:
+            serial_page_texts = page_texts
+        reports.append({
+            "workers": worker_count,
+            "pages": len(page_texts),
+            "seconds": round(elapsed, 2),
+            "pages_per_second": round(len(page_texts) / elapsed, 1),
+            "same_text": page_texts == serial_page_texts
+        })
+
+    for report in reports:
+        print(
+            "Workers", str(report["workers"]).rjust(3), "-", report["pages"], "pages in", report["seconds"], "seconds,",
+            report["pages_per_second"], "pages/sec,", str(round(report["pages_per_second"] / reports[0]["pages_per_second"], 1)) + "x,",
+            "same page texts" if report["same_text"] else "DIFFERENT PAGE TEXTS"
+        )
+    return reports
+
+# Function to return the full text sections of a document in an index of the OpenSearch stand-in, in section order
+def get_indexed_sections(opensearch_client, index_name, key):
+    return sorted(
+        (record["section"], record.get("page"), record.get("section_heading"), record["text"])
+        for record in opensearch_client.indices[index_name].values()
+        if record["document"] == key
+    )
+
+# Function to index a pdf and a markdown document as fan-out work units, and check them against a single invocation
+# Messages are processed one at a time from the in-memory queue, with every message delivered twice and the first unit
+# message delivered again after the merge, so duplicate and late deliveries are covered
+# Returns the report of each document
+def run_fan_out_benchmark(args):
+    rng = random.Random(args.seed)
+    corpus = {
+        "benchmark/fan-out.pdf": make_pdf(rng, args.pdf_pages, args.pdf_image_kb),
+        "benchmark/fan-out.md": make_markdown(rng, args.document_kb * 1000)
+    }
+    counter = RequestCounter()
+    s3_client = LocalS3Client(corpus, args.s3_latency, counter)
+    opensearch_client = LocalOpenSearchClient(args.opensearch_latency, 0, counter)
+    index_documents_helper.boto3_client_cache[("s3", None)] = s3_client
+    index_documents_helper.boto3_client_cache[("bedrock-runtime", benchmark_region_name)] = LocalBedrockRuntimeClient(args.bedrock_latency, 0, counter)
+    index_documents_helper.opensearch_client_cache[(benchmark_region_name, benchmark_opensearch_host)] = opensearch_client
+    unlimited_settings = dict(rate_limiter_settings, batch = {"initial_rate": 1000, "min_rate": 1, "max_rate": 1000, "increase_step": 1, "decrease_factor": 0.5, "burst": 1000})
+    index_documents_helper.bedrock_rate_limiter = AdaptiveRateLimiter(unlimited_settings)
+
+    work_queue = InMemoryWorkQueue()
+    state_store = InMemoryStateStore()
+    config_dict = {
+        "region_name": benchmark_region_name,
+        "bucket_name": benchmark_bucket_name,
+        "host": benchmark_opensearch_host,
+        "max_summary_length": args.max_summary_length,
+        "full_text_index_name": "chatbot-full_text",
+        "summary_index_name": "chatbot-summary",
+        "date_index_name": "chatbot-date-index",
+        "summary_cache_prefix": "chatbot-summary-cache/",
+        "summary_cache_max_bytes": 100000000,
+        "embedding_backend": None,
+        "work_queue": work_queue,
+        "state_store": state_store,
+        "fan_out_pages_per_unit": args.fan_out_pages_per_unit,
+        "fan_out_chars_per_unit": args.fan_out_chars_per_unit
+    }
+    max_unit_bytes_ratio = 1 + index_documents_helper.ranged_read_max_fraction
+
+    reports = []
+    for key in list(corpus):
+        object_size = len(corpus[key])
+        with contextlib.redirect_stdout(io.StringIO()):
+            # Index the document in a single invocation into a separate index, as the sections to compare with
+            split_and_index_full_text(
+                region_name = benchmark_region_name,
+                opensearch_host = benchmark_opensearch_host,
+                bucket_name = benchmark_bucket_name,
+                key_list = [key],
+                full_text_index_name = "benchmark-single-invocation"
+            )
+
+            counter.counts.clear()
+            start_time = time.perf_counter()
+            if not app.start_document_fan_out(key, config_dict):
+                raise ValueError(key + " is not large enough to split into work units with these settings")
+            planning_bytes = counter.counts["S3 bytes read"]
+
+            unit_bytes = []
+            first_unit_message = None
+            merges = 0
+            while True:
+                message = work_queue.receive()
+                if message is None:
+                    break
+                if "fan_out_unit" in message and first_unit_message is None:
+                    first_unit_message = message
+                for delivery in range(2):
+                    bytes_before = counter.counts["S3 bytes read"]
+                    app.process_fan_out_queue_message(message, config_dict)
+                    if "fan_out_unit" in message:
+                        unit_bytes.append(counter.counts["S3 bytes read"] - bytes_before)
+                if "fan_out_merge" in message:
+                    merges += 1
+            # A unit message delivered again after the run has been merged must leave the merged document unchanged
+            app.process_fan_out_queue_message(first_unit_message, config_dict)
+            while work_queue.receive() is not None:
+                merges += 1
+            elapsed = time.perf_counter() - start_time
+
+        fan_out_sections = get_indexed_sections(opensearch_client, "chatbot-full_text", key)
+        single_invocation_sections = get_indexed_sections(opensearch_client, "benchmark-single-invocation", key)
+        report = {
+            "document": key,
+            "object_bytes": object_size,
+            "units": len(unit_bytes) // 2,
+            "seconds": round(elapsed, 2),
+            "sections": len(fan_out_sections),
+            "same_sections": fan_out_sections == single_invocation_sections,
+            "sections_numbered": [section[0] for section in fan_out_sections] == list(range(1, len(fan_out_sections) + 1)),
+            "summary_records": sum(1 for record in opensearch_client.indices["chatbot-summary"].values() if record["document"] == key),
+            "merges": merges,
+            "state_left": len(state_store.list(fan_out_run_prefix(key, s3_client.get_etag(key)))),
+            "planning_bytes_ratio": round(planning_bytes / object_size, 2),
+            "unit_bytes_ratio": round(sum(unit_bytes) / object_size, 2),
+            "max_unit_bytes_ratio": round(max(unit_bytes, default = 0) / object_size, 2),
+            "requests": dict(sorted(counter.counts.items()))
+        }
+        report["passed"] = (
+            report["same_sections"]
+            and report["sections_numbered"]
+            and report["summary_records"] > 0
+            and report["merges"] == 1
+            and report["state_left"] == 0
+            and report["max_unit_bytes_ratio"] <= max_unit_bytes_ratio
+        )
+        reports.append(report)
+
+    for report in reports:
+        print(report["document"], "-", round(report["object_bytes"] / 1000000, 2), "MB in", report["units"], "units,", report["seconds"], "seconds")
+        print("   Sections:", report["sections"], "same as a single invocation" if report["same_sections"] else "DIFFERENT FROM A SINGLE INVOCATION",
+              "and numbered 1 to n" if report["sections_numbered"] else "NOT NUMBERED 1 TO N")
+        print("   Summary records:", report["summary_records"], " merges:", report["merges"], " state objects left:", report["state_left"])
+        print("   S3 bytes read / object size: planning", report["planning_bytes_ratio"], " all unit deliveries", report["unit_bytes_ratio"],
+              " largest unit delivery", report["max_unit_bytes_ratio"], "(limit " + str(max_unit_bytes_ratio) + ")")
+        print("   " + ("Passed" if report["passed"] else "FAILED"))
+    return reports
+
+# Function to index one document the same way as process_s3_record in the indexing Lambda
+# The full text and date are indexed first, then the summary, which the Lambda runs as a separate queued stage
+# Returns the metrics of the document and the seconds until its full text and date were searchable
+def index_document(key, args, summary_cache, embedding_backend):
+    metrics = IndexingMetrics(key, operation = "Benchmark")
+    key_list = [key]
+    parsed_documents = {key: read_document(benchmark_bucket_name, key, metrics = metrics)}
+    split_and_index_full_text(
+        region_name = benchmark_region_name,
+        opensearch_host = benchmark_opensearch_host,
+        bucket_name = benchmark_bucket_name,
+        key_list = key_list,
+        full_text_index_name = "chatbot-full_text",
+        parsed_documents = parsed_documents,
+        incremental = True,
+        embedding_backend = embedding_backend,
+        metrics = metrics
+    )
+    index_date(
+        region_name = benchmark_region_name,
+        opensearch_host = benchmark_opensearch_host,
+        bucket_name = benchmark_bucket_name,
+        key_list = key_list,
+        date_index_name = "chatbot-date-index",
+        parsed_documents = parsed_documents,
+        metrics = metrics
+    )
+    searchable_seconds = time.perf_counter() - metrics.start_time
+    opensearch_payload = summarize_documents(
+        region_name = benchmark_region_name,
+        bucket_name = benchmark_bucket_name,
+        key_list = key_list,
+        max_summary_length = args.max_summary_length,
+        parsed_documents = parsed_documents,
+        summary_cache = summary_cache,
+        metrics = metrics
+    )
+    index_opensearch_summary_payload(
+        region_name = benchmark_region_name,
+        opensearch_host = benchmark_opensearch_host,
+        opensearch_payload = opensearch_payload,
+        summary_index_name = "chatbot-summary",
+        key_list = key_list,
+        embedding_backend = embedding_backend,
+        metrics = metrics
+    )
+    return metrics, searchable_seconds
+
+# Function to return the peak resident memory of the process in MB, or None where it is not available
+# On Linux VmHWM is read from /proc, as ru_maxrss is kept across exec and so includes the peak of a spawning parent
+def peak_rss_mb():
+    if os.path.exists("/proc/self/status"):
+        with open("/proc/self/status") as status_file:
+            for line in status_file:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1000, 1)
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KB on Linux
+    return round(max_rss / (1000000 if sys.platform == "darwin" else 1000), 1)
+
+# Function to index every document in the corpus once and return the report for the pass
+def run_pass(pass_number, corpus, args, counter, summary_cache, embedding_backend):
+    counter.counts.clear()
+    start_time = time.perf_counter()
+    # The helper functions print progress for each document, which is not part of the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        with ThreadPoolExecutor(max_workers = max(1, args.workers)) as executor:
+            document_results = list(executor.map(lambda key: index_document(key, args, summary_cache, embedding_backend), corpus))
+    elapsed = time.perf_counter() - start_time
+
+    stage_durations = collections.Counter()
+    stage_counts = collections.Counter()
+    searchable_seconds = [seconds for metrics, seconds in document_results]
+    for metrics, seconds in document_results:
+        stage_durations.update(metrics.durations)
+        stage_counts.update(metrics.counts)
+    sections = stage_counts["Sections"]
+
+    report = {
+        "pass": pass_number,
+        "documents": len(corpus),
+        "sections": sections,
+        "seconds": round(elapsed, 2),
+        "mean_seconds_to_searchable": round(sum(searchable_seconds) / max(1, len(searchable_seconds)), 2),
+        "max_seconds_to_searchable": round(max(searchable_seconds, default = 0), 2),
+        "documents_per_second": round(len(corpus) / elapsed, 2),
+        "sections_per_second": round(sections / elapsed, 1),
+        "peak_rss_mb": peak_rss_mb(),
+        "stage_seconds": {stage_name: round(duration_ms / 1000, 2) for stage_name, duration_ms in sorted(stage_durations.items())},
+        "stage_counts": dict(sorted(stage_counts.items())),
+        "requests": dict(sorted(counter.counts.items()))
+    }
+    if args.trace_memory:
+        report["peak_python_heap_mb"] = round(tracemalloc.get_traced_memory()[1] / 1000000, 1)
+        tracemalloc.reset_peak()
+    return report
+
+# Function to print the report of a pass
+def print_report(report):
+    print("Pass", report["pass"], "-", report["documents"], "documents,", report["sections"], "full text sections in", report["seconds"], "seconds")
+    print("  ", report["documents_per_second"], "documents/sec,", report["sections_per_second"], "sections/sec")
+    print("   Seconds to searchable (full text and date indexed): mean", report["mean_seconds_to_searchable"], "max", report["max_seconds_to_searchable"])
+    print("   Peak RSS:", report["peak_rss_mb"], "MB" + (", peak Python heap: " + str(report["peak_python_heap_mb"]) + " MB" if "peak_python_heap_mb" in report else ""))
+    print("   Time per stage (summed over concurrent documents):")
+    for stage_name, seconds in report["stage_seconds"].items():
+        print("     ", stage_name.ljust(20), seconds, "s")
+    print("   Counts:")
+    for name, value in report["stage_counts"].items():
+        print("     ", name.ljust(20), value)
+    print("   Requests:")
+    for name, value in report["requests"].items():
+        print("     ", name.ljust(40), value)
+
+# Function to write the reports of a run to the --json file, if one was given
+def write_json_report(args, reports):
+    if args.json is not None:
+        with open(args.json, "w") as report_file:
+            json.dump({"arguments": vars(args), "passes": reports}, report_file, indent = 2)
+        print("Report written to", args.json)
+
+def main():
+    args = parse_arguments()
+    if args.mode == "bulk":
+        reports = run_bulk_benchmark(args)
+        write_json_report(args, reports)
+        return 0
+    if args.mode == "summarize":
+        reports = run_summarize_benchmark(args)
+        write_json_report(args, reports)
+        return 0 if all(report["in_order"] for report in reports) else 1
+    if args.mode == "pdf-extraction":
+        reports = run_pdf_extraction_benchmark(args)
+        write_json_report(args, reports)
+        return 0 if all(report["same_text"] for report in reports) else 1
+    if args.mode == "memory":
+        reports = run_memory_benchmark(args)
+        write_json_report(args, reports)
+        return 0
+    if args.mode == "fan-out":
+        reports = run_fan_out_benchmark(args)
+        write_json_report(args, reports)
+        return 0 if all(report["passed"] for report in reports) else 1
+    if args.trace_memory:
+        tracemalloc.start()
+    if args.pdf_workers is not None:
+        index_documents_helper.pdf_extraction_workers = args.pdf_workers
+
+    print("Generating", args.md_count, "markdown,", args.pdf_count, "pdf and", args.docx_count, "docx documents")
+    corpus = make_corpus(args)
+    print("Corpus size:", round(sum(len(body) for body in corpus.values()) / 1000000, 1), "MB")
+
+    # Place the stand-ins in the client caches so the helper functions use them instead of AWS clients
+    counter = RequestCounter()
+    index_documents_helper.boto3_client_cache[("s3", None)] = LocalS3Client(corpus, args.s3_latency, counter)
+    index_documents_helper.boto3_client_cache[("bedrock-runtime", benchmark_region_name)] = LocalBedrockRuntimeClient(args.bedrock_latency, args.bedrock_quota, counter)
+    index_documents_helper.opensearch_client_cache[(benchmark_region_name, benchmark_opensearch_host)] = LocalOpenSearchClient(args.opensearch_latency, args.pipeline_latency, counter)
+
+    summary_cache = SqliteSummaryCache(":memory:") if args.summary_cache else None
+    embedding_backend = StubEmbeddingBackend() if args.embedding_backend == "stub" else None
+
+    reports = []
+    for pass_number in range(1, args.passes + 1):
+        report = run_pass(pass_number, corpus, args, counter, summary_cache, embedding_backend)
+        print_report(report)
+        reports.append(report)
+
+    write_json_report(args, reports)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,80 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# This file contains embedding backends used to compute text embeddings on the client when indexing
+# Records written with a precomputed text_embedding skip the chatbot-nlp-pipeline ingest pipeline,
+# so the embedding model is called once per batch instead of once per record on the data nodes
+# Every backend exposes batch_size and embed_texts(texts), which returns one vector per text in the same order
+
+import hashlib
+import math
+
+# Function to return the embedding model id used by the text_embedding processor of an ingest pipeline
+# Using the pipeline's model keeps client side vectors identical to the vectors the pipeline would write
+def get_pipeline_embedding_model_id(opensearch_client, pipeline_id):
+    pipeline = opensearch_client.ingest.get_pipeline(id=pipeline_id)[pipeline_id]
+    for processor in pipeline["processors"]:
+        if "text_embedding" in processor:
+            return processor["text_embedding"]["model_id"]
+    raise ValueError("Pipeline " + pipeline_id + " has no text_embedding processor")
+
+# Function to compute the embeddings of a list of texts with a backend, one batch_size request at a time
+def embed_texts_in_batches(embedding_backend, texts):
+    embeddings = []
+    for start in range(0, len(texts), embedding_backend.batch_size):
+        embeddings.extend(embedding_backend.embed_texts(texts[start:start + embedding_backend.batch_size]))
+    return embeddings
+
+# Embedding backend using the OpenSearch ML Commons predict API, with many texts in each request
+# This is the same model the ingest pipeline uses, but called once per batch instead of once per record
+class OpenSearchMLEmbeddingBackend:
+    def __init__(self, opensearch_client, model_id, batch_size = 32):
+        self.opensearch_client = opensearch_client
+        self.model_id = model_id
+        self.batch_size = batch_size
+
+    def embed_texts(self, texts):
+        response = self.opensearch_client.transport.perform_request(
+            "POST",
+            "/_plugins/_ml/_predict/text_embedding/" + self.model_id,
+            body = {
+                "text_docs": texts,
+                "target_response": ["sentence_embedding"]
+            }
+        )
+        return [result["output"][0]["data"] for result in response["inference_results"]]
+
+# Embedding backend running a sentence-transformers model locally, e.g. on a backfill host with a GPU
+# Use the model registered in OpenSearch so vectors match those written by the ingest pipeline and used at query time
+class SentenceTransformerEmbeddingBackend:
+    def __init__(self, model_name = "sentence-transformers/all-distilroberta-v1", batch_size = 32):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            raise ImportError("SentenceTransformerEmbeddingBackend requires the sentence-transformers package")
+        self.model = SentenceTransformer(model_name)
+        self.batch_size = batch_size
+
+    def embed_texts(self, texts):
+        embeddings = self.model.encode(texts, batch_size = self.batch_size, normalize_embeddings = True)
+        return [embedding.tolist() for embedding in embeddings]
+
+# Deterministic embedding backend for tests and benchmarks, returning a unit vector derived from a hash of each text
+# The vectors have no semantic meaning
+class StubEmbeddingBackend:
+    def __init__(self, dimension = 768, batch_size = 32):
+        self.dimension = dimension
+        self.batch_size = batch_size
+
+    def embed_texts(self, texts):
+        embeddings = []
+        for text in texts:
+            values = []
+            counter = 0
+            while len(values) < self.dimension:
+                digest = hashlib.sha256((str(counter) + ":" + text).encode('utf-8')).digest()
+                values.extend(byte / 127.5 - 1 for byte in digest)
+                counter += 1
+            values = values[:self.dimension]
+            norm = math.sqrt(sum(value * value for value in values)) or 1
+            embeddings.append([value / norm for value in values])
+        return embeddings
@@ -0,0 +1,251 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# This file coordinates fan-out processing of documents too large to index in a single Lambda invocation
+# A document is planned as a list of work units (page ranges of a pdf, character ranges of markdown or docx text)
+# Each unit is sent as its own queue message and processed by a separate invocation, which stores its result
+# The unit that completes the run queues a single merge message, which assembles the document summary and date
+#
+# Run state is kept in a state store under a run prefix:
+#   plan.json            the document and its list of work units
+#   texts/NNNNNN.json    the text of each markdown or docx unit, stored when the run is planned
+#   results/NNNNNN.json  the result of each completed unit
+#   merge_queued.json    created once by the unit that queues the merge
+#
+# The text of a document queued for its summary stage is kept under summaries/ and the document's run prefix
+# until the stage has run, so the stage does not read and parse the document again
+#
+# Queues expose send_messages(messages) and state stores expose put, get, list, create and delete_prefix
+# SQS and S3 implementations are used in Lambda, and in-memory stand-ins are provided to run the coordination locally
+
+import boto3
+import collections
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError, ParamValidationError
+
+# Number of unit texts stored at the same time when a run is started
+unit_text_put_concurrency = 16
+
+# Function to return the name of the result of a work unit in the state store
+def unit_result_name(run_prefix, unit_index):
+    return run_prefix + "results/" + str(unit_index).zfill(6) + ".json"
+
+# Function to return the name of the stored text of a work unit in the state store
+def unit_text_name(run_prefix, unit_index):
+    return run_prefix + "texts/" + str(unit_index).zfill(6) + ".json"
+
+# Function to return the name of the stored text of a document queued for its summary stage in the state store
+def summary_text_name(run_prefix):
+    return "summaries/" + run_prefix + "text.json"
+
+# Work queue backed by SQS, sending each message as a JSON body
+class SqsWorkQueue:
+    def __init__(self, queue_url, sqs_client = None):
+        self.queue_url = queue_url
+        self.sqs_client = sqs_client if sqs_client is not None else boto3.client("sqs")
+
+    def send_messages(self, messages):
+        # send_message_batch accepts up to 10 messages per request
+        for start in range(0, len(messages), 10):
+            response = self.sqs_client.send_message_batch(
+                QueueUrl = self.queue_url,
+                Entries = [
+                    {"Id": str(index), "MessageBody": json.dumps(message)}
+                    for index, message in enumerate(messages[start:start + 10])
+                ]
+            )
+            if len(response.get("Failed", [])) > 0:
+                raise RuntimeError("Failed to queue fan-out messages: " + json.dumps(response["Failed"]))
+
+# In-memory work queue, used to run the coordination without SQS
+class InMemoryWorkQueue:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.messages = collections.deque()
+
+    def send_messages(self, messages):
+        with self.lock:
+            # Round trip through JSON so messages behave as they would on SQS
+            self.messages.extend(json.loads(json.dumps(message)) for message in messages)
+
+    def receive(self):
+        with self.lock:
+            return self.messages.popleft() if len(self.messages) > 0 else None
+
+# State store backed by JSON objects under a prefix of an S3 bucket
+class S3StateStore:
+    def __init__(self, bucket_name, prefix, s3_client = None):
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.s3_client = s3_client if s3_client is not None else boto3.client("s3")
+
+    def put(self, name, value):
+        self.s3_client.put_object(
+            Bucket = self.bucket_name,
+            Key = self.prefix + name,
+            Body = json.dumps(value, default = str).encode('utf-8'),
+            ContentType = "application/json"
+        )
+
+    def get(self, name):
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=self.prefix + name)
+        except self.s3_client.exceptions.NoSuchKey:
+            return None
+        return json.loads(response["Body"].read())
+
+    def list(self, name_prefix):
+        names = []
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=self.prefix + name_prefix):
+            names.extend(item["Key"][len(self.prefix):] for item in page.get("Contents", []))
+        return names
+
+    # Create an object only if it does not exist, returning False if it already existed
+    def create(self, name, value):
+        try:
+            self.s3_client.put_object(
+                Bucket = self.bucket_name,
+                Key = self.prefix + name,
+                Body = json.dumps(value, default = str).encode('utf-8'),
+                ContentType = "application/json",
+                IfNoneMatch = "*"
+            )
+        except ParamValidationError:
+            # Older botocore versions do not support conditional writes; fall back to a check then write
+            if self.get(name) is not None:
+                return False
+            self.put(name, value)
+        except ClientError as error:
+            if error.response['Error']['Code'] in ("PreconditionFailed", "ConditionalRequestConflict"):
+                return False
+            raise
+        return True
+
+    def delete_prefix(self, name_prefix):
+        keys = [{"Key": self.prefix + name} for name in self.list(name_prefix)]
+        # delete_objects accepts up to 1000 keys per request, and reports keys it could not delete in Errors instead of raising
+        for start in range(0, len(keys), 1000):
+            response = self.s3_client.delete_objects(
+                Bucket = self.bucket_name,
+                Delete = {"Objects": keys[start:start + 1000], "Quiet": True}
+            )
+            if len(response.get("Errors", [])) > 0:
+                raise RuntimeError("Failed to delete fan-out state: " + json.dumps(response["Errors"]))
+
+# In-memory state store, used to run the coordination without S3
+class InMemoryStateStore:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.objects = {}
+
+    def put(self, name, value):
+        with self.lock:
+            self.objects[name] = json.dumps(value, default = str)
+
+    def get(self, name):
+        with self.lock:
+            value = self.objects.get(name)
+        return json.loads(value) if value is not None else None
+
+    def list(self, name_prefix):
+        with self.lock:
+            return sorted(name for name in self.objects if name.startswith(name_prefix))
+
+    def create(self, name, value):
+        with self.lock:
+            if name in self.objects:
+                return False
+            self.objects[name] = json.dumps(value, default = str)
+        return True
+
+    def delete_prefix(self, name_prefix):
+        with self.lock:
+            for name in [name for name in self.objects if name.startswith(name_prefix)]:
+                del self.objects[name]
+
+# Function to start a fan-out run: store the plan and queue a message for each unit that has no result yet
+# If unit_texts is given, the value at each unit's position is stored for the unit before its message is queued
+# Starting a run again, e.g. when the S3 event is delivered twice, only queues the units that are still missing
+# Returns the number of unit messages queued
+def start_fan_out(state_store, work_queue, run_prefix, plan, unit_texts = None):
+    state_store.put(run_prefix + "plan.json", plan)
+    completed = set(state_store.list(run_prefix + "results/"))
+    pending_units = [unit for unit in plan["units"] if unit_result_name(run_prefix, unit["unit_index"]) not in completed]
+    if unit_texts is not None and len(pending_units) > 0:
+        with ThreadPoolExecutor(max_workers = min(unit_text_put_concurrency, len(pending_units))) as executor:
+            list(executor.map(
+                lambda unit: state_store.put(unit_text_name(run_prefix, unit["unit_index"]), unit_texts[unit["unit_index"]]),
+                pending_units
+            ))
+    messages = [
+        {"fan_out_unit": dict(unit, run_prefix = run_prefix, unit_count = len(plan["units"]))}
+        for unit in pending_units
+    ]
+    if len(messages) > 0:
+        work_queue.send_messages(messages)
+    else:
+        queue_fan_out_merge(state_store, work_queue, run_prefix)
+    return len(messages)
+
+# Function to queue the merge message of a run once, however many units find the run complete at the same time
+def queue_fan_out_merge(state_store, work_queue, run_prefix):
+    if not state_store.create(run_prefix + "merge_queued.json", {"run_prefix": run_prefix}):
+        return False
+    try:
+        work_queue.send_messages([{"fan_out_merge": {"run_prefix": run_prefix}}])
+    except Exception:
+        # Let a retry of this unit queue the merge
+        state_store.delete_prefix(run_prefix + "merge_queued.json")
+        raise
+    return True
+
+# Function to store the result of a work unit and queue the merge if every unit of the run has a result
+# Returns True if this call queued the merge
+def complete_work_unit(state_store, work_queue, unit, result):
+    run_prefix = unit["run_prefix"]
+    state_store.put(unit_result_name(run_prefix, unit["unit_index"]), result)
+    if len(state_store.list(run_prefix + "results/")) < unit["unit_count"]:
+        return False
+    return queue_fan_out_merge(state_store, work_queue, run_prefix)
+
+# Function to load the plan of a run and the results of its units in unit order
+# Returns None for the plan if the run has already finished
+def load_fan_out_run(state_store, run_prefix):
+    plan = state_store.get(run_prefix + "plan.json")
+    if plan is None:
+        return None, []
+    unit_results = [state_store.get(unit_result_name(run_prefix, unit["unit_index"])) for unit in plan["units"]]
+    return plan, unit_results
+
+# Function to remove the state of a run once it has been merged or superseded
+def finish_fan_out(state_store, run_prefix):
+    state_store.delete_prefix(run_prefix)
+
+# Function to process one fan-out queue message
+# process_unit(unit) returns the JSON serializable result of a unit, or None if the document changed and the run is obsolete
+# merge_units(plan, unit_results) assembles the document from the unit results
+def process_fan_out_message(message, state_store, work_queue, process_unit, merge_units):
+    if "fan_out_unit" in message:
+        unit = message["fan_out_unit"]
+        # A unit message delivered again after its run was merged or dropped must not index the unit or store a result
+        if state_store.get(unit["run_prefix"] + "plan.json") is None:
+            print("Run", unit["run_prefix"], "already finished.  Skipping unit", unit["unit_index"] + 1, "of", unit["unit_count"])
+            return
+        result = process_unit(unit)
+        if result is None:
+            print("Document", unit["key"], "changed since run", unit["run_prefix"], "was planned.  Dropping the run.")
+            finish_fan_out(state_store, unit["run_prefix"])
+            return
+        if complete_work_unit(state_store, work_queue, unit, result):
+            print("All", unit["unit_count"], "units of", unit["key"], "completed.  Merge queued.")
+
+    elif "fan_out_merge" in message:
+        run_prefix = message["fan_out_merge"]["run_prefix"]
+        plan, unit_results = load_fan_out_run(state_store, run_prefix)
+        if plan is None:
+            print("Run", run_prefix, "already finished")
+            return
+        merge_units(plan, unit_results)
+        finish_fan_out(state_store, run_prefix)
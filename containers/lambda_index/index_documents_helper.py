@@ -1,15 +1,160 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
+import bisect
 import boto3
+import datetime
+import hashlib
+import io
 import json
+import math
+import multiprocessing
 import os
-from io import BytesIO
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from pypdf import PdfReader
 import docx
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from opensearchpy import OpenSearch, RequestsHttpConnection, AWSV4SignerAuth, helpers
-from opensearchpy.helpers import bulk
+from opensearchpy.helpers import bulk, streaming_bulk
+from summary_cache_helper import summary_cache_key
+from embedding_helper import embed_texts_in_batches
+from metrics_helper import metrics_stage, increment_metric
+from bedrock_rate_limiter import bedrock_rate_limiter, invoke_model_with_rate_limit
+
+# Limits used to batch records into OpenSearch _bulk requests
+bulk_chunk_size = 500
+bulk_max_chunk_bytes = 5000000
+bulk_max_retries = 5
+bulk_initial_backoff = 1
+bulk_max_backoff = 30
+
+# Limits used for Bedrock summarization calls
+summary_max_concurrency = 4
+bedrock_max_retries = 6
+# Summarization is batch traffic, which yields Bedrock quota to interactive chat (see bedrock_rate_limiter.py)
+bedrock_priority = "batch"
+
+# Model, prompt and generation config used to summarize documents
+summary_model_id = 'amazon.titan-text-express-v1'
+summary_prompt_template = '''The following is a document:
+        {text_to_summarize}
+        Summarize the key points of the document in no more than 4 sentences.'''
+summary_text_gen_config = {
+    "maxTokenCount": 500,
+    "stopSequences": [], 
+    "temperature": 0,
+    "topP": 1
+}
+
+# Context window in tokens (input plus output) of the models used for summarization
+summary_model_context_tokens = {
+    'amazon.titan-text-express-v1': 8192
+}
+
+# Tokens are estimated from characters; the safety factor leaves headroom for text that tokenizes worse than the estimate
+summary_chars_per_token = 4
+summary_chunk_safety_factor = 0.85
+summary_chunk_overlap = 100
+# Sections the model rejects as too long are split in half and retried, down to sections of this many characters
+summary_min_split_section_size = 1000
+
+# Maximum number of document keys in one terms query, seconds between polls of asynchronous delete tasks,
+# and the default number of seconds to wait for the tasks before giving up on them
+delete_max_keys_per_query = 10000
+delete_task_poll_interval = 2
+delete_task_max_wait = 600
+
+# Id of the document holding the index generation, and retries when concurrent invocations increment it at the same time
+index_generation_document_id = "generation"
+index_generation_retry_on_conflict = 10
+
+# S3 error codes of a conditional read or head of an object that has changed (412) or been removed (404) since a given ETag
+changed_object_error_codes = ("412", "PreconditionFailed")
+removed_object_error_codes = ("404", "NoSuchKey", "NotFound")
+changed_or_removed_object_error_codes = changed_object_error_codes + removed_object_error_codes
+
+# Downloads larger than this many bytes are spooled to a temporary file instead of being held in memory
+spooled_file_max_memory = 8000000
+
+# Page ranges of a pdf are read with ranged GET requests of between ranged_read_min_bytes and ranged_read_max_bytes,
+# keeping up to ranged_read_cache_bytes of the ranges read in memory
+# Objects up to ranged_read_min_object_bytes, and objects whose ranged reads would download more than ranged_read_max_fraction
+# of the object or more than ranged_read_cache_bytes, are downloaded whole with one GET into a spooled temporary file instead
+ranged_read_min_bytes = 8192
+ranged_read_max_bytes = 4194304
+ranged_read_cache_bytes = 33554432
+ranged_read_min_object_bytes = 8388608
+ranged_read_max_fraction = 0.5
+# When an object is downloaded whole after ranged reads, the bytes not held yet are fetched with one ranged GET per gap
+# if there are at most this many gaps, or with one GET of the whole object otherwise
+ranged_read_max_gap_requests = 16
+
+# pdf text extraction is split across this many processes for files with at least pdf_parallel_min_pages pages
+pdf_extraction_workers = os.cpu_count() or 1
+pdf_parallel_min_pages = 50
+
+# Whether process pools work in this process, probed once and then reused for every pdf
+process_pool_lock = threading.Lock()
+process_pool_support = None
+
+# Maximum number of pooled HTTP connections kept open per client
+client_max_pool_connections = 20
+
+# Clients and stack outputs are created once per process and reused across warm Lambda invocations
+client_cache_lock = threading.Lock()
+boto3_client_cache = {}
+opensearch_client_cache = {}
+stack_outputs_cache = {}
+
+# Function to return a shared boto3 client for a service and region
+# boto3 clients are thread safe once created, but creating them is not, so creation is done under a lock
+def get_boto3_client(service_name, region_name = None):
+    cache_key = (service_name, region_name)
+    with client_cache_lock:
+        if cache_key not in boto3_client_cache:
+            boto3_client_cache[cache_key] = boto3.client(
+                service_name = service_name,
+                region_name = region_name,
+                config = Config(max_pool_connections = client_max_pool_connections)
+            )
+        return boto3_client_cache[cache_key]
+
+# Function to return a shared OpenSearch client for a host
+# The signer is given refreshable credentials, so they are only refreshed when they are about to expire
+def get_opensearch_client(region_name, opensearch_host):
+    cache_key = (region_name, opensearch_host)
+    with client_cache_lock:
+        if cache_key not in opensearch_client_cache:
+            credentials = boto3.Session().get_credentials()
+            auth = AWSV4SignerAuth(credentials, region_name)
+            opensearch_client_cache[cache_key] = OpenSearch(
+                hosts = [{'host': opensearch_host, 'port': 443}],
+                http_auth = auth,
+                use_ssl = True,
+                verify_certs = True,
+                connection_class = RequestsHttpConnection,
+                pool_maxsize = client_max_pool_connections
+            )
+        return opensearch_client_cache[cache_key]
+
+# Function to return the outputs of a CloudFormation stack as a dictionary, described once per process
+def get_stack_outputs(stack_name):
+    with client_cache_lock:
+        if stack_name in stack_outputs_cache:
+            return stack_outputs_cache[stack_name]
+    cf_client = get_boto3_client('cloudformation')
+    response = cf_client.describe_stacks(StackName=stack_name)
+    outputs = {output['OutputKey']: output['OutputValue'] for output in response["Stacks"][0]["Outputs"]}
+    with client_cache_lock:
+        stack_outputs_cache[stack_name] = outputs
+    return outputs
 
 def get_s3_key_list(bucket_name, s3_prefix, file_extensions, max_file_size):
     s3_resource = boto3.resource('s3')
@@ -21,192 +166,623 @@ def get_s3_key_list(bucket_name, s3_prefix, file_extensions, max_file_size):
             
     return key_list
 
-def read_md(bucket_name, key):
-    md_full_text = ""
-    
-    s3 = boto3.client("s3")
-    md_file = s3.get_object(Bucket=bucket_name, Key=key)[
-        "Body"
-    ].read()
-        
-    return md_file.decode('utf-8')
-
-def read_pdf(bucket_name, key):
-    s3 = boto3.client("s3")
-    pdf_file = s3.get_object(Bucket=bucket_name, Key=key)[
-        "Body"
-    ].read()
-    reader = PdfReader(BytesIO(pdf_file))
-    pages = reader.pages
-    return pages
-
-def read_docx(bucket_name, key):
-    docx_full_text = ""
-
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(bucket_name)
-    object = bucket.Object(key)
-
-    file_stream = BytesIO()
-    object.download_fileobj(file_stream)
-
-    document = docx.Document(file_stream)
-    for para in document.paragraphs:
-        docx_full_text += para.text + "\n"
-        
-    return docx_full_text
+# Function to list the objects in a bucket prefix with their size and ETag, filtered by extension and maximum size
+def get_s3_object_list(bucket_name, s3_prefix, file_extensions, max_file_size):
+    s3 = get_boto3_client("s3")
+    object_list = []
 
-#Function to split and summarize a text string using a Langchain text splitter object and Titan Text Express on Bedrock
-def split_and_summarize_text_until_sized(region_name, text, max_summary_length):
-    text_splitter_object = RecursiveCharacterTextSplitter(
-        chunk_size=15000,
-        chunk_overlap=100,
-        length_function=len,
-    )
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=s3_prefix):
+        for item in page.get("Contents", []):
+            if item["Key"].endswith(file_extensions) and int(item["Size"]) <= max_file_size:
+                object_list.append(
+                    {
+                        "key": item["Key"],
+                        "size": int(item["Size"]),
+                        "etag": item["ETag"]
+                    }
+                )
 
-    bedrock_runtime_object = boto3.client(
-        service_name='bedrock-runtime',
-        region_name=region_name, 
-    )
+    return object_list
 
-    llm_prompt_template = '''The following is a document:
-        {text_to_summarize}
-        Summarize the key points of the document in no more than 4 sentences.'''
-    
-    text_gen_config = {
-        "maxTokenCount": 500,
-        "stopSequences": [], 
-        "temperature": 0,
-        "topP": 1
+# Function to extract the text of each page of a pdf file object, one page at a time
+def iter_pdf_page_texts(reader, start_page = 0, end_page = None):
+    if end_page is None:
+        end_page = len(reader.pages)
+    for page_number in range(start_page, end_page):
+        yield reader.pages[page_number].extract_text()
+
+# Function run in a worker process to extract the text of a range of pages from a pdf file on disk
+def extract_pdf_page_range_texts(file_path, start_page, end_page):
+    reader = PdfReader(file_path)
+    return [reader.pages[page_number].extract_text() for page_number in range(start_page, end_page)]
+
+# Function to return True if process pools can be used, probed once per process
+# Lambda has no /dev/shm, so the semaphores a process pool needs cannot be created there and the probe is skipped
+def process_pool_available():
+    global process_pool_support
+    with process_pool_lock:
+        if process_pool_support is None:
+            if "AWS_LAMBDA_FUNCTION_NAME" in os.environ:
+                process_pool_support = False
+            else:
+                try:
+                    multiprocessing.get_context("spawn").Lock()
+                    process_pool_support = True
+                except (OSError, ImportError, NotImplementedError):
+                    process_pool_support = False
+        return process_pool_support
+
+# Function to extract the text of every page of a pdf, or of the pages from start_page up to end_page, in page order
+# Large files are split into page ranges extracted by a pool of worker processes, small files are extracted serially
+# Extraction is serial where process pools are not available, and falls back to serial if the pool or its temporary file fails
+def extract_pdf_page_texts(reader, file_object, max_workers = None, start_page = 0, end_page = None):
+    global process_pool_support
+    if max_workers is None:
+        max_workers = pdf_extraction_workers
+    if end_page is None:
+        end_page = len(reader.pages)
+    page_count = end_page - start_page
+    if max_workers <= 1 or page_count < pdf_parallel_min_pages or not process_pool_available():
+        return list(iter_pdf_page_texts(reader, start_page, end_page))
+
+    # Use a few page ranges per worker so uneven pages are balanced across the pool
+    range_size = max(1, -(-page_count // (max_workers * 4)))
+    page_ranges = [(start, min(start + range_size, end_page)) for start in range(start_page, end_page, range_size)]
+    try:
+        # Worker processes open the pdf by path, so write it to a named temporary file
+        with tempfile.NamedTemporaryFile(suffix = ".pdf") as named_file:
+            file_object.seek(0)
+            shutil.copyfileobj(file_object, named_file, 1024 * 1024)
+            named_file.flush()
+
+            # spawn avoids forking a process that may be running other threads
+            with ProcessPoolExecutor(max_workers = max_workers, mp_context = multiprocessing.get_context("spawn")) as executor:
+                futures = [
+                    executor.submit(extract_pdf_page_range_texts, named_file.name, start, end)
+                    for start, end in page_ranges
+                ]
+                page_texts = []
+                for future in futures:
+                    page_texts.extend(future.result())
+    except (NotImplementedError, BrokenProcessPool) as error:
+        # The pool cannot run in this process, so later pdfs are extracted serially without trying again
+        print("Process pool not available, extracting pdf text serially:", repr(error))
+        with process_pool_lock:
+            process_pool_support = False
+        return list(iter_pdf_page_texts(reader, start_page, end_page))
+    except OSError as error:
+        # e.g. /tmp is full; later pdfs may still fit, so the pool is not disabled
+        print("Parallel pdf extraction failed, extracting pdf text serially:", repr(error))
+        return list(iter_pdf_page_texts(reader, start_page, end_page))
+
+    return page_texts
+
+# File object reading an S3 object with ranged GET requests, for parsers that need random access to part of a large file
+# Scattered reads, such as a pdf parser checking the header of every object, fetch a small range around each read;
+# reads starting less than min_fetch_bytes after the end of the previous request fetch twice as much each time, so sequential
+# parsing takes few requests.  Ranges read are kept without overlap and joined when adjacent, and a request never fetches bytes already held
+# Small objects, and objects whose reads would download most of the object, are downloaded whole instead, keeping the ranges
+# already held where that takes few requests; a reader downloads at most 1 + max_fraction times the object, usually once
+# Every request is made with IfMatch, so a read fails with PreconditionFailed if the object changes while it is read
+class S3RangeReader(io.RawIOBase):
+    def __init__(self, s3_client, bucket_name, key, size, etag, min_fetch_bytes = ranged_read_min_bytes, max_fetch_bytes = ranged_read_max_bytes, cache_bytes = ranged_read_cache_bytes, min_object_bytes = ranged_read_min_object_bytes, max_fraction = ranged_read_max_fraction):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.key = key
+        self.size = size
+        self.etag = etag
+        self.min_fetch_bytes = min_fetch_bytes
+        self.max_fetch_bytes = max_fetch_bytes
+        self.cache_bytes = cache_bytes
+        self.min_object_bytes = min_object_bytes
+        self.max_fraction = max_fraction
+        # Ranges read, by start offset, and their start offsets in order
+        self.ranges = {}
+        self.range_starts = []
+        self.cached_bytes = 0
+        self.current_range = (0, b"")
+        self.next_fetch_bytes = min_fetch_bytes
+        self.last_fetch_end = None
+        # Spooled temporary file holding the whole object, once it has been downloaded whole
+        self.spool = None
+        self.position = 0
+        self.bytes_read = 0
+        self.request_count = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence = io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(0, offset)
+        return self.position
+
+    def close(self):
+        if self.spool is not None:
+            self.spool.close()
+        self.ranges = {}
+        self.range_starts = []
+        super().close()
+
+    # Download the whole object into a spooled temporary file, which serves every later read
+    def spool_object(self):
+        self.spool = tempfile.SpooledTemporaryFile(max_size = spooled_file_max_memory)
+        gaps = []
+        gap_start = 0
+        for start in self.range_starts:
+            if start > gap_start:
+                gaps.append((gap_start, start))
+            gap_start = start + len(self.ranges[start])
+        if gap_start < self.size:
+            gaps.append((gap_start, self.size))
+
+        if len(gaps) > ranged_read_max_gap_requests:
+            response = self.s3_client.get_object(Bucket = self.bucket_name, Key = self.key, IfMatch = self.etag)
+            shutil.copyfileobj(response["Body"], self.spool, 1024 * 1024)
+            self.request_count += 1
+            self.bytes_read += self.size
+        else:
+            for start in self.range_starts:
+                self.spool.seek(start)
+                self.spool.write(self.ranges[start])
+            for start, end in gaps:
+                response = self.s3_client.get_object(
+                    Bucket = self.bucket_name,
+                    Key = self.key,
+                    Range = "bytes=" + str(start) + "-" + str(end - 1),
+                    IfMatch = self.etag
+                )
+                self.spool.seek(start)
+                shutil.copyfileobj(response["Body"], self.spool, 1024 * 1024)
+                self.request_count += 1
+                self.bytes_read += end - start
+        self.ranges = {}
+        self.range_starts = []
+        self.cached_bytes = 0
+        self.current_range = (0, b"")
+
+    # Store a range, joining it with the ranges that end where it starts and start where it ends
+    def add_range(self, start, data):
+        index = bisect.bisect_left(self.range_starts, start)
+        if index < len(self.range_starts) and self.range_starts[index] == start + len(data):
+            data = data + self.ranges.pop(self.range_starts.pop(index))
+        if index > 0:
+            previous_start = self.range_starts[index - 1]
+            if previous_start + len(self.ranges[previous_start]) == start:
+                data = self.ranges.pop(previous_start) + data
+                self.range_starts.pop(index - 1)
+                start = previous_start
+        bisect.insort(self.range_starts, start)
+        self.ranges[start] = data
+        return start, data
+
+    # Return a held range containing the byte at position, or fetch one starting there that holds at least size bytes,
+    # ending at the next held range; returns None once the object has been downloaded whole instead
+    def get_range(self, position, size):
+        start, data = self.current_range
+        if start <= position < start + len(data):
+            return self.current_range
+        index = bisect.bisect_right(self.range_starts, position) - 1
+        if index >= 0:
+            start = self.range_starts[index]
+            data = self.ranges[start]
+            if position < start + len(data):
+                self.current_range = (start, data)
+                return self.current_range
+
+        if self.last_fetch_end is not None and self.last_fetch_end <= position < self.last_fetch_end + self.min_fetch_bytes:
+            self.next_fetch_bytes = min(self.next_fetch_bytes * 2, self.max_fetch_bytes)
+        else:
+            self.next_fetch_bytes = self.min_fetch_bytes
+        end = min(position + max(size, self.next_fetch_bytes), self.size)
+        if index + 1 < len(self.range_starts):
+            end = min(end, self.range_starts[index + 1])
+
+        if (
+                self.size <= self.min_object_bytes
+                or self.bytes_read + end - position > self.size * self.max_fraction
+                or self.cached_bytes + end - position > self.cache_bytes
+            ):
+            self.spool_object()
+            return None
+
+        response = self.s3_client.get_object(
+            Bucket = self.bucket_name,
+            Key = self.key,
+            Range = "bytes=" + str(position) + "-" + str(end - 1),
+            IfMatch = self.etag
+        )
+        data = response["Body"].read()
+        self.request_count += 1
+        self.bytes_read += len(data)
+        self.cached_bytes += len(data)
+        self.last_fetch_end = end
+        self.current_range = self.add_range(position, data)
+        return self.current_range
+
+    # Return size bytes from the current position, or fewer at the end of the object, reading across ranges as needed
+    def read(self, size = -1):
+        if size is None or size < 0:
+            size = self.size - self.position
+        parts = []
+        while size > 0 and self.position < self.size:
+            held_range = None
+            if self.spool is None:
+                held_range = self.get_range(self.position, size)
+            if held_range is None:
+                self.spool.seek(self.position)
+                part = self.spool.read(size)
+            else:
+                start, data = held_range
+                offset = self.position - start
+                part = data[offset:offset + size]
+            parts.append(part)
+            self.position += len(part)
+            size -= len(part)
+        return b"".join(parts)
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+# Function to read a range of pages of a pdf from S3 into a document dictionary like read_document
+# A large object is read with ranged requests, so a work unit downloads the parts of the file its pages use rather than the
+# whole file; small objects, or objects the unit would mostly read anyway, are downloaded whole (see S3RangeReader)
+def read_pdf_page_range(bucket_name, key, page_range, if_match = None, metrics = None):
+    s3 = get_boto3_client("s3")
+    with metrics_stage(metrics, "Download"):
+        if if_match is not None:
+            response = s3.head_object(Bucket=bucket_name, Key=key, IfMatch=if_match)
+        else:
+            response = s3.head_object(Bucket=bucket_name, Key=key)
+
+    parsed_document = {
+        "key": key,
+        "etag": response["ETag"],
+        "file_extension": ".pdf",
+        "page_count": None,
+        "page_texts": None,
+        "text": "",
+        # Default date is based on S3 last modified date
+        "document_date": response["LastModified"]
     }
-    
-    model_id = 'amazon.titan-text-express-v1'
+
+    with S3RangeReader(s3, bucket_name, key, response["ContentLength"], response["ETag"]) as range_reader:
+        with metrics_stage(metrics, "Parse"):
+            reader = PdfReader(range_reader)
+            parsed_document["page_count"] = len(reader.pages)
+            page_texts = extract_pdf_page_texts(reader, range_reader, start_page = page_range[0], end_page = min(page_range[1], len(reader.pages)))
+            parsed_document["page_texts"] = page_texts
+            parsed_document["text"] = "".join(page_texts)
+            increment_metric(metrics, "Pages", len(page_texts))
+            if reader.metadata is not None and reader.metadata.creation_date is not None:
+                parsed_document["document_date"] = reader.metadata.creation_date
+        increment_metric(metrics, "DocumentBytes", range_reader.bytes_read)
+    return parsed_document
+
+# Function to download a markdown, pdf or docx file from S3 once and parse it into a document dictionary
+# The dictionary holds the extracted text (and page texts for pdf) and the document date
+# It is passed to the summary, full text and date stages so each S3 object is only fetched and parsed once
+# pdf and docx files are streamed into a spooled temporary file, so large files are parsed from /tmp rather than memory
+# If page_range is given as (start_page, end_page), only the text of those pdf pages is extracted, reading the pdf with ranged
+# requests (see read_pdf_page_range); page_count is always the whole pdf
+# If if_match is given, the read fails with PreconditionFailed unless the object still has that ETag
+# If metrics from metrics_helper is given, the Download and Parse stages are timed and the bytes and pages are counted
+def read_document(bucket_name, key, page_range = None, if_match = None, metrics = None):
+    filename, file_extension = os.path.splitext(key)
+    if file_extension == ".pdf" and page_range is not None:
+        return read_pdf_page_range(bucket_name, key, page_range, if_match = if_match, metrics = metrics)
+
+    s3 = get_boto3_client("s3")
+    with metrics_stage(metrics, "Download"):
+        if if_match is not None:
+            response = s3.get_object(Bucket=bucket_name, Key=key, IfMatch=if_match)
+        else:
+            response = s3.get_object(Bucket=bucket_name, Key=key)
+    increment_metric(metrics, "DocumentBytes", response["ContentLength"])
+
+    parsed_document = {
+        "key": key,
+        "etag": response["ETag"],
+        "file_extension": file_extension,
+        "page_count": None,
+        "page_texts": None,
+        "text": "",
+        # Default date is based on S3 last modified date
+        "document_date": response["LastModified"]
+    }
+
+    # If a markdown file, the text is the decoded file
+    if file_extension == ".md":
+        with metrics_stage(metrics, "Download"):
+            body = response["Body"].read()
+        with metrics_stage(metrics, "Parse"):
+            parsed_document["text"] = body.decode('utf-8')
+        return parsed_document
+
+    with tempfile.SpooledTemporaryFile(max_size = spooled_file_max_memory) as file_object:
+        with metrics_stage(metrics, "Download"):
+            shutil.copyfileobj(response["Body"], file_object, 1024 * 1024)
+        file_object.seek(0)
+
+        with metrics_stage(metrics, "Parse"):
+            # If a pdf file, extract the text of each page once and use the pdf metadata creation date
+            if file_extension == ".pdf":
+                reader = PdfReader(file_object)
+                parsed_document["page_count"] = len(reader.pages)
+                page_texts = extract_pdf_page_texts(reader, file_object)
+                parsed_document["page_texts"] = page_texts
+                parsed_document["text"] = "".join(page_texts)
+                increment_metric(metrics, "Pages", len(page_texts))
+                if reader.metadata is not None and reader.metadata.creation_date is not None:
+                    parsed_document["document_date"] = reader.metadata.creation_date
+
+            # If a docx file, join the paragraphs and use the docx metadata creation date
+            elif file_extension == ".docx":
+                document = docx.Document(file_object)
+                parsed_document["text"] = "".join(para.text + "\n" for para in document.paragraphs)
+                if document.core_properties.created is not None:
+                    parsed_document["document_date"] = document.core_properties.created
+
+    return parsed_document
+
+# Function to get the parsed document for a key, reading it from S3 if it has not already been parsed
+def get_parsed_document(bucket_name, key, parsed_documents):
+    if parsed_documents is not None and key in parsed_documents:
+        return parsed_documents[key]
+    return read_document(bucket_name, key)
+
+# Function to return True if an error is Bedrock rejecting a request whose input has more tokens than the model accepts
+def is_input_too_long_error(error):
+    if not isinstance(error, ClientError) or error.response['Error']['Code'] != 'ValidationException':
+        return False
+    message = error.response['Error'].get('Message', '').lower()
+    return "too long" in message or "too many input tokens" in message or "max input tokens" in message
+
+# Function to estimate the number of tokens in a text string from its length
+def estimate_token_count(text):
+    return math.ceil(len(text) / summary_chars_per_token)
+
+# Function to return the largest section, in characters, that fits in the model input together with the prompt and the output
+def get_summary_chunk_size(model_id = summary_model_id, prompt_template = summary_prompt_template, text_gen_config = summary_text_gen_config):
+    prompt_overhead_tokens = estimate_token_count(prompt_template.replace("{text_to_summarize}", ""))
+    input_tokens = summary_model_context_tokens[model_id] - text_gen_config["maxTokenCount"] - prompt_overhead_tokens
+    return int(input_tokens * summary_chars_per_token * summary_chunk_safety_factor)
+
+# Function to plan the summarization rounds for a text of a given length
+# Each round packs the text into as few sections as fit in the model input, then sections are balanced to the same size
+# Every call is assumed to return maxTokenCount tokens, so the planned calls and rounds are an upper bound
+def plan_summarization(text_length, max_summary_length, chunk_size = None, text_gen_config = summary_text_gen_config):
+    if chunk_size is None:
+        chunk_size = get_summary_chunk_size(text_gen_config = text_gen_config)
+    max_summary_chars = text_gen_config["maxTokenCount"] * summary_chars_per_token
+
+    round_calls = []
+    while text_length > max_summary_length:
+        calls = math.ceil(text_length / chunk_size)
+        round_calls.append(calls)
+        next_text_length = calls * (max_summary_chars + 1)
+        # A single call always ends the reduction, as its output is as short as the model can make it
+        if calls == 1 or next_text_length >= text_length:
+            break
+        text_length = next_text_length
+
+    plan = {
+        'chunk_size': chunk_size,
+        'round_calls': round_calls,
+        'planned_rounds': len(round_calls),
+        'planned_calls': sum(round_calls)
+    }
+    return plan
+
+# Function to return the section size for one round: the text is split into the fewest sections that fit the chunk size,
+# with the sections balanced so the last one is not a small remainder that costs a call of its own
+def get_round_section_size(text_length, chunk_size):
+    calls = math.ceil(text_length / chunk_size)
+    balanced_size = math.ceil(text_length / calls) + summary_chunk_overlap
+    return min(chunk_size, balanced_size + balanced_size // 20)
+
+#Function to split and summarize a text string using a Langchain text splitter object and Titan Text Express on Bedrock
+# Sections are sized from the model context window by plan_summarization, and the planned number of calls is printed first
+# The sections of each round are summarized concurrently, up to max_concurrency Bedrock calls at a time
+# If a summary_cache from summary_cache_helper is given, sections already summarized in any round are not sent to the model again
+# Model calls go through the shared Bedrock rate limiter, whose metrics are printed once the text is summarized
+# If metrics is given, model calls, retries, cache hits and rounds are counted
+def split_and_summarize_text_until_sized(region_name, text, max_summary_length, max_concurrency = summary_max_concurrency, bedrock_runtime_object = None, summary_cache = None, metrics = None):
+    if bedrock_runtime_object is None:
+        bedrock_runtime_object = get_boto3_client('bedrock-runtime', region_name)
+
+    llm_prompt_template = summary_prompt_template
+    text_gen_config = summary_text_gen_config
+    model_id = summary_model_id
     accept = 'application/json' 
     content_type = 'application/json'
+
+    chunk_size = get_summary_chunk_size(model_id, llm_prompt_template, text_gen_config)
+    plan = plan_summarization(len(text), max_summary_length, chunk_size, text_gen_config)
+    if plan['planned_calls'] > 0:
+        print("Planned", plan['planned_calls'], "summarization calls in", plan['planned_rounds'], "rounds for", len(text), "characters")
+
+    # Summarize a single section with the model, returning None if the model declined to summarize it
+    def invoke_summary_model(section):
+        prompt_data = llm_prompt_template.replace("{text_to_summarize}", section)
+        body = json.dumps({
+        "inputText": prompt_data,
+        "textGenerationConfig": text_gen_config  
+        })
+        response = invoke_model_with_rate_limit(
+            bedrock_runtime_object,
+            bedrock_priority,
+            max_retries = bedrock_max_retries,
+            rate_limiter = bedrock_rate_limiter,
+            metrics_callback = lambda metric_name: increment_metric(metrics, metric_name),
+            body = body,
+            modelId = model_id,
+            accept = accept,
+            contentType = content_type
+        )
+        response_body = json.loads(response['body'].read())
+        if not "Sorry - this model is unable to" in response_body['results'][0]['outputText']:
+            return response_body['results'][0]['outputText']
+        print(response_body['results'][0]['outputText'])
+        return None
+
+    # Summarize a single section, returning None if the model declined to summarize it
+    # A declined section is cached as an empty string so it is not retried either
+    # Text that tokenizes worse than the chunk size estimate (tables, numbers, other languages) can exceed the model input;
+    # such a section is split in half at a space and the summaries of the halves are joined
+    def summarize_section(section):
+        if summary_cache is not None:
+            cache_key = summary_cache_key(model_id, llm_prompt_template, text_gen_config, section)
+            cached_summary = summary_cache.get(cache_key)
+            if cached_summary is not None:
+                increment_metric(metrics, "SummaryCacheHits")
+                return cached_summary if cached_summary != "" else None
+
+        try:
+            section_summary = invoke_summary_model(section)
+        except ClientError as error:
+            if not is_input_too_long_error(error) or len(section) < summary_min_split_section_size:
+                raise
+            print("Section of", len(section), "characters is too long for the model, summarizing it in two halves")
+            increment_metric(metrics, "SummarySectionSplits")
+            split_position = section.rfind(" ", 0, len(section) // 2)
+            if split_position <= 0:
+                split_position = len(section) // 2
+            half_summaries = [summarize_section(section[:split_position]), summarize_section(section[split_position:])]
+            section_summary = " ".join(half_summary for half_summary in half_summaries if half_summary is not None)
+            if section_summary == "":
+                section_summary = None
+
+        if summary_cache is not None:
+            summary_cache.put(cache_key, section_summary if section_summary is not None else "")
+        return section_summary
     
     while len(text) > max_summary_length:
         #print("A round of summarization. Text length is", len(text))
         new_text = ""
+        text_splitter_object = RecursiveCharacterTextSplitter(
+            chunk_size=get_round_section_size(len(text), chunk_size),
+            chunk_overlap=summary_chunk_overlap,
+            length_function=len,
+        )
         sections = text_splitter_object.split_text(text)
-        for section in sections:
-            prompt_data = llm_prompt_template.replace("{text_to_summarize}", section)
-            body = json.dumps({
-            "inputText": prompt_data,
-            "textGenerationConfig": text_gen_config  
-            })
-            response = bedrock_runtime_object.invoke_model(
-                body=body, 
-                modelId=model_id, 
-                accept=accept, 
-                contentType=content_type
-            )
-            response_body = json.loads(response['body'].read())
-            if not "Sorry - this model is unable to" in response_body['results'][0]['outputText']:
-                new_text += response_body['results'][0]['outputText'] + " "
-            else:
-                print(response_body['results'][0]['outputText'])
+        increment_metric(metrics, "SummaryRounds")
+        # Executor map returns the section summaries in the same order as the sections
+        with ThreadPoolExecutor(max_workers = max(1, min(max_concurrency, len(sections)))) as executor:
+            section_summaries = list(executor.map(summarize_section, sections))
+        for section_summary in section_summaries:
+            if section_summary is not None:
+                new_text += section_summary + " "
                 
         text = new_text
-    return text
 
-def summarize_md_document(region_name, bucket_name, key, max_summary_length):
-    text = read_md(
-        bucket_name = bucket_name,
-        key = key
-    )
-    summary_text = split_and_summarize_text_until_sized(
-        region_name = region_name,
-        text = text, 
-        max_summary_length = max_summary_length
-    )
-    return summary_text
-
-def summarize_pdf_document(region_name, bucket_name, key, max_summary_length):
-    pages = read_pdf(
-        bucket_name = bucket_name,
-        key = key
-    )
-    text = ""
-    for page in pages:
-        text += page.extract_text()
-    summary_text = split_and_summarize_text_until_sized(
-        region_name = region_name,
-        text = text,
-        max_summary_length = max_summary_length
-    )
-    return summary_text
-
-def summarize_docx_document(region_name, bucket_name, key, max_summary_length):
-    text = read_docx(
-        bucket_name = bucket_name,
-        key = key
-    )
-    summary_text = split_and_summarize_text_until_sized(
-        region_name = region_name,
-        text = text, 
-        max_summary_length = max_summary_length
-    )
-    return summary_text
-
-# Function to return a list of dictionaries as OpenSearch payload given an list of S3 keys, bucket name, region, and maxiumum summary length
-def summarize_documents(region_name, bucket_name, key_list, max_summary_length):
+    # Report the rate limiter's current rate, queue depth and throttles after the document's model calls
+    if plan['planned_calls'] > 0:
+        bedrock_rate_limiter.emit_metrics(bedrock_priority)
+    return text
 
+# Function to split the summary of a document into sections and return them as OpenSearch summary index records
+def summary_to_opensearch_payload(key, summary):
     text_splitter_object = RecursiveCharacterTextSplitter(
         chunk_size=512,
         chunk_overlap=0,
         length_function=len,
     )
-    
+
+    opensearch_payload = []
+    sections = text_splitter_object.split_text(summary)
+    for section_number, section in enumerate(sections):
+        clean_section = section.replace(" \n", " ").replace("\n", " ")
+        body = {
+           "document": key,
+            "section": section_number,
+            "text": clean_section
+        }
+        
+        opensearch_payload.append(body)
+    return opensearch_payload
+
+# Function to return a list of dictionaries as OpenSearch payload given an list of S3 keys, bucket name, region, and maxiumum summary length
+# parsed_documents is an optional dictionary of key to document returned by read_document, used to avoid downloading a key again
+# summary_cache is an optional cache from summary_cache_helper used to reuse section summaries of unchanged text
+def summarize_documents(region_name, bucket_name, key_list, max_summary_length, parsed_documents = None, summary_cache = None, metrics = None):
+
     opensearch_payload = []
 
     for key in key_list:
         filename, file_extension = os.path.splitext(key)
-        if file_extension == ".md":
-            summary = summarize_md_document(
-                region_name = region_name,
-                bucket_name = bucket_name,
-                key = key,
-                max_summary_length = max_summary_length
-            )
-        elif file_extension == ".pdf":
-            summary = summarize_pdf_document(
-                region_name = region_name,
-                bucket_name = bucket_name,
-                key = key,
-                max_summary_length = max_summary_length
-            )
-        elif file_extension == ".docx":
-            summary = summarize_docx_document(
+        if file_extension not in (".md", ".pdf", ".docx"):
+            print(key, "- not a supported file type.", "File extension:", file_extension)
+            continue
+
+        parsed_document = get_parsed_document(bucket_name, key, parsed_documents)
+        with metrics_stage(metrics, "Summarize"):
+            summary = split_and_summarize_text_until_sized(
                 region_name = region_name,
-                bucket_name = bucket_name,
-                key = key,
-                max_summary_length = max_summary_length
+                text = parsed_document["text"],
+                max_summary_length = max_summary_length,
+                summary_cache = summary_cache,
+                metrics = metrics
             )
 
-        sections = text_splitter_object.split_text(summary)
-        for section_number, section in enumerate(sections):
-            clean_section = section.replace(" \n", " ").replace("\n", " ")
-            body = {
-               "document": key,
-                "section": section_number,
-                "text": clean_section
-            }
-            
-            opensearch_payload.append(body)
+        opensearch_payload.extend(summary_to_opensearch_payload(key, summary))
+
+    # Keep the summary cache within its size limit
+    if summary_cache is not None:
+        evicted = summary_cache.evict()
+        if evicted > 0:
+            print("Evicted", evicted, "entries from the summary cache")
+
     return opensearch_payload
 
-# Function to write to opensearch summary index a list of dictionaries as OpenSearch payload
-def index_opensearch_summary_payload(region_name, opensearch_host, opensearch_payload, summary_index_name):
-    # Get OpenSearch client
-    credentials = boto3.Session().get_credentials()
-    auth = AWSV4SignerAuth(credentials, region_name)
-    opensearch_client = OpenSearch(
-        hosts = [{'host': opensearch_host, 'port': 443}],
-        http_auth = auth,
-        use_ssl = True,
-        verify_certs = True,
-        connection_class = RequestsHttpConnection
-    )
+# Function to add a text_embedding computed by an embedding backend to each index action in a generator of bulk actions
+# Actions are embedded one batch at a time as they are consumed, and written with pipeline _none to skip the ingest pipeline
+# Update and delete actions are passed through unchanged, and the order of the actions is kept
+def add_embeddings_to_actions(actions, embedding_backend, metrics = None):
+    batch = []
+    for action in actions:
+        batch.append(action)
+        if len(batch) >= embedding_backend.batch_size:
+            yield from embed_index_actions(batch, embedding_backend, metrics)
+            batch = []
+    yield from embed_index_actions(batch, embedding_backend, metrics)
+
+# Function to return a batch of bulk actions with the text of each index action embedded in one backend call
+def embed_index_actions(batch, embedding_backend, metrics = None):
+    index_actions = [action for action in batch if action.get("_op_type", "index") == "index"]
+    if len(index_actions) == 0:
+        return batch
+    with metrics_stage(metrics, "Embed"):
+        embeddings = iter(embed_texts_in_batches(embedding_backend, [action["_source"]["text"] for action in index_actions]))
+    increment_metric(metrics, "EmbeddedRecords", len(index_actions))
+    embedded_batch = []
+    for action in batch:
+        if action.get("_op_type", "index") == "index":
+            action = dict(action)
+            action["_source"] = dict(action["_source"], text_embedding = next(embeddings))
+            action["pipeline"] = "_none"
+        embedded_batch.append(action)
+    return embedded_batch
+
+# Function to write a list or generator of bulk actions (index, update or delete) to OpenSearch using _bulk requests
+# Requests are batched by record count and byte size, and records rejected with 429 are retried with backoff
+# If an embedding_backend from embedding_helper is given, index actions are embedded on the client instead of by the ingest pipeline
+# If metrics is given, the OpenSearchWrite stage is timed (including any Embed time) and written and failed records are counted
+def bulk_write_actions(opensearch_client, actions, embedding_backend = None, metrics = None):
+    if embedding_backend is not None:
+        actions = add_embeddings_to_actions(actions, embedding_backend, metrics)
 
     # Define the dictionary to summarize result
     result = {
@@ -214,17 +790,219 @@ def index_opensearch_summary_payload(region_name, opensearch_host, opensearch_pa
         'error_record_count': 0
         }
 
-    # Iterate through each record and index in OpenSearch
-    for item in opensearch_payload:
-        result['success_record_count'] += 1
-        response = opensearch_client.index(index=summary_index_name, body=item)
-        if response['result'] != "created":
-            print(response)
+    with metrics_stage(metrics, "OpenSearchWrite"):
+        for ok, item in streaming_bulk(
+            client = opensearch_client,
+            actions = actions,
+            chunk_size = bulk_chunk_size,
+            max_chunk_bytes = bulk_max_chunk_bytes,
+            max_retries = bulk_max_retries,
+            initial_backoff = bulk_initial_backoff,
+            max_backoff = bulk_max_backoff,
+            raise_on_error = False,
+            raise_on_exception = False
+        ):
+            if ok:
+                result['success_record_count'] += 1
+            else:
+                print(item)
+                result['error_record_count'] += 1
 
+    increment_metric(metrics, "RecordsWritten", result['success_record_count'])
+    increment_metric(metrics, "RecordErrors", result['error_record_count'])
     return result
 
-# Function to create opensearch insert dictionary from list of string from pages
-def pages_to_opensearch(pages, key, opensearch_client, full_text_index_name):
+# Function to write a list or generator of records to an OpenSearch index using _bulk requests
+# If record_ids is given, each record is written with the id at the same position, overwriting any existing record
+# If embedding_backend is given, the text_embedding of each record is computed in batches on the client
+def bulk_index_records(opensearch_client, index_name, records, record_ids = None, embedding_backend = None, metrics = None):
+    if record_ids is None:
+        actions = (
+            {
+                "_index": index_name,
+                "_source": record
+            }
+            for record in records
+        )
+    else:
+        actions = (
+            {
+                "_index": index_name,
+                "_id": record_id,
+                "_source": record
+            }
+            for record, record_id in zip(records, record_ids)
+        )
+    return bulk_write_actions(opensearch_client, actions, embedding_backend, metrics)
+
+# Function to return a deterministic OpenSearch record id from a document key and the parts identifying the record
+# The key is hashed so ids stay short and safe for any S3 key
+def document_record_id(key, *parts):
+    key_hash = hashlib.sha256(key.encode('utf-8')).hexdigest()[:40]
+    return "-".join([key_hash] + [str(part) for part in parts])
+
+# Function to return the records indexed for a document key, with the requested source fields
+# The key is matched exactly on the document.keyword field, as in the deletes by key
+def get_indexed_records(opensearch_client, index_name, key, source_fields):
+    return list(helpers.scan(
+        opensearch_client,
+        index = index_name,
+        query = {
+            "_source": ["document"] + source_fields,
+            "query": {"term": {"document.keyword": key}}
+        }
+    ))
+
+# Function to delete the records indexed for a document key whose ids are not in keep_ids
+# Used after overwriting a document's records by id to remove trailing sections from a longer previous version
+def delete_stale_records(opensearch_client, index_name, key, keep_ids, metrics = None):
+    actions = [
+        {
+            "_op_type": "delete",
+            "_index": index_name,
+            "_id": hit["_id"]
+        }
+        for hit in get_indexed_records(opensearch_client, index_name, key, [])
+        if hit["_id"] not in keep_ids
+    ]
+    bulk_result = bulk_write_actions(opensearch_client, actions, metrics = metrics)
+    return bulk_result['success_record_count']
+
+# Function to write to opensearch summary index a list of dictionaries as OpenSearch payload
+# key_list is the list of document keys that were summarized; the previous summary records of every key are replaced,
+# including keys with no records in the payload, e.g. a new version of a document that no longer has any text
+def index_opensearch_summary_payload(region_name, opensearch_host, opensearch_payload, summary_index_name, key_list, embedding_backend = None, metrics = None):
+    # Get OpenSearch client
+    opensearch_client = get_opensearch_client(region_name, opensearch_host)
+
+    # Index the records in OpenSearch in bulk with an id for each document key and section, overwriting previous versions
+    record_ids = [document_record_id(item["document"], item["section"]) for item in opensearch_payload]
+    result = bulk_index_records(
+        opensearch_client = opensearch_client,
+        index_name = summary_index_name,
+        records = opensearch_payload,
+        record_ids = record_ids,
+        embedding_backend = embedding_backend,
+        metrics = metrics
+    )
+
+    # Delete summary sections left over from longer previous versions of each document
+    result['deleted_record_count'] = 0
+    for key in set(key_list):
+        result['deleted_record_count'] += delete_stale_records(
+            opensearch_client = opensearch_client,
+            index_name = summary_index_name,
+            key = key,
+            keep_ids = set(record_ids),
+            metrics = metrics
+        )
+
+    return result
+
+# Function to compute the content hash stored on each full text section
+def section_content_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+# Function to write the full text sections of one document to the OpenSearch full text index
+# Each section has a deterministic id from the document key, its content hash and the occurrence of that content in the document,
+# so writing a document again overwrites its records and sections no longer in the document are deleted by id
+# In incremental mode, sections already indexed with the same id are kept (and updated if they moved or the document date changed),
+# so the ingest pipeline only embeds added or changed sections
+# If embedding_backend is given, the added or changed sections are embedded in batches on the client instead
+# If fan_out_unit_start is given, the records are one work unit of a large document: ids include the unit start,
+# sections of other units are not deleted, and section numbers are left for merge_document_work_units to set
+def write_full_text_sections(opensearch_client, full_text_index_name, key, records, incremental, embedding_backend = None, fan_out_unit_start = None, document_date = None, metrics = None):
+
+    # Store the document date on every section, so searches can decay scores by age without looking up the date index
+    if document_date is not None:
+        for record in records:
+            record["document_date"] = document_date.isoformat()
+
+    # Assign the id of each section
+    record_ids = []
+    content_hash_occurrences = {}
+    for record in records:
+        occurrence = content_hash_occurrences.get(record["content_hash"], 0)
+        content_hash_occurrences[record["content_hash"]] = occurrence + 1
+        if fan_out_unit_start is not None:
+            occurrence = str(fan_out_unit_start) + "." + str(occurrence)
+        record_ids.append(document_record_id(key, record["content_hash"], occurrence))
+
+    # Get the sections already indexed for this document
+    existing_sections = {
+        hit["_id"]: hit["_source"]
+        for hit in get_indexed_records(opensearch_client, full_text_index_name, key, ["page", "section", "document_date"])
+    }
+
+    actions = []
+    embedded_record_count = 0
+    unchanged_record_count = 0
+    deleted_record_count = 0
+
+    # Reuse an existing section with the same id in incremental mode, otherwise index the section
+    for record, record_id in zip(records, record_ids):
+        existing_section = existing_sections.pop(record_id, None)
+        if incremental and existing_section is not None:
+            same_section = fan_out_unit_start is not None or existing_section.get("section") == record["section"]
+            same_date = "document_date" not in record or existing_section.get("document_date") == record["document_date"]
+            if same_section and same_date and existing_section.get("page") == record.get("page"):
+                unchanged_record_count += 1
+                continue
+            # Partial updates do not run the ingest pipeline, so the existing embedding is kept
+            doc = {"section": record["section"]}
+            if "page" in record:
+                doc["page"] = record["page"]
+            if "document_date" in record:
+                doc["document_date"] = record["document_date"]
+            actions.append(
+                {
+                    "_op_type": "update",
+                    "_index": full_text_index_name,
+                    "_id": record_id,
+                    "doc": doc
+                }
+            )
+        else:
+            actions.append(
+                {
+                    "_op_type": "index",
+                    "_index": full_text_index_name,
+                    "_id": record_id,
+                    "_source": record
+                }
+            )
+            embedded_record_count += 1
+
+    # Delete the existing sections that are no longer in the document
+    # For a work unit, the sections of other units are still in existing_sections, so nothing is deleted
+    if fan_out_unit_start is not None:
+        existing_sections = {}
+    for existing_id in existing_sections:
+        actions.append(
+            {
+                "_op_type": "delete",
+                "_index": full_text_index_name,
+                "_id": existing_id
+            }
+        )
+        deleted_record_count += 1
+
+    bulk_result = bulk_write_actions(opensearch_client, actions, embedding_backend, metrics)
+    increment_metric(metrics, "Sections", len(records))
+    increment_metric(metrics, "UnchangedSections", unchanged_record_count)
+    result = {
+        'sections': len(records),
+        'success_record_count': bulk_result['success_record_count'],
+        'error_record_count': bulk_result['error_record_count'],
+        'embedded_record_count': embedded_record_count,
+        'unchanged_record_count': unchanged_record_count,
+        'deleted_record_count': deleted_record_count,
+        'record_ids': record_ids
+    }
+    return result
+
+# Function to split the text of each pdf page into full text index records, numbering pages from first_page_number
+def page_texts_to_records(page_texts, key, first_page_number = 1):
 
     # Create a langchain text splitter object for pdf
     pdf_text_splitter_object = RecursiveCharacterTextSplitter(
@@ -234,13 +1012,11 @@ def pages_to_opensearch(pages, key, opensearch_client, full_text_index_name):
     )
 
     section_number = 0
-    success_record_count = 0
-    error_record_count = 0
     filename, file_extension = os.path.splitext(key)
+    records = []
     
-    for page_number, page in enumerate(pages):
+    for page_number, page_text in enumerate(page_texts):
         #print("Processing page", page_number)
-        page_text = page.extract_text()
         sections = pdf_text_splitter_object.split_text(page_text)
         
         for section in sections:
@@ -248,32 +1024,40 @@ def pages_to_opensearch(pages, key, opensearch_client, full_text_index_name):
             clean_section = section.replace(" \n", " ").replace("\n", " ")
             body = {
                "document": key,
-                "page": page_number+1,
+                "page": page_number+first_page_number,
                 "section": section_number+1,
-                "text": clean_section
+                "text": clean_section,
+                "content_hash": section_content_hash(clean_section)
             }
-
-            response = opensearch_client.index(index=full_text_index_name, body=body)
-            if response['result'] == "created":
-                #print("Success indexing.")
-                success_record_count += 1
-            else:
-                #print(response)
-                error_record_count += 1
+            records.append(body)
             section_number += 1
-    result = {
-        'sections': section_number,
-        'success_record_count': success_record_count,
-        'error_record_count': error_record_count
-    }
+
+    return records
+
+# Function to create opensearch insert dictionary from list of string from pages
+def pages_to_opensearch(page_texts, key, opensearch_client, full_text_index_name, incremental = False, embedding_backend = None, document_date = None, metrics = None):
+
+    with metrics_stage(metrics, "Split"):
+        records = page_texts_to_records(page_texts, key)
+
+    # Write the sections to OpenSearch
+    result = write_full_text_sections(
+        opensearch_client = opensearch_client,
+        full_text_index_name = full_text_index_name,
+        key = key,
+        records = records,
+        incremental = incremental,
+        embedding_backend = embedding_backend,
+        document_date = document_date,
+        metrics = metrics
+    )
     return result
 
-# Function to create opensearch insert dictionary from single text string
-def text_string_to_opensearch(text, key, opensearch_client, full_text_index_name):
+# Function to split the text of a markdown or docx file into full text index records
+def text_string_to_records(text, key):
 
-    success_record_count = 0
-    error_record_count = 0
     filename, file_extension = os.path.splitext(key)
+    records = []
 
     if file_extension == ".md":
         # Create a langchain text splitter object for markdown and split into sections
@@ -310,35 +1094,40 @@ def text_string_to_opensearch(text, key, opensearch_client, full_text_index_name
             "document": key,
             "section": section_number + 1,
             "text": clean_section,
-            "section_heading": section_heading
+            "section_heading": section_heading,
+            "content_hash": section_content_hash(clean_section)
         }
+        records.append(body)
 
-        response = opensearch_client.index(index=full_text_index_name, body=body)
-        if response['result'] == "created":
-            success_record_count += 1
-        else:
-            error_record_count += 1
-    
-    result = {
-        'sections': section_number + 1,
-        'success_record_count': success_record_count,
-        'error_record_count': error_record_count
-    }
+    return records
+
+# Function to create opensearch insert dictionary from single text string
+def text_string_to_opensearch(text, key, opensearch_client, full_text_index_name, incremental = False, embedding_backend = None, document_date = None, metrics = None):
+
+    with metrics_stage(metrics, "Split"):
+        records = text_string_to_records(text, key)
+
+    # Write the sections to OpenSearch
+    result = write_full_text_sections(
+        opensearch_client = opensearch_client,
+        full_text_index_name = full_text_index_name,
+        key = key,
+        records = records,
+        incremental = incremental,
+        embedding_backend = embedding_backend,
+        document_date = document_date,
+        metrics = metrics
+    )
     return result
 
 # Function to split and index full text from list of S3 markdown, pdf or docx keys
-def split_and_index_full_text(region_name, opensearch_host, bucket_name, key_list, full_text_index_name):
+# If incremental is True, existing records for each key are not deleted first; only added or changed sections are written
+# If embedding_backend is given, sections are embedded in batches on the client and skip the ingest pipeline
+# Each section also stores the document date, which the retriever uses to decay scores by document age
+def split_and_index_full_text(region_name, opensearch_host, bucket_name, key_list, full_text_index_name, parsed_documents = None, incremental = False, embedding_backend = None, metrics = None):
 
     # Get OpenSearch client
-    credentials = boto3.Session().get_credentials()
-    auth = AWSV4SignerAuth(credentials, region_name)
-    opensearch_client = OpenSearch(
-        hosts = [{'host': opensearch_host, 'port': 443}],
-        http_auth = auth,
-        use_ssl = True,
-        verify_certs = True,
-        connection_class = RequestsHttpConnection
-    )
+    opensearch_client = get_opensearch_client(region_name, opensearch_host)
 
     result_summary = []
     
@@ -347,30 +1136,42 @@ def split_and_index_full_text(region_name, opensearch_host, bucket_name, key_lis
         filename, file_extension = os.path.splitext(key)
         # Read and split markdown file
         if file_extension == ".md":
-            text = read_md(bucket_name, key)
+            parsed_document = get_parsed_document(bucket_name, key, parsed_documents)
             result = text_string_to_opensearch(
-                text = text,
+                text = parsed_document["text"],
                 key = key,
                 opensearch_client = opensearch_client,
-                full_text_index_name = full_text_index_name
+                full_text_index_name = full_text_index_name,
+                incremental = incremental,
+                embedding_backend = embedding_backend,
+                document_date = parsed_document["document_date"],
+                metrics = metrics
             )
         # Read and split pdf file
         elif file_extension == ".pdf":
-            pages = read_pdf(bucket_name, key)
+            parsed_document = get_parsed_document(bucket_name, key, parsed_documents)
             result = pages_to_opensearch(
-                pages = pages,
+                page_texts = parsed_document["page_texts"],
                 key = key,
                 opensearch_client = opensearch_client,
-                full_text_index_name = full_text_index_name
+                full_text_index_name = full_text_index_name,
+                incremental = incremental,
+                embedding_backend = embedding_backend,
+                document_date = parsed_document["document_date"],
+                metrics = metrics
             )
         # Read and split docx file
         elif file_extension == ".docx":
-            text = read_docx(bucket_name, key)
+            parsed_document = get_parsed_document(bucket_name, key, parsed_documents)
             result = text_string_to_opensearch(
-                text = text,
+                text = parsed_document["text"],
                 key = key,
                 opensearch_client = opensearch_client,
-                full_text_index_name = full_text_index_name
+                full_text_index_name = full_text_index_name,
+                incremental = incremental,
+                embedding_backend = embedding_backend,
+                document_date = parsed_document["document_date"],
+                metrics = metrics
             )
         # Not a supported file type, skip
         else:
@@ -383,108 +1184,350 @@ def split_and_index_full_text(region_name, opensearch_host, bucket_name, key_lis
                 'key': key,
                 'sections': result['sections'],
                 'success_record_count': result['success_record_count'],
-                'error_record_count': result['error_record_count']
+                'error_record_count': result['error_record_count'],
+                'embedded_record_count': result['embedded_record_count'],
+                'unchanged_record_count': result['unchanged_record_count'],
+                'deleted_record_count': result['deleted_record_count']
             }
         )
     return result_summary
 
 # Function to determine a date for each file in a list and add it to the OpenSearch date index
-def index_date(region_name, opensearch_host, bucket_name, key_list, date_index_name):
+def index_date(region_name, opensearch_host, bucket_name, key_list, date_index_name, parsed_documents = None, metrics = None):
 
     documents_indexed = 0
-    success_record_count = 0
-    error_record_count = 0
+    records = []
     
     # Get OpenSearch client
-    credentials = boto3.Session().get_credentials()
-    auth = AWSV4SignerAuth(credentials, region_name)
-    opensearch_client = OpenSearch(
-        hosts = [{'host': opensearch_host, 'port': 443}],
-        http_auth = auth,
-        use_ssl = True,
-        verify_certs = True,
-        connection_class = RequestsHttpConnection
-    )
+    opensearch_client = get_opensearch_client(region_name, opensearch_host)
 
-    # Get S3 client and resource
-    s3_client = boto3.client("s3")
-    s3_resource = boto3.resource('s3')
-    
     # Iterate through the documents in the S3 key list, determine a date for each and write to OpenSearch index
-    # There are different ways of determining dates for files.  Update code below to suit your use case.
+    # There are different ways of determining dates for files.  Update read_document to suit your use case.
+    # For pdf and docx files the date is based on metadata creation date, for markdown files on S3 last modified date
     for count, key in enumerate(key_list):
         filename, file_extension = os.path.splitext(key)
 
-        # If a markdown file, date is based on S3 last modified date
-        if file_extension == ".md":
-            document_date = s3_client.get_object(Bucket=bucket_name, Key=key)[
-                "LastModified"]            
-
-        # If a pdf file, date is based on pdf metadata creation date
-        elif file_extension == ".pdf":
-            pdf_file = s3_client.get_object(Bucket=bucket_name, Key=key)[
-                    "Body"
-                ].read()
-            reader = PdfReader(BytesIO(pdf_file))
-            document_date = reader.metadata.creation_date
-            
-        # If a docx file, date is based on docx metadata creation date
-        elif file_extension == ".docx":
-            bucket = s3_resource.Bucket(bucket_name)
-            object = bucket.Object(key)
-            file_stream = BytesIO()
-            object.download_fileobj(file_stream)
-            document = docx.Document(file_stream)
-            prop = document.core_properties
-            document_date = prop.created
-
         # Not a supported file type, skip
-        else:
+        if file_extension not in (".md", ".pdf", ".docx"):
             print(key, "- not a supported file type.", "File extension:", file_extension)
             continue
 
+        parsed_document = get_parsed_document(bucket_name, key, parsed_documents)
+        document_date = parsed_document["document_date"]
+
         documents_indexed += 1
             
-        # Write date to OpenSearch date index
+        # Add date to the records for the OpenSearch date index
         item = {
             "document": key,
             "document_date": document_date
         }
-        response = opensearch_client.index(index=date_index_name, body=item)
-        
-        if response['result'] == "created":
-            success_record_count += 1
-        else:
-            error_record_count += 1
+        records.append(item)
+
+    # Write dates to OpenSearch date index in bulk with one id per document key, overwriting any previous date
+    record_ids = [document_record_id(item["document"]) for item in records]
+    bulk_result = bulk_index_records(
+        opensearch_client = opensearch_client,
+        index_name = date_index_name,
+        records = records,
+        record_ids = record_ids,
+        metrics = metrics
+    )
+
+    # Delete any other date records for these documents, e.g. written before records had deterministic ids
+    for item, record_id in zip(records, record_ids):
+        delete_stale_records(
+            opensearch_client = opensearch_client,
+            index_name = date_index_name,
+            key = item["document"],
+            keep_ids = {record_id},
+            metrics = metrics
+        )
     
     result_summary = {
         'documents': documents_indexed,
-        'success_record_count': success_record_count,
-        'error_record_count': error_record_count
+        'success_record_count': bulk_result['success_record_count'],
+        'error_record_count': bulk_result['error_record_count']
     }
     return result_summary
 
+# Function to delete all records for a list of document keys from each OpenSearch index in a list
+# Keys are matched exactly on the document.keyword field, with one terms query per index for up to 10,000 keys
+# If run_as_tasks is True, all deletes are started as OpenSearch tasks, then polled until they complete
+# A RuntimeError naming the unfinished task ids is raised if they have not completed within max_wait_seconds,
+# which a Lambda caller can set from context.get_remaining_time_in_millis()
+# If metrics is given, RecordsDeleted counts the records deleted
+def delete_index_recs_by_key_list_from_indices(region_name, opensearch_host, key_list, index_name_list, run_as_tasks = False, max_wait_seconds = delete_task_max_wait, metrics = None):
+
+    # Get OpenSearch client
+    opensearch_client = get_opensearch_client(region_name, opensearch_host)
+
+    results = []
+    task_ids = []
+
+    # Delete the records for each batch of keys from each index
+    for start in range(0, len(key_list), delete_max_keys_per_query):
+        query = {
+            'query': {'terms': {'document.keyword': key_list[start:start + delete_max_keys_per_query]}}
+        }
+        for index_name in index_name_list:
+            if run_as_tasks:
+                response = opensearch_client.delete_by_query(index=index_name, body=query, conflicts="proceed", wait_for_completion=False)
+                task_ids.append(response['task'])
+            else:
+                response = opensearch_client.delete_by_query(index=index_name, body=query, conflicts="proceed")
+                results.append(response)
+
+    # Poll the delete tasks until each one has completed, or until max_wait_seconds have passed
+    deadline = time.monotonic() + max_wait_seconds
+    while len(task_ids) > 0:
+        for task_id in list(task_ids):
+            task = opensearch_client.tasks.get(task_id=task_id)
+            if task.get('completed'):
+                results.append(task.get('response', task))
+                task_ids.remove(task_id)
+        if len(task_ids) == 0:
+            break
+        if time.monotonic() + delete_task_poll_interval > deadline:
+            # Unfinished tasks keep running in OpenSearch; deletes are idempotent, so the caller can retry the keys
+            increment_metric(metrics, "RecordsDeleted", sum(result.get('deleted', 0) for result in results))
+            raise RuntimeError("Delete tasks did not complete within " + str(max_wait_seconds) + " seconds: " + ", ".join(task_ids))
+        time.sleep(delete_task_poll_interval)
+
+    increment_metric(metrics, "RecordsDeleted", sum(result.get('deleted', 0) for result in results))
+    return results
+
 # Function to delete all records for a list of document keys from OpenSearch index
 def delete_index_recs_by_key_list(region_name, opensearch_host, key_list, index_name):
+    return delete_index_recs_by_key_list_from_indices(
+        region_name = region_name,
+        opensearch_host = opensearch_host,
+        key_list = key_list,
+        index_name_list = [index_name]
+    )
+
+# Function to increment the index generation, so the chat does not return answers cached before the indices changed
+# The generation is a counter in one document of its own index, created with generation 1 on the first increment
+def bump_index_generation(region_name, opensearch_host, generation_index_name):
 
     # Get OpenSearch client
-    credentials = boto3.Session().get_credentials()
-    auth = AWSV4SignerAuth(credentials, region_name)
-    opensearch_client = OpenSearch(
-        hosts = [{'host': opensearch_host, 'port': 443}],
-        http_auth = auth,
-        use_ssl = True,
-        verify_certs = True,
-        connection_class = RequestsHttpConnection
+    opensearch_client = get_opensearch_client(region_name, opensearch_host)
+
+    response = opensearch_client.update(
+        index = generation_index_name,
+        id = index_generation_document_id,
+        body = {
+            "script": {"source": "ctx._source.generation += 1", "lang": "painless"},
+            "upsert": {"generation": 1}
+        },
+        retry_on_conflict = index_generation_retry_on_conflict,
+        _source = True
     )
+    return response["get"]["_source"]["generation"]
 
-    results = []
-    
-    # Iterate through the documents in the key list, delete any records in OpenSearch index
-    for key in key_list:
-        response = opensearch_client.delete_by_query(index=index_name, body={
-          'query': {'match_phrase':{'document': key}}
-        })
-        results.append(response)
-        
-    return results
\ No newline at end of file
+# Function to return the state store prefix of the fan-out run for a version of a document
+def fan_out_run_prefix(key, etag):
+    return document_record_id(key, etag.strip('"')) + "/"
+
+# Function to plan the fan-out of a large document parsed by read_document into work units
+# pdf files are split into ranges of pages_per_unit pages; markdown and docx text into ranges of about chars_per_unit characters,
+# ending at a heading or line break so that full text sections are not cut at a unit boundary
+# read_document can be called with page_range = (0, 0) for a pdf, as planning only needs its page count
+def plan_document_fan_out(parsed_document, bucket_name, pages_per_unit, chars_per_unit):
+    ranges = []
+    if parsed_document["file_extension"] == ".pdf":
+        kind = "pages"
+        page_count = parsed_document["page_count"]
+        ranges = [(start, min(start + pages_per_unit, page_count)) for start in range(0, page_count, pages_per_unit)]
+    else:
+        kind = "characters"
+        text = parsed_document["text"]
+        separators = ["\n#", "\n"] if parsed_document["file_extension"] == ".md" else ["\n"]
+        start = 0
+        while start < len(text):
+            end = min(start + chars_per_unit, len(text))
+            if end < len(text):
+                for separator in separators:
+                    split_point = text.rfind(separator, start + chars_per_unit // 2, end)
+                    if split_point != -1:
+                        end = split_point + 1
+                        break
+            ranges.append((start, end))
+            start = end
+
+    plan = {
+        "bucket_name": bucket_name,
+        "key": parsed_document["key"],
+        "etag": parsed_document["etag"],
+        "file_extension": parsed_document["file_extension"],
+        "document_date": parsed_document["document_date"].isoformat(),
+        "units": [
+            {
+                "bucket_name": bucket_name,
+                "key": parsed_document["key"],
+                "etag": parsed_document["etag"],
+                "kind": kind,
+                "unit_index": unit_index,
+                "start": start,
+                "end": end
+            }
+            for unit_index, (start, end) in enumerate(ranges)
+        ]
+    }
+    return plan
+
+# Function to index one work unit of a large document: its full text sections and a summary of its text
+# pdf units read only their pages, with ranged requests; markdown and docx units are given the unit_text stored when the
+# run was planned, as {"text", "document_date"}, and only check the document is unchanged
+# Units queued without a stored text read and parse the whole document
+# Returns the unit summary and the ids of its full text sections in order for merge_document_work_units,
+# or None if the document has changed or been removed since the unit was planned
+def index_document_work_unit(region_name, opensearch_host, unit, full_text_index_name, max_summary_length, summary_cache = None, embedding_backend = None, unit_text = None, metrics = None):
+    key = unit["key"]
+    try:
+        if unit["kind"] == "pages":
+            parsed_document = read_document(unit["bucket_name"], key, page_range = (unit["start"], unit["end"]), if_match = unit["etag"], metrics = metrics)
+            text = parsed_document["text"]
+            document_date = parsed_document["document_date"]
+            with metrics_stage(metrics, "Split"):
+                records = page_texts_to_records(parsed_document["page_texts"], key, first_page_number = unit["start"] + 1)
+        else:
+            if unit_text is not None:
+                with metrics_stage(metrics, "Download"):
+                    get_boto3_client("s3").head_object(Bucket=unit["bucket_name"], Key=key, IfMatch=unit["etag"])
+                text = unit_text["text"]
+                document_date = datetime.datetime.fromisoformat(unit_text["document_date"])
+            else:
+                parsed_document = read_document(unit["bucket_name"], key, if_match = unit["etag"], metrics = metrics)
+                text = parsed_document["text"][unit["start"]:unit["end"]]
+                document_date = parsed_document["document_date"]
+            with metrics_stage(metrics, "Split"):
+                records = text_string_to_records(text, key)
+    except ClientError as error:
+        if error.response['Error']['Code'] in changed_or_removed_object_error_codes:
+            return None
+        raise
+
+    # Write the full text sections of the unit; section numbers are set for the whole document by the merge
+    opensearch_client = get_opensearch_client(region_name, opensearch_host)
+    full_text_result = write_full_text_sections(
+        opensearch_client = opensearch_client,
+        full_text_index_name = full_text_index_name,
+        key = key,
+        records = records,
+        incremental = True,
+        embedding_backend = embedding_backend,
+        fan_out_unit_start = unit["start"],
+        document_date = document_date,
+        metrics = metrics
+    )
+
+    # Summarize the text of the unit; the merge summarizes the unit summaries into the document summary
+    with metrics_stage(metrics, "Summarize"):
+        summary = split_and_summarize_text_until_sized(
+            region_name = region_name,
+            text = text,
+            max_summary_length = max_summary_length,
+            summary_cache = summary_cache,
+            metrics = metrics
+        )
+
+    result = {
+        'summary': summary,
+        'record_ids': full_text_result['record_ids'],
+        'sections': full_text_result['sections'],
+        'success_record_count': full_text_result['success_record_count'],
+        'error_record_count': full_text_result['error_record_count'],
+        'embedded_record_count': full_text_result['embedded_record_count'],
+        'unchanged_record_count': full_text_result['unchanged_record_count']
+    }
+    return result
+
+# Function to merge the work units of a large document once all have completed
+# Numbers the full text sections in document order, deletes sections of earlier versions,
+# summarizes the unit summaries into the document summary and indexes the document date
+# Returns None without writing if the document has changed or been removed since the run was planned
+def merge_document_work_units(region_name, opensearch_host, plan, unit_results, summary_index_name, full_text_index_name, date_index_name, max_summary_length, summary_cache = None, embedding_backend = None, metrics = None):
+    key = plan["key"]
+
+    try:
+        get_boto3_client("s3").head_object(Bucket=plan["bucket_name"], Key=key, IfMatch=plan["etag"])
+    except ClientError as error:
+        error_code = error.response['Error']['Code']
+        if error_code in changed_object_error_codes:
+            print(key, "has changed since the run was planned.  Skipping merge.")
+            return None
+        if error_code in removed_object_error_codes:
+            # Units may have written sections after the delete event was processed
+            print(key, "has been removed since the run was planned.  Deleting its records.")
+            delete_index_recs_by_key_list_from_indices(
+                region_name = region_name,
+                opensearch_host = opensearch_host,
+                key_list = [key],
+                index_name_list = [summary_index_name, full_text_index_name, date_index_name],
+                metrics = metrics
+            )
+            return None
+        raise
+
+    # Number the sections of all units in document order, and delete sections that are not in any unit
+    opensearch_client = get_opensearch_client(region_name, opensearch_host)
+    record_ids = [record_id for unit_result in unit_results for record_id in unit_result["record_ids"]]
+    section_numbers = {record_id: section_number + 1 for section_number, record_id in enumerate(record_ids)}
+    actions = []
+    for hit in get_indexed_records(opensearch_client, full_text_index_name, key, ["section"]):
+        if hit["_id"] not in section_numbers:
+            actions.append({"_op_type": "delete", "_index": full_text_index_name, "_id": hit["_id"]})
+        elif hit["_source"].get("section") != section_numbers[hit["_id"]]:
+            actions.append(
+                {
+                    "_op_type": "update",
+                    "_index": full_text_index_name,
+                    "_id": hit["_id"],
+                    "doc": {"section": section_numbers[hit["_id"]]}
+                }
+            )
+    full_text_result = bulk_write_actions(opensearch_client, actions, metrics = metrics)
+
+    # Summarize the unit summaries into the document summary
+    with metrics_stage(metrics, "Summarize"):
+        summary = split_and_summarize_text_until_sized(
+            region_name = region_name,
+            text = " ".join(unit_result["summary"] for unit_result in unit_results),
+            max_summary_length = max_summary_length,
+            summary_cache = summary_cache,
+            metrics = metrics
+        )
+    summary_result = index_opensearch_summary_payload(
+        region_name = region_name,
+        opensearch_host = opensearch_host,
+        opensearch_payload = summary_to_opensearch_payload(key, summary),
+        summary_index_name = summary_index_name,
+        key_list = [key],
+        embedding_backend = embedding_backend,
+        metrics = metrics
+    )
+
+    # The date was read from the document when the run was planned
+    date_result = index_date(
+        region_name = region_name,
+        opensearch_host = opensearch_host,
+        bucket_name = plan["bucket_name"],
+        key_list = [key],
+        date_index_name = date_index_name,
+        parsed_documents = {key: {"document_date": plan["document_date"]}},
+        metrics = metrics
+    )
+
+    if summary_cache is not None:
+        summary_cache.evict()
+
+    result = {
+        'key': key,
+        'units': len(unit_results),
+        'sections': len(record_ids),
+        'full_text_update_count': full_text_result['success_record_count'],
+        'summary_sections': summary_result['success_record_count'],
+        'date_records': date_result['success_record_count']
+    }
+    return result
@@ -0,0 +1,106 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# This file records per-stage timing and throughput metrics while a document is indexed
+# Metrics are printed as JSON log lines in CloudWatch Embedded Metric Format (EMF), so CloudWatch Logs turns them into metrics
+# One line is printed as each stage finishes, and a summary line with the totals for the document is printed at the end
+# Stages can run more than once for a document (e.g. one OpenSearch write per index) and their durations add up
+# Stages can also be nested: OpenSearchWrite includes the time of any client side Embed done while writing
+
+import contextlib
+import json
+import threading
+import time
+
+metrics_namespace = "ChatbotIndexing"
+
+# Function to return the CloudWatch unit of a metric from its name
+def metric_unit(metric_name):
+    if metric_name.endswith("Duration"):
+        return "Milliseconds"
+    if metric_name.endswith("Bytes"):
+        return "Bytes"
+    return "Count"
+
+# Function to print one EMF log line with metrics, dimensions and properties
+def emit_emf_record(namespace, dimensions, metrics, properties):
+    record = {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": namespace,
+                    "Dimensions": [list(dimensions.keys())],
+                    "Metrics": [{"Name": name, "Unit": metric_unit(name)} for name in metrics]
+                }
+            ]
+        }
+    }
+    record.update(properties)
+    record.update(dimensions)
+    record.update(metrics)
+    print(json.dumps(record, default = str))
+
+# Metrics recorder for the indexing of one document, shared by all threads working on the document
+class IndexingMetrics:
+    def __init__(self, document_key, operation = "Index", namespace = metrics_namespace):
+        self.document_key = document_key
+        self.operation = operation
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.start_time = time.perf_counter()
+        self.durations = {}
+        self.counts = {}
+
+    def set_operation(self, operation):
+        self.operation = operation
+
+    def increment(self, metric_name, value = 1):
+        with self.lock:
+            self.counts[metric_name] = self.counts.get(metric_name, 0) + value
+
+    def get_count(self, metric_name):
+        with self.lock:
+            return self.counts.get(metric_name, 0)
+
+    # Context manager timing one run of a stage and printing its duration when it finishes
+    @contextlib.contextmanager
+    def stage(self, stage_name):
+        stage_start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            duration_ms = (time.perf_counter() - stage_start) * 1000
+            with self.lock:
+                self.durations[stage_name] = self.durations.get(stage_name, 0) + duration_ms
+            emit_emf_record(
+                namespace = self.namespace,
+                dimensions = {"Stage": stage_name},
+                metrics = {"StageDuration": round(duration_ms, 1)},
+                properties = {"Document": self.document_key, "Operation": self.operation}
+            )
+
+    # Print the summary line for the document with the total duration, each stage duration and every count
+    def emit_summary(self, status):
+        with self.lock:
+            metrics = {"DocumentDuration": round((time.perf_counter() - self.start_time) * 1000, 1)}
+            for stage_name, duration_ms in self.durations.items():
+                metrics[stage_name + "Duration"] = round(duration_ms, 1)
+            metrics.update(self.counts)
+        emit_emf_record(
+            namespace = self.namespace,
+            dimensions = {"Operation": self.operation},
+            metrics = metrics,
+            properties = {"Document": self.document_key, "Status": status}
+        )
+        return metrics
+
+# Function to time a stage with an optional metrics recorder, doing nothing if metrics is None
+def metrics_stage(metrics, stage_name):
+    if metrics is None:
+        return contextlib.nullcontext()
+    return metrics.stage(stage_name)
+
+# Function to increment a count of an optional metrics recorder, doing nothing if metrics is None
+def increment_metric(metrics, metric_name, value = 1):
+    if metrics is not None:
+        metrics.increment(metric_name, value)
@@ -0,0 +1,137 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# This file contains a content-addressed cache for section summaries generated by the LLM
+# Entries are keyed by a hash of the model id, prompt template, generation config and section text
+# Two backends are provided: a local SQLite file and an S3 prefix
+# Both backends expose get, put and evict, and evict removes the oldest entries until the cache is under max_bytes
+
+import boto3
+import hashlib
+import json
+import random
+import sqlite3
+import threading
+import time
+
+# Prefix and size limit of the S3 cache in the data bucket, shared by the indexing Lambda and backfills
+# Every writer to the prefix evicts against the same limit, so they do not evict each other's entries
+s3_summary_cache_prefix = "chatbot-summary-cache/"
+s3_summary_cache_max_bytes = 500000000
+
+# Function to compute the cache key for a section summary
+def summary_cache_key(model_id, prompt_template, text_gen_config, section):
+    key_material = json.dumps(
+        [model_id, prompt_template, text_gen_config, section],
+        sort_keys = True,
+        ensure_ascii = False
+    )
+    return hashlib.sha256(key_material.encode('utf-8')).hexdigest()
+
+# Summary cache stored in a local SQLite file, e.g. under /tmp in Lambda or on a local disk for backfills
+class SqliteSummaryCache:
+    def __init__(self, path, max_bytes = 100000000):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread = False)
+        with self.lock:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS summaries "
+                "(cache_key TEXT PRIMARY KEY, summary TEXT, size INTEGER, last_used REAL)"
+            )
+            self.connection.commit()
+
+    def get(self, cache_key):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT summary FROM summaries WHERE cache_key = ?", (cache_key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self.connection.execute(
+                "UPDATE summaries SET last_used = ? WHERE cache_key = ?", (time.time(), cache_key)
+            )
+            self.connection.commit()
+        return row[0]
+
+    def put(self, cache_key, summary):
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO summaries (cache_key, summary, size, last_used) VALUES (?, ?, ?, ?)",
+                (cache_key, summary, len(summary.encode('utf-8')), time.time())
+            )
+            self.connection.commit()
+
+    # Remove least recently used entries until the total size is within max_bytes
+    def evict(self):
+        evicted = 0
+        with self.lock:
+            total_bytes = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM summaries").fetchone()[0]
+            if total_bytes <= self.max_bytes:
+                return evicted
+            rows = self.connection.execute("SELECT cache_key, size FROM summaries ORDER BY last_used").fetchall()
+            for cache_key, size in rows:
+                if total_bytes <= self.max_bytes:
+                    break
+                self.connection.execute("DELETE FROM summaries WHERE cache_key = ?", (cache_key,))
+                total_bytes -= size
+                evicted += 1
+            self.connection.commit()
+        return evicted
+
+# Summary cache stored as one object per entry under an S3 prefix, shared by all Lambda invocations
+# S3 does not record access time, so eviction removes the entries written longest ago
+# Eviction lists the whole prefix, so it only runs on a random evict_probability fraction of calls
+class S3SummaryCache:
+    def __init__(self, bucket_name, prefix = s3_summary_cache_prefix, max_bytes = s3_summary_cache_max_bytes, s3_client = None, evict_probability = 0.05):
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.evict_probability = evict_probability
+        self.s3_client = s3_client if s3_client is not None else boto3.client("s3")
+
+    def get(self, cache_key):
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=self.prefix + cache_key + ".json")
+        except self.s3_client.exceptions.NoSuchKey:
+            return None
+        return json.loads(response["Body"].read())["summary"]
+
+    def put(self, cache_key, summary):
+        self.s3_client.put_object(
+            Bucket = self.bucket_name,
+            Key = self.prefix + cache_key + ".json",
+            Body = json.dumps({"summary": summary}).encode('utf-8'),
+            ContentType = "application/json"
+        )
+
+    # Remove the oldest entries until the total size under the prefix is within max_bytes
+    def evict(self):
+        evicted = 0
+        if random.random() >= self.evict_probability:
+            return evicted
+        objects = []
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=self.prefix):
+            objects.extend(page.get("Contents", []))
+        total_bytes = sum(item["Size"] for item in objects)
+        if total_bytes <= self.max_bytes:
+            return evicted
+        delete_keys = []
+        for item in sorted(objects, key=lambda item: item["LastModified"]):
+            if total_bytes <= self.max_bytes:
+                break
+            delete_keys.append({"Key": item["Key"]})
+            total_bytes -= item["Size"]
+        # delete_objects accepts up to 1000 keys per request, and reports keys it could not delete in Errors instead of raising
+        # Eviction runs after the summaries are indexed, so failed deletes are logged rather than failing the document
+        delete_errors = []
+        for start in range(0, len(delete_keys), 1000):
+            response = self.s3_client.delete_objects(
+                Bucket = self.bucket_name,
+                Delete = {"Objects": delete_keys[start:start + 1000], "Quiet": True}
+            )
+            delete_errors.extend(response.get("Errors", []))
+        if len(delete_errors) > 0:
+            print("Failed to evict", len(delete_errors), "summary cache entries, e.g.", json.dumps(delete_errors[0]))
+        evicted = len(delete_keys) - len(delete_errors)
+        return evicted
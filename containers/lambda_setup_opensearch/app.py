@@ -145,11 +145,19 @@ def handler(event, context):
           "mappings": {
             "properties": {
               "document": {
-                "type": "text"
+                "type": "text",
+                "fields": {
+                  "keyword": {
+                    "type": "keyword"
+                  }
+                }
               },
               "section": {
                 "type": "integer"
               },
+              "document_date": {
+                "type": "date"
+              },
               "text_embedding": {
                 "type": "knn_vector",
                 "dimension": 768,
@@ -199,7 +207,12 @@ def handler(event, context):
               "mappings": {
                 "properties": {
                   "document": {
-                    "type": "text"
+                    "type": "text",
+                    "fields": {
+                      "keyword": {
+                        "type": "keyword"
+                      }
+                    }
                   },
                   "document_date": {
                     "type": "date"
@@ -215,6 +228,82 @@ def handler(event, context):
             print(response)
             print("Success creating index for date in OpenSearch.")
         
+        # Add the document keyword sub-field to indices created before it was part of the mappings
+        # Adding a sub-field does not index existing records into it, so records without it are then updated in place;
+        # until they are, deletes, section fetches and summary collapsing by document key do not see them
+        print("Adding document keyword sub-field to existing indices...")
+        try:
+            document_keyword_mapping = {
+              "properties": {
+                "document": {
+                  "type": "text",
+                  "fields": {
+                    "keyword": {
+                      "type": "keyword"
+                    }
+                  }
+                }
+              }
+            }
+            for index_name in [summary_index_name, full_text_index_name, date_index_name]:
+                response = opensearch_client.indices.put_mapping(index=index_name, body=document_keyword_mapping)
+                print(response)
+        except:
+            print("Error adding document keyword sub-field to indices in OpenSearch.")
+            success_flag = False
+        else:
+            print("Success adding document keyword sub-field to indices in OpenSearch.")
+
+        # Update records indexed before the keyword sub-field existed, so the sub-field is indexed for them
+        # The update skips the ingest pipeline, as the records already have their embeddings, and only touches records
+        # without the sub-field, so running it again is cheap; it runs as a task so large indices do not time out the setup
+        print("Indexing the document keyword sub-field of existing records...")
+        try:
+            missing_document_keyword_query = {
+              "query": {
+                "bool": {
+                  "must_not": {
+                    "exists": {
+                      "field": "document.keyword"
+                    }
+                  }
+                }
+              }
+            }
+            for index_name in [summary_index_name, full_text_index_name, date_index_name]:
+                response = opensearch_client.update_by_query(
+                    index=index_name,
+                    body=missing_document_keyword_query,
+                    conflicts="proceed",
+                    pipeline="_none",
+                    wait_for_completion=False
+                )
+                print("Started update of", index_name, "as task", response['task'])
+        except:
+            print("Error indexing the document keyword sub-field of existing records in OpenSearch.")
+            success_flag = False
+        else:
+            print("Success starting the update of existing records in OpenSearch.")
+
+        # Add the document date field to a full text index created before it was part of the mappings
+        # Sections indexed before this change get their date when the document is indexed again
+        print("Adding document date field to existing full text index...")
+        try:
+            document_date_mapping = {
+              "properties": {
+                "document_date": {
+                  "type": "date"
+                }
+              }
+            }
+            response = opensearch_client.indices.put_mapping(index=full_text_index_name, body=document_date_mapping)
+            print(response)
+        except:
+            print("Error adding document date field to full text index in OpenSearch.")
+            success_flag = False
+        else:
+            print("Success adding document date field to full text index in OpenSearch.")
+
         # Read back the lst of indices to confirm
         try:
             for index in opensearch_client.indices.get('*'):
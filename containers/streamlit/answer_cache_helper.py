@@ -0,0 +1,135 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# This file contains a cache of chat answers, so repeated questions are answered without retrieval or a Bedrock call
+# Entries are keyed by a hash of the normalized question, the model and generation settings, the RAG search settings
+# and the index generation, a counter the indexing Lambda increments whenever it changes the indices
+# Answers cached before the documents changed are therefore never returned, and age out with the TTL or size limit
+# Two local backends are provided: in memory, shared by the chat sessions of one Streamlit process, and a SQLite file,
+# shared by processes on the same host and kept across restarts
+# Both backends expose get and put, and keep at most max_entries entries for at most ttl_seconds
+# The in memory backend is TtlLruCache, which opensearch_retrieve_helper also uses to cache query embeddings
+
+import collections
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from opensearchpy import NotFoundError
+
+# Id of the document holding the index generation in the generation index
+index_generation_document_id = "generation"
+
+# Function to return the current index generation, or 0 if the indexing Lambda has not written one yet
+def get_index_generation(opensearch_client, generation_index_name):
+    try:
+        response = opensearch_client.get(index=generation_index_name, id=index_generation_document_id)
+    except NotFoundError:
+        return 0
+    return response["_source"]["generation"]
+
+# Function to normalize a question so questions differing only in whitespace share a cache entry
+# Case is kept, as the embedding of the question, and so the retrieved sections, can depend on it
+def normalize_question(question):
+    return " ".join(question.split())
+
+# Function to compute the cache key for an answer
+def answer_cache_key(question, model_settings, rag_settings, index_generation):
+    key_material = json.dumps(
+        [normalize_question(question), model_settings, rag_settings, index_generation],
+        sort_keys = True,
+        ensure_ascii = False,
+        default = str
+    )
+    return hashlib.sha256(key_material.encode('utf-8')).hexdigest()
+
+# Least recently used cache held in memory with a maximum number of entries and a time to live, shared by all threads
+class TtlLruCache:
+    def __init__(self, max_entries = 500, ttl_seconds = 86400):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+
+    def get(self, cache_key):
+        with self.lock:
+            entry = self.entries.get(cache_key)
+            if entry is None:
+                return None
+            created, value = entry
+            if time.monotonic() - created > self.ttl_seconds:
+                del self.entries[cache_key]
+                return None
+            self.entries.move_to_end(cache_key)
+            return value
+
+    def put(self, cache_key, value):
+        with self.lock:
+            self.entries[cache_key] = (time.monotonic(), value)
+            self.entries.move_to_end(cache_key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last = False)
+
+# Answer cache stored in a local SQLite file, evicting the least recently used entries when it is full
+class SqliteAnswerCache:
+    def __init__(self, path, max_entries = 500, ttl_seconds = 86400):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread = False)
+        with self.lock:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS answers "
+                "(cache_key TEXT PRIMARY KEY, answer TEXT, created REAL, last_used REAL)"
+            )
+            self.connection.commit()
+
+    def get(self, cache_key):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT answer, created FROM answers WHERE cache_key = ?", (cache_key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if time.time() - row[1] > self.ttl_seconds:
+                self.connection.execute("DELETE FROM answers WHERE cache_key = ?", (cache_key,))
+                self.connection.commit()
+                return None
+            self.connection.execute(
+                "UPDATE answers SET last_used = ? WHERE cache_key = ?", (time.time(), cache_key)
+            )
+            self.connection.commit()
+        return json.loads(row[0])
+
+    def put(self, cache_key, answer):
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO answers (cache_key, answer, created, last_used) VALUES (?, ?, ?, ?)",
+                (cache_key, json.dumps(answer), now, now)
+            )
+            # Remove expired entries, then the least recently used entries beyond max_entries
+            self.connection.execute("DELETE FROM answers WHERE created < ?", (now - self.ttl_seconds,))
+            self.connection.execute(
+                "DELETE FROM answers WHERE cache_key IN "
+                "(SELECT cache_key FROM answers ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            self.connection.commit()
+
+# Answer caches are created once per process, as Streamlit runs the chat script again on every interaction
+answer_cache_lock = threading.Lock()
+answer_caches = {}
+
+# Function to return the shared answer cache for a backend ("memory" or "sqlite") and its settings
+def get_answer_cache(backend, max_entries, ttl_seconds, path = None):
+    cache_settings = (backend, max_entries, ttl_seconds, path)
+    with answer_cache_lock:
+        if cache_settings not in answer_caches:
+            if backend == "sqlite":
+                answer_caches[cache_settings] = SqliteAnswerCache(path, max_entries, ttl_seconds)
+            elif backend == "memory":
+                answer_caches[cache_settings] = TtlLruCache(max_entries, ttl_seconds)
+            else:
+                raise ValueError("Unknown answer cache backend: " + backend)
+        return answer_caches[cache_settings]
@@ -4,10 +4,13 @@
 import boto3
 import streamlit as st
 import json
-from opensearch_retrieve_helper import opensearch_query
+from opensearch_retrieve_helper import opensearch_query, get_opensearch_client
 from get_opensearch_model_id import opensearch_model_id
 import logging
 from rag_search_config_helper import read_rag_search_config
+from bedrock_rate_limiter import bedrock_rate_limiter, invoke_model_with_rate_limit
+from answer_cache_helper import get_answer_cache, answer_cache_key, get_index_generation
+import os
 
 st.title("Question and Answer Bot")
 
@@ -21,7 +24,11 @@ region_name = session.region_name
 # Get the values from rag_search.cfg
 config_dict = read_rag_search_config()
 
+# Get the name of the index holding the index generation, which the indexing Lambda increments when the indices change
+generation_index_name = os.environ.get('OPENSEARCH_GENERATION_INDEX', 'chatbot-index-generation')
+
 # Create the Bedrock runtime
+# Model calls are made as interactive traffic through the rate limiter in bedrock_rate_limiter.py, shared by every chat session
 bedrock_runtime = boto3.client(
     service_name='bedrock-runtime',
     region_name=region_name, 
@@ -37,6 +44,84 @@ bedrock_guardrail_version = list(filter(lambda outputs: outputs['OutputKey'] ==
 stack_parameters = response["Stacks"][0]["Parameters"]
 bedrock_guardrails_block_message = list(filter(lambda stack_parameters: stack_parameters['ParameterKey'] == 'BedrockGuardrailsBlockMessage', stack_parameters))[0]["ParameterValue"]
 
+# Function to retrieve the RAG text for a question from OpenSearch and ask the Bedrock model to answer it
+def generate_answer(query_text):
+    # Query OpenSearch
+    rag_text, reference_text, retrieval_timings = opensearch_query(query_text, opensearch_model_id, config_dict)
+    print("Retrieval timings (ms):", retrieval_timings)
+
+    # Prepare the request to the model
+    prompt_template = (
+                "Context information is below.\n"
+                "---------------------\n"
+                "{context}\n"
+                "---------------------\n"
+                "You are an assistant for answering questions. "
+                "You are given the extracted parts long documents as context and a question. "
+                "Provide a conversational answer. "
+                "If you don't know the answer, just say 'I do not know.' Don't make up an answer.\n"
+                "Query: {query_text}\n"
+                "Answer: "
+                )
+    prompt_data = prompt_template.replace("{context}", rag_text).replace("{query_text}", query_text)
+
+    # If config file says use Titan Text Express, invoke that model
+    if config_dict['bedrock_model_id'] == "amazon.titan-text-express-v1":
+        text_gen_config = {
+            "maxTokenCount": config_dict['max_token_count'],
+            "stopSequences": [], 
+            "temperature": config_dict['temperature'],
+            "topP": config_dict['top_p']
+        }
+        accept = 'application/json' 
+        content_type = 'application/json'
+
+        body = json.dumps({
+            "inputText": prompt_data,
+            "textGenerationConfig": text_gen_config
+        })
+
+        bedrock_response = invoke_model_with_rate_limit(
+            bedrock_runtime,
+            "interactive",
+            modelId = config_dict['bedrock_model_id'], 
+            body = body, 
+            accept = accept, 
+            contentType = content_type,
+            guardrailIdentifier = bedrock_guardrail_id,
+            guardrailVersion = bedrock_guardrail_version
+        )
+        response_body = json.loads(bedrock_response.get('body').read())
+        output_text = response_body.get('results')[0].get('outputText')
+
+    # If config file says use a Llama 3 model, invoke that model
+    elif "meta.llama3" in config_dict['bedrock_model_id']:
+        native_request = {
+            "prompt": prompt_data,
+            "max_gen_len": config_dict['max_gen_len'],
+            "temperature": config_dict['temperature'],
+        }
+        request = json.dumps(native_request)
+        bedrock_response = invoke_model_with_rate_limit(
+            bedrock_runtime,
+            "interactive",
+            modelId = config_dict['bedrock_model_id'],
+            body = request,
+            guardrailIdentifier = bedrock_guardrail_id,
+            guardrailVersion = bedrock_guardrail_version
+        )
+        response_body = json.loads(bedrock_response["body"].read())
+        output_text = response_body["generation"]
+
+    # Invalid model specified in config file
+    else:
+        output_text = "Invalid model in config file."
+
+    # Report the interactive rate limiter's current rate, queue depth and throttles
+    bedrock_rate_limiter.emit_metrics("interactive")
+
+    return rag_text, reference_text, output_text
+
 # Build the user interface
 if "messages" not in st.session_state:
     st.session_state.messages = [
@@ -54,75 +139,42 @@ if query_text := st.chat_input("Enter your question"):
 
     with st.chat_message("assistant"):
         with st.spinner("Thinking..."):
-            # Query OpenSearch
-            rag_text, reference_text = opensearch_query(query_text, opensearch_model_id, config_dict)
-
-            # Prepare the request to the model
-            prompt_template = (
-                        "Context information is below.\n"
-                        "---------------------\n"
-                        "{context}\n"
-                        "---------------------\n"
-                        "You are an assistant for answering questions. "
-                        "You are given the extracted parts long documents as context and a question. "
-                        "Provide a conversational answer. "
-                        "If you don't know the answer, just say 'I do not know.' Don't make up an answer.\n"
-                        "Query: {query_text}\n"
-                        "Answer: "
-                        )
-            prompt_data = prompt_template.replace("{context}", rag_text).replace("{query_text}", query_text)
-
-            # If config file says use Titan Text Express, invoke that model
-            if config_dict['bedrock_model_id'] == "amazon.titan-text-express-v1":
-                text_gen_config = {
-                    "maxTokenCount": config_dict['max_token_count'],
-                    "stopSequences": [], 
-                    "temperature": config_dict['temperature'],
-                    "topP": config_dict['top_p']
-                }
-                accept = 'application/json' 
-                content_type = 'application/json'
-
-                body = json.dumps({
-                    "inputText": prompt_data,
-                    "textGenerationConfig": text_gen_config
-                })
-
-                bedrock_response = bedrock_runtime.invoke_model(
-                    modelId = config_dict['bedrock_model_id'], 
-                    body = body, 
-                    accept = accept, 
-                    contentType = content_type,
-                    guardrailIdentifier = bedrock_guardrail_id,
-                    guardrailVersion = bedrock_guardrail_version
+            # Look for an answer to the same question, asked with the same settings since the indices last changed
+            cached_answer = None
+            if config_dict['use_answer_cache']:
+                answer_cache = get_answer_cache(
+                    config_dict['answer_cache_backend'],
+                    config_dict['answer_cache_max_entries'],
+                    config_dict['answer_cache_ttl_seconds'],
+                    path = config_dict['answer_cache_path']
                 )
-                response_body = json.loads(bedrock_response.get('body').read())
-                output_text = response_body.get('results')[0].get('outputText')
-
-            # If config file says use a Llama 3 model, invoke that model
-            elif "meta.llama3" in config_dict['bedrock_model_id']:
-                native_request = {
-                    "prompt": prompt_data,
-                    "max_gen_len": config_dict['max_gen_len'],
-                    "temperature": config_dict['temperature'],
+                model_settings = {
+                    "opensearch_model_id": opensearch_model_id,
+                    "bedrock_guardrail_id": bedrock_guardrail_id,
+                    "bedrock_guardrail_version": bedrock_guardrail_version
                 }
-                request = json.dumps(native_request)
-                bedrock_response = bedrock_runtime.invoke_model(
-                    modelId = config_dict['bedrock_model_id'],
-                    body = request,
-                    guardrailIdentifier = bedrock_guardrail_id,
-                    guardrailVersion = bedrock_guardrail_version
-                )
-                response_body = json.loads(bedrock_response["body"].read())
-                output_text = response_body["generation"]
-
-            # Invalid model specified in config file
+                rag_settings = {name: value for name, value in config_dict.items() if "answer_cache" not in name}
+                index_generation = get_index_generation(get_opensearch_client(), generation_index_name)
+                cache_key = answer_cache_key(query_text, model_settings, rag_settings, index_generation)
+                cached_answer = answer_cache.get(cache_key)
+
+            if cached_answer is not None:
+                rag_text, reference_text, output_text = cached_answer["rag_text"], cached_answer["reference_text"], cached_answer["output_text"]
+                print("Answer cache hit for index generation", index_generation)
             else:
-                output_text = "Invalid model in config file."
+                rag_text, reference_text, output_text = generate_answer(query_text)
+                if config_dict['use_answer_cache'] and output_text != "Invalid model in config file.":
+                    answer_cache.put(cache_key, {
+                        "rag_text": rag_text,
+                        "reference_text": reference_text,
+                        "output_text": output_text
+                    })
 
             st.markdown(output_text)
 #            st.write(output_text)
+            if cached_answer is not None:
+                st.caption("Answered from cache")
             if output_text != bedrock_guardrails_block_message:
                 with st.expander("References"):
                     st.write(reference_text)
-    st.session_state.messages.append({"role": "assistant", "content": output_text})
\ No newline at end of file
+    st.session_state.messages.append({"role": "assistant", "content": output_text})
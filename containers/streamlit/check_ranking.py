@@ -0,0 +1,79 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+# This script checks the ranking of full text sections by rank_full_text_sections on a fixed set of search hits
+# It runs without a deployed stack, and exits with an error if the ranked sections are not in the expected order
+# Run it after changing the ranking, and update the expected orders below only when the change in ranking is intended
+#
+# Example:
+#   python check_ranking.py
+
+import sys
+from opensearch_retrieve_helper import rank_full_text_sections
+
+ranking_config = {
+    "full_text_hit_score_threshold": 0.5,
+    "summary_weight_over_full_text": 1.5
+}
+
+# Full text hits as returned by the full text search, highest score first
+full_text_hits = [
+    {"_score": 0.9, "_source": {"document": "b.pdf", "section": 2, "page": 1, "section_heading": None}},
+    {"_score": 0.8, "_source": {"document": "a.pdf", "section": 5, "page": 2, "section_heading": None}},
+    {"_score": 0.7, "_source": {"document": "d.md", "section": 2, "page": None, "section_heading": "Setup"}},
+    {"_score": 0.7, "_source": {"document": "c.md", "section": 1, "page": None, "section_heading": "Overview"}},
+    {"_score": 0.6, "_source": {"document": "a.pdf", "section": 6, "page": 2, "section_heading": None}},
+    {"_score": 0.3, "_source": {"document": "b.pdf", "section": 10, "page": 4, "section_heading": None}}
+]
+
+# Highest summary score of each summarized document; c.md and d.md have no summary score
+document_summary_scores = {
+    "a.pdf": 0.5,
+    "b.pdf": 0.4
+}
+
+# With summary scores, each hit is boosted by 1.5 times its document's summary score and expanded by one section each side:
+#   a.pdf 5 scores 1.55, b.pdf 2 scores 1.5, a.pdf 6 scores 1.35 and b.pdf 10 scores 0.9
+#   c.md and d.md are left out, and sections already listed from a higher scoring hit are not repeated
+expected_with_summary = [
+    ("a.pdf", 4), ("a.pdf", 5), ("a.pdf", 6),
+    ("b.pdf", 1), ("b.pdf", 2), ("b.pdf", 3),
+    ("a.pdf", 7),
+    ("b.pdf", 9), ("b.pdf", 10), ("b.pdf", 11)
+]
+
+# Without summary scores, hits keep their full text score and are expanded by three sections each side, from section 1
+# c.md and d.md tie and are ordered by document
+expected_without_summary = [
+    ("b.pdf", 1), ("b.pdf", 2), ("b.pdf", 3), ("b.pdf", 4), ("b.pdf", 5),
+    ("a.pdf", 2), ("a.pdf", 3), ("a.pdf", 4), ("a.pdf", 5), ("a.pdf", 6), ("a.pdf", 7), ("a.pdf", 8),
+    ("c.md", 1), ("c.md", 2), ("c.md", 3), ("c.md", 4),
+    ("d.md", 1), ("d.md", 2), ("d.md", 3), ("d.md", 4), ("d.md", 5),
+    ("a.pdf", 9),
+    ("b.pdf", 7), ("b.pdf", 8), ("b.pdf", 9), ("b.pdf", 10), ("b.pdf", 11), ("b.pdf", 12), ("b.pdf", 13)
+]
+
+# Function to rank the fixed hits and compare the order of the ranked sections with the expected order
+# Returns True if they match, printing the first difference if not
+def check_ranking(name, document_summary_scores, expected_sections):
+    ranked_sections = [
+        (section["document"], section["section"])
+        for section in rank_full_text_sections(full_text_hits, document_summary_scores, ranking_config)
+    ]
+    if ranked_sections == expected_sections:
+        print(name, "- ranked", len(ranked_sections), "sections in the expected order")
+        return True
+    for position in range(max(len(ranked_sections), len(expected_sections))):
+        ranked = ranked_sections[position] if position < len(ranked_sections) else None
+        expected = expected_sections[position] if position < len(expected_sections) else None
+        if ranked != expected:
+            print(name, "- position", position + 1, "is", ranked, "but expected", expected)
+            break
+    return False
+
+if __name__ == "__main__":
+    results = [
+        check_ranking("With summary scores", document_summary_scores, expected_with_summary),
+        check_ranking("Without summary scores", None, expected_without_summary)
+    ]
+    if not all(results):
+        sys.exit(1)
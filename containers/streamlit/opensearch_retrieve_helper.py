@@ -3,229 +3,335 @@
 # This file contains a helper function to make OpenSearch semantic queries
 # Uses searches on document summaries and full text
 # Returns RAG text, which is a string of all search results
-# Also returns references, which is a list of references to search hits
+# Also returns references, which is a list of references to search hits, and the time spent in each stage
 
 import boto3
 import os
 from opensearchpy import OpenSearch, RequestsHttpConnection, AWSV4SignerAuth, helpers
 import json
+import threading
+import time
 from urllib.parse import quote
-from datetime import datetime
+from answer_cache_helper import TtlLruCache, normalize_question
 
+# Query embeddings are cached per process, so repeated questions from any user are not embedded again
+query_embedding_cache_max_entries = 1000
+query_embedding_cache_ttl_seconds = 3600
+
+# Sections are fetched with room for this many records per section, as a section can have more than one record while a
+# document is being re-indexed, e.g. during the merge of a fan-out run or after an interrupted incremental run
+section_fetch_records_per_section = 2
+
+query_embedding_cache = TtlLruCache(query_embedding_cache_max_entries, query_embedding_cache_ttl_seconds)
+
+# Function to return the embedding of a query from the cache, or from the ML Commons predict API of the model
+# The query text is normalized like questions in the answer cache, and the normalized text is embedded so cached vectors match
+# Returns the embedding and whether it came from the cache
+def get_query_embedding(opensearch_client, model_id, query_text):
+    normalized_query_text = normalize_question(query_text)
+    cache_key = (model_id, normalized_query_text)
+    embedding = query_embedding_cache.get(cache_key)
+    if embedding is not None:
+        return embedding, True
+    response = opensearch_client.transport.perform_request(
+        "POST",
+        "/_plugins/_ml/_predict/text_embedding/" + model_id,
+        body = {
+            "text_docs": [normalized_query_text],
+            "target_response": ["sentence_embedding"]
+        }
+    )
+    embedding = response["inference_results"][0]["output"][0]["data"]
+    query_embedding_cache.put(cache_key, embedding)
+    return embedding, False
+
+# Number of neighbouring sections included before and after each full text hit, with and without summary scores
+summary_section_expansion = 1
+full_text_section_expansion = 3
+
+# Function to return the highest summary score of each document within the summary hit score threshold,
+# and the threshold score, which is 0 when no document has been summarized yet
+def get_document_summary_scores(summary_response, config_dict):
+    if summary_response['hits']['max_score'] is None:
+        return {}, 0
+    min_summary_hit_score = config_dict['summary_hit_score_threshold'] * summary_response['hits']['max_score']
+
+    document_summary_scores = {}
+    for hit in summary_response['hits']['hits']:
+        # Add this document if it's within the hit score threshold
+        if hit['_score'] >= min_summary_hit_score:
+            document = hit['_source']['document']
+            document_summary_scores[document] = max(hit['_score'], document_summary_scores.get(document, float('-inf')))
+    return document_summary_scores, min_summary_hit_score
+
+# Function to rank full text hits and their neighbouring sections, highest score first, with each section listed once
+# If document_summary_scores is given, a hit's score is boosted by the weighted summary score of its document,
+# and hits of documents without a summary score are left out
+# Hits below the full text hit score threshold are left out
+def rank_full_text_sections(full_text_hits, document_summary_scores, config_dict):
+    if len(full_text_hits) == 0:
+        return []
+    min_hit_score = config_dict['full_text_hit_score_threshold'] * min(hit['_score'] for hit in full_text_hits)
+    section_expansion = summary_section_expansion if document_summary_scores is not None else full_text_section_expansion
+
+    # Make a list of full text hits and their neighbouring sections with their scores
+    hit_sections = []
+    for hit in full_text_hits:
+        document = hit["_source"]["document"]
+        if hit["_score"] < min_hit_score:
+            continue
+        if document_summary_scores is not None:
+            if document not in document_summary_scores:
+                continue
+            document_score = hit["_score"] + config_dict['summary_weight_over_full_text'] * document_summary_scores[document]
+        else:
+            document_score = hit["_score"]
+        for i in range(hit["_source"]["section"] - section_expansion, hit["_source"]["section"] + section_expansion + 1):
+            if i > 0:
+                hit_sections.append(
+                    {
+                        "document": document,
+                        "page": hit["_source"].get("page"),
+                        "section_heading": hit["_source"].get("section_heading"),
+                        "section": i,
+                        "document_score": document_score
+                    }
+                )
+
+    # Sort the hit list by score high to low
+    sorted_section_list_with_scores = sorted(hit_sections, key=lambda x: (x['document_score'] * -1, x['document'], x['page'], x['section_heading'], x['section']))
+    # Eliminate duplicates in the sorted hit list, keeping the highest scoring entry for each section
+    deduplicated_section_list = []
+    seen_sections = set()
+    for i in sorted_section_list_with_scores:
+        if (i['document'], i['section']) not in seen_sections:
+            seen_sections.add((i['document'], i['section']))
+            deduplicated_section_list.append(i)
+    return deduplicated_section_list
+
+# Function to return the milliseconds since a time.perf_counter() start time
+def elapsed_ms(start_time):
+    return round((time.perf_counter() - start_time) * 1000, 1)
+
+# OpenSearch clients are created once per process and host, and shared by the retrieval and the answer cache
+opensearch_client_lock = threading.Lock()
+opensearch_clients = {}
+
+# Function to return the OpenSearch client for the host in the OPENSEARCH_SERVICE_ENDPOINT environment variable
+def get_opensearch_client():
+    host = os.environ['OPENSEARCH_SERVICE_ENDPOINT']
+    with opensearch_client_lock:
+        if host not in opensearch_clients:
+            # Get the current region
+            session = boto3.session.Session()
+            region_name = session.region_name
+
+            credentials = boto3.Session().get_credentials()
+            auth = AWSV4SignerAuth(credentials, region_name)
+
+            opensearch_clients[host] = OpenSearch(
+                hosts = [{'host': host, 'port': 443}],
+                http_auth = auth,
+                use_ssl = True,
+                verify_certs = True,
+                connection_class = RequestsHttpConnection
+            )
+        return opensearch_clients[host]
+
+# Function to fetch the text of a list of (document, section) pairs with one search, matching each document's sections exactly
+# The text of the first record of each pair is added to section_texts, so extra records of a section are ignored
+# Returns True if the search returned as many hits as it asked for, so some sections may have been cut off
+def fetch_section_texts(opensearch_client, index_name, sections, section_texts, records_per_section = section_fetch_records_per_section):
+    sections_by_document = {}
+    for document, section in sections:
+        sections_by_document.setdefault(document, []).append(section)
+    query = {
+        "size": len(sections) * records_per_section,
+        "_source": ["document", "section", "text"],
+        "query": {
+            "bool": {
+                "should": [
+                    {
+                        "bool": {
+                            "filter": [
+                                {"term": {"document.keyword": document}},
+                                {"terms": {"section": document_sections}}
+                            ]
+                        }
+                    }
+                    for document, document_sections in sections_by_document.items()
+                ],
+                "minimum_should_match": 1
+            }
+        }
+    }
+    section_response = opensearch_client.search(
+        body = query,
+        index = index_name
+    )
+    for hit in section_response["hits"]["hits"]:
+        section_texts.setdefault((hit["_source"]["document"], hit["_source"]["section"]), hit["_source"]["text"])
+    return len(section_response["hits"]["hits"]) >= query["size"]
+
+# Function to search OpenSearch for the sections most relevant to a query
+# Returns the RAG text, the reference text and the milliseconds spent in each stage of the retrieval,
+# with whether the query embedding came from the cache
 def opensearch_query(query_text, opensearch_model_id, config_dict):
-    # Get the OpenSearch host, index name and model ID from envionment variables
+    query_start = time.perf_counter()
+    timings = {}
+
+    # Get the OpenSearch index names from envionment variables
     summary_index_name = os.environ['OPENSEARCH_SUMMARY_INDEX']
     full_text_index_name = os.environ['OPENSEARCH_FULL_TEXT_INDEX']
-    date_index_name = os.environ['OPENSEARCH_DATE_INDEX']
-    host = os.environ['OPENSEARCH_SERVICE_ENDPOINT']
-
-    # Get the current region
-    session = boto3.session.Session()
-    region_name = session.region_name
 
     # Get OpenSearch client
-    credentials = boto3.Session().get_credentials()
-    auth = AWSV4SignerAuth(credentials, region_name)
-
-    opensearch_client = OpenSearch(
-        hosts = [{'host': host, 'port': 443}],
-        http_auth = auth,
-        use_ssl = True,
-        verify_certs = True,
-        connection_class = RequestsHttpConnection
-    )
+    opensearch_client = get_opensearch_client()
+    timings["client_ms"] = elapsed_ms(query_start)
+
+    # Embed the query once for both searches, instead of each neural query running the model on the cluster
+    embedding_start = time.perf_counter()
+    query_embedding, timings["embedding_cache_hit"] = get_query_embedding(opensearch_client, opensearch_model_id, query_text)
+    timings["embedding_ms"] = elapsed_ms(embedding_start)
 
-    # Do a semantic search for the search term on the summary index
+    # Semantic search for the search term on the summary index
     if config_dict['use_summary']:
-        query={
-            "_source": {
-                "excludes": [ "text_embedding" ]
-            },
+        # Hits are collapsed on the document key, so OpenSearch returns only the best summary section of each document
+        summary_query={
+            "_source": ["document"],
             "size": 30,
             "query": {
-                "neural": {
+                "knn": {
                     "text_embedding": {
-                    "query_text": query_text,
-                    "model_id": opensearch_model_id,
+                    "vector": query_embedding,
                     "k": 30
                     }
                 }
+            },
+            "collapse": {
+                "field": "document.keyword"
             }
         }
 
-        summary_response = opensearch_client.search(index=summary_index_name, 
-                               body=query,
-                               stored_fields=["text"])
-
-        print("Got",len(summary_response["hits"]["hits"]),"hits.")
-    else:
-        summary_response = []
-
-    # Build a list of keys of documents with the highest summary score for each document
-    if config_dict['use_summary']:
-        doc_list = []
-        min_summary_hit_score = config_dict['summary_hit_score_threshold'] * summary_response['hits']['max_score']
-
-        for i in summary_response['hits']['hits']:
-            # Add this document if it's within the hit score threshold
-            if i['_score'] >= min_summary_hit_score:
-                doc_list.append({i['_source']['document']: i['_score']})
-
-        all_keys = set().union(*doc_list)
-        document_summary_high_scores = {key: max(dic.get(key, float('-inf')) for dic in doc_list) for key in all_keys}
-
-    # Do a semantic search for the search term on the full text index
-    query={
-        "_source": {
-            "excludes": [ "text_embedding" ]
-        },
-        "size": 20,
-        "query": {
-            "neural": {
-                "text_embedding": {
-                "query_text": query_text,
-                "model_id": opensearch_model_id,
-                "k": 30
-                }
+    # Semantic search for the search term on the full text index
+    full_text_query = {
+        "knn": {
+            "text_embedding": {
+            "vector": query_embedding,
+            "k": 30
             }
         }
     }
 
-    full_text_response = opensearch_client.search(index=full_text_index_name, 
-                           body=query,
-                           stored_fields=["text"])
-
-    # If use_date parameter is true, get the date of each document with a search hit and calculate its age in days
-    document_age_list = []
+    # If use_date parameter is true, scale the score of each full text hit down in proportion to the age of its document,
+    # reaching zero at years_until_no_value, using the document date stored on each section
+    # Sections without a document date, indexed before the date was stored on sections, are not scaled
     if config_dict['use_date']:
-        for full_text_hit in full_text_response["hits"]["hits"]:
-            if not any(d['document'] == full_text_hit["_source"]["document"] for d in document_age_list):
-                query={
-                    "query": {
-                        "match_phrase": {
-                            "document": full_text_hit["_source"]["document"]
-                        }
-                    }
-                }
-                date_response = opensearch_client.search(index=date_index_name, body=query)
-                document_date = date_response["hits"]["hits"][0]["_source"]["document_date"][:10]
-                days_old = (datetime.now() - datetime.strptime(document_date, "%Y-%m-%d")).days
-                document_age_list.append(
+        full_text_query = {
+            "function_score": {
+                "query": full_text_query,
+                "functions": [
                     {
-                        "document": full_text_hit["_source"]["document"],
-                        "date": document_date,
-                        "days_old": days_old
+                        "linear": {
+                            "document_date": {
+                                "origin": "now",
+                                "scale": str(max(1, round(365 * 24 * config_dict['years_until_no_value']))) + "h",
+                                "decay": 0.001
+                            }
+                        }
                     }
-                )
-    
-    # If use_date parameter is true, deduct points on scores of each full text hit based on the age of the document and parameter points to deduct per day old 
-    if config_dict['use_date']:
-        for hit in full_text_response["hits"]["hits"]:
-            days_old = list(filter(lambda doc: doc['document'] == hit['_source']['document'], document_age_list))[0]["days_old"]
-            points_to_deduct = config_dict['points_deduct_per_day_old'] * days_old
-            if hit["_score"] > points_to_deduct:
-                hit["_score"] = hit["_score"] - (config_dict['points_deduct_per_day_old'] * days_old)
-            else:
-                hit["_score"] = 0
-    
-    # Make a list of full text hits with associated summary document scores
-    hit_sections = []
-    min_hit_score = config_dict['full_text_hit_score_threshold'] * min(full_text_response["hits"]["hits"], key=lambda x:x['_score'])["_score"]
+                ],
+                "boost_mode": "multiply"
+            }
+        }
 
+    # Only the fields used for ranking are returned; the text of the ranked sections is fetched afterwards
+    full_text_search_query={
+        "_source": ["document", "section", "page", "section_heading"],
+        "size": 20,
+        "query": full_text_query
+    }
+
+    # Run the summary and full text searches concurrently in one _msearch request
+    search_start = time.perf_counter()
+    msearch_body = [{"index": full_text_index_name}, full_text_search_query]
     if config_dict['use_summary']:
-        for hit in full_text_response["hits"]["hits"]:
-            for i in range(hit["_source"]["section"] - 1, hit["_source"]["section"] + 2):
-                if "page" in hit["_source"]:
-                    page = hit["_source"]["page"]
-                else:
-                    page = None
-                if "section_heading" in hit["_source"]:
-                    section_heading = hit["_source"]["section_heading"]
-                else:
-                    section_heading = None
-                if i > 0 and hit["_score"] >= min_hit_score:
-                    # If summary doc score exists for this full text hit then use that, else do not add this item
-                    if hit['_source']['document'] in document_summary_high_scores:
-                        document_score = config_dict['summary_weight_over_full_text'] * document_summary_high_scores[hit["_source"]["document"]]
-                        hit_sections.append(
-                                {
-                                    "document": hit["_source"]["document"],
-                                    "page": page,
-                                    "section_heading": section_heading,
-                                    "section": i,
-                                    "document_score": hit["_score"] + document_score
-                                }
-                            )
-    else:
-        for hit in full_text_response["hits"]["hits"]:
-            for i in range(hit["_source"]["section"] - 3, hit["_source"]["section"] + 4):
-                if "page" in hit["_source"]:
-                    page = hit["_source"]["page"]
-                else:
-                    page = None
-                if "section_heading" in hit["_source"]:
-                    section_heading = hit["_source"]["section_heading"]
-                else:
-                    section_heading = None
-                if i > 0 and hit["_score"] >= min_hit_score:
-                    hit_sections.append(
-                            {
-                                "document": hit["_source"]["document"],
-                                "page": page,
-                                "section_heading": section_heading,
-                                "section": i,
-                                "document_score": hit["_score"],
-                            }
-                        )
+        msearch_body.extend([{"index": summary_index_name}, summary_query])
+    msearch_responses = opensearch_client.msearch(body=msearch_body)["responses"]
+    for response in msearch_responses:
+        if "error" in response:
+            raise RuntimeError("OpenSearch search failed: " + json.dumps(response["error"]))
+    full_text_response = msearch_responses[0]
+    timings["search_ms"] = elapsed_ms(search_start)
 
-    # Sort the hit list by score high to low
-    sorted_section_list_with_scores = sorted(hit_sections, key=lambda x: (x['document_score'] * -1, x['document'], x['page'], x['section_heading'], x['section']))    
-    # Remove the scores and eliminate duplicates in the sorted hit list
-    sorted_section_list_without_scores = []
+    if config_dict['use_summary']:
+        summary_response = msearch_responses[1]
+        print("Got",len(summary_response["hits"]["hits"]),"hits.")
+        document_summary_high_scores, min_summary_hit_score = get_document_summary_scores(summary_response, config_dict)
+    else:
+        document_summary_high_scores = None
 
-    for i in sorted_section_list_with_scores:
-        sorted_section_list_without_scores.append(
-            {
-                "document": i['document'],
-                "section": i['section']
+    # Full text hits of documents with no summary records yet are ranked as if their summary scored at the threshold,
+    # instead of being left out until the summary is indexed
+    pending_check_start = time.perf_counter()
+    if config_dict['use_summary']:
+        unscored_documents = {hit["_source"]["document"] for hit in full_text_response["hits"]["hits"]} - set(document_summary_high_scores)
+        # Documents are summarized in a separate stage after their full text is indexed, so documents with full text hits
+        # but no summary hits are checked for summary records, to find those whose summary is still pending
+        summarized_documents = set()
+        if len(unscored_documents) > 0:
+            query={
+                "size": 0,
+                "query": {
+                    "terms": {
+                        "document.keyword": list(unscored_documents)
+                    }
+                },
+                "aggs": {
+                    "documents": {
+                        "terms": {
+                            "field": "document.keyword",
+                            "size": len(unscored_documents)
+                        }
+                    }
+                }
             }
-        )
+            summarized_response = opensearch_client.search(index=summary_index_name, body=query)
+            summarized_documents.update(bucket["key"] for bucket in summarized_response["aggregations"]["documents"]["buckets"])
+        for document in unscored_documents - summarized_documents:
+            print("Document", document, "is not summarized yet")
+            document_summary_high_scores[document] = min_summary_hit_score
+
+    timings["pending_summary_check_ms"] = elapsed_ms(pending_check_start)
 
-    deduplicated_section_list = {frozenset(item.items()) : item for item in sorted_section_list_without_scores}.values()
-    
-    # Retrieve the text of the each section in the hit list and concatenate into a single string as RAG context for the LLM
+    # Rank the full text hits and their neighbouring sections
+    rank_start = time.perf_counter()
+    deduplicated_section_list = rank_full_text_sections(full_text_response["hits"]["hits"], document_summary_high_scores, config_dict)
+    timings["rank_ms"] = elapsed_ms(rank_start)
+
+    # Retrieve the text of every section in the hit list with one search
+    fetch_start = time.perf_counter()
+    section_texts = {}
+    if len(deduplicated_section_list) > 0:
+        requested_sections = [(i['document'], i['section']) for i in deduplicated_section_list]
+        hits_cut_off = fetch_section_texts(opensearch_client, full_text_index_name, requested_sections, section_texts)
+        # If the hits were cut short by sections with more records than allowed for, fetch the sections still missing
+        # Sections past the end of a document are missing too, but the hits are only cut short when there are duplicates
+        missing_sections = [section for section in requested_sections if section not in section_texts]
+        if hits_cut_off and len(missing_sections) > 0:
+            fetch_section_texts(opensearch_client, full_text_index_name, missing_sections, section_texts, records_per_section = len(requested_sections))
+    timings["fetch_sections_ms"] = elapsed_ms(fetch_start)
+
+    # Concatenate the section texts in score order into a single string as RAG context for the LLM
     rag_text = ""
     rag_text_list_chunks = []
     reference_list_with_dupes = []
 
-    for i in sorted_section_list_with_scores:
-        query = {
-            'size': 1,
-            "query": {
-                "bool": {
-                    "must": [
-                        {
-                            "match": {
-                                "document": i["document"]
-                            }
-                        },
-                        {
-                            "match": {
-                                "section": i["section"]
-                            }
-                        }
-                    ]
-                }
-            }
-        }
-        response2 = opensearch_client.search(
-            body = query,
-            index = full_text_index_name
-        )
+    for i in deduplicated_section_list:
+        section_text = section_texts.get((i['document'], i['section']))
         # Check to make sure there is a value and that adding this hit will not make the RAG text exceed the maximum length
-        if len(response2["hits"]["hits"]) > 0 and (len(rag_text) + len(response2["hits"]["hits"][0]["_source"]["text"]) < config_dict['max_length_rag_text']):
+        if section_text is not None and (len(rag_text) + len(section_text) < config_dict['max_length_rag_text']):
             # Add the text from this hit to the RAG text
-            rag_text += response2["hits"]["hits"][0]["_source"]["text"]
+            rag_text += section_text
             # Add the reference - used if option to show text with references is not selected
             reference = {
                 "document": i['document'],
@@ -238,7 +344,7 @@ def opensearch_query(query_text, opensearch_model_id, config_dict):
                 "document": i['document'],
                 "page": i['page'],
                 "section_heading": i['section_heading'],
-                "text": response2["hits"]["hits"][0]["_source"]["text"]
+                "text": section_text
             }
             rag_text_list_chunks.append(rag_text_item)        
 
@@ -285,4 +391,5 @@ def opensearch_query(query_text, opensearch_model_id, config_dict):
         if config_dict['include_text_in_references']:
             reference_text += "\n" + item['text']
 
-    return(rag_text, reference_text)
\ No newline at end of file
+    timings["total_ms"] = elapsed_ms(query_start)
+    return(rag_text, reference_text, timings)
\ No newline at end of file
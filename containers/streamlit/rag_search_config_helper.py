@@ -30,10 +30,14 @@ def read_rag_search_config():
     config_dict['top_p'] = config['Text Gen'].getint('TopP', 1)
     config_dict['max_gen_len'] = config['Text Gen'].getint("MaxGenLen", 512)
     config_dict['bedrock_model_id'] = config['Text Gen'].get('BedrockModelId', 'amazon.titan-text-express-v1')
+    # Read the Answer Cache parameters
+    config_dict['use_answer_cache'] = config['Answer Cache'].getboolean('UseAnswerCache', True)
+    config_dict['answer_cache_backend'] = config['Answer Cache'].get('AnswerCacheBackend', 'memory')
+    config_dict['answer_cache_path'] = config['Answer Cache'].get('AnswerCachePath', '/tmp/chatbot_answer_cache.sqlite')
+    config_dict['answer_cache_max_entries'] = config['Answer Cache'].getint('AnswerCacheMaxEntries', 500)
+    config_dict['answer_cache_ttl_seconds'] = config['Answer Cache'].getint('AnswerCacheTtlSeconds', 86400)
     # Clamp the values from the config file to within limits
     config_dict = clamp_rag_search_config(config_dict)
-    # Set points to deduct per day based on years_until_no_value
-    config_dict['points_deduct_per_day_old'] = 1/(365 * config_dict['years_until_no_value'])
     return(config_dict)
     
 def clamp_rag_search_config(config_dict):
@@ -46,4 +50,6 @@ def clamp_rag_search_config(config_dict):
     config_dict['max_token_count'] = clamp(config_dict['max_token_count'], 1, 8192)
     config_dict['temperature'] = clamp(config_dict['temperature'], 0, 1)
     config_dict['top_p'] = clamp(config_dict['top_p'], 0, 1)
+    config_dict['answer_cache_max_entries'] = clamp(config_dict['answer_cache_max_entries'], 1, 100000)
+    config_dict['answer_cache_ttl_seconds'] = clamp(config_dict['answer_cache_ttl_seconds'], 0, 604800)
     return(config_dict)
\ No newline at end of file
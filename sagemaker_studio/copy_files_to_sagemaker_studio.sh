@@ -13,10 +13,17 @@ cd /home/sagemaker-user/chatbot
 cp /home/sagemaker-user/rag-chatbot-with-bedrock-opensearch-and-document-summaries-in-govcloud/sagemaker_studio/notebooks/* .
 cp /home/sagemaker-user/rag-chatbot-with-bedrock-opensearch-and-document-summaries-in-govcloud/sagemaker_studio/streamlit/* .
 cp /home/sagemaker-user/rag-chatbot-with-bedrock-opensearch-and-document-summaries-in-govcloud/containers/lambda_index/index_documents_helper.py .
+cp /home/sagemaker-user/rag-chatbot-with-bedrock-opensearch-and-document-summaries-in-govcloud/containers/lambda_index/summary_cache_helper.py .
+cp /home/sagemaker-user/rag-chatbot-with-bedrock-opensearch-and-document-summaries-in-govcloud/containers/lambda_index/embedding_helper.py .
+cp /home/sagemaker-user/rag-chatbot-with-bedrock-opensearch-and-document-summaries-in-govcloud/containers/lambda_index/fan_out_helper.py .
+cp /home/sagemaker-user/rag-chatbot-with-bedrock-opensearch-and-document-summaries-in-govcloud/containers/lambda_index/metrics_helper.py .
+cp /home/sagemaker-user/rag-chatbot-with-bedrock-opensearch-and-document-summaries-in-govcloud/containers/lambda_index/bedrock_rate_limiter.py .
+cp /home/sagemaker-user/rag-chatbot-with-bedrock-opensearch-and-document-summaries-in-govcloud/containers/lambda_index/backfill_indices.py .
 cp /home/sagemaker-user/rag-chatbot-with-bedrock-opensearch-and-document-summaries-in-govcloud/containers/streamlit/chat.py .
 cp /home/sagemaker-user/rag-chatbot-with-bedrock-opensearch-and-document-summaries-in-govcloud/containers/streamlit/get_opensearch_model_id.py .
 cp /home/sagemaker-user/rag-chatbot-with-bedrock-opensearch-and-document-summaries-in-govcloud/containers/streamlit/opensearch_retrieve_helper.py .
 cp /home/sagemaker-user/rag-chatbot-with-bedrock-opensearch-and-document-summaries-in-govcloud/containers/streamlit/rag_search_config_helper.py .
+cp /home/sagemaker-user/rag-chatbot-with-bedrock-opensearch-and-document-summaries-in-govcloud/containers/streamlit/answer_cache_helper.py .
 cp /home/sagemaker-user/rag-chatbot-with-bedrock-opensearch-and-document-summaries-in-govcloud/containers/streamlit/rag_search.cfg .
 cp /home/sagemaker-user/rag-chatbot-with-bedrock-opensearch-and-document-summaries-in-govcloud/containers/streamlit/requirements.txt .
 mkdir /home/sagemaker-user/chatbot/pages
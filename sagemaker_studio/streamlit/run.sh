@@ -19,6 +19,7 @@ export OPENSEARCH_SERVICE_ENDPOINT=`aws cloudformation describe-stacks --region
 export OPENSEARCH_FULL_TEXT_INDEX="chatbot-full_text"
 export OPENSEARCH_SUMMARY_INDEX="chatbot-summary"
 export OPENSEARCH_DATE_INDEX="chatbot-date-index"
+export OPENSEARCH_GENERATION_INDEX="chatbot-index-generation"
 
 # Run the Streamlit app and save the output to "temp.txt"
 streamlit run chat.py > temp.txt & 